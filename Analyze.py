@@ -0,0 +1,350 @@
+import argparse
+import gzip
+import itertools
+import json
+import math
+import time
+
+import numpy as np
+
+CHUNK_SIZE = 200000
+CACHE_SIZES = [100, 1000, 10000, 100000, 1000000]
+# multiplier of key hash for key sampling (Knuth multiplicative hash)
+_HASH = np.uint64(2654435761)
+
+
+def read_cli():
+    parser = argparse.ArgumentParser(description='Analyze json query logs of QueryLog.Log')
+    parser.add_argument('paths', nargs='+', type=str, metavar='path',
+                        help='json query log files (gzip if name ends with .gz), e.g. rotated logs of several days')
+    parser.add_argument('--chunk-size', default=CHUNK_SIZE, type=int, help='records parsed at once')
+    parser.add_argument('--top', default=20, type=int, help='rows of frequency and candidate tables')
+    parser.add_argument('--cache-sizes', nargs='+', default=CACHE_SIZES, type=int, metavar='N',
+                        help='answer cache sizes to simulate hit ratio for')
+    parser.add_argument('--target', default=0.95, type=float,
+                        help='hit ratio to find the smallest answer cache size for [0-1]')
+    parser.add_argument('--sample-rate', default=1., type=float,
+                        help='fraction of cache keys to simulate [0-1] for very large logs')
+    parser.add_argument('--suffix-labels', default=2, type=int,
+                        help='labels of domain names candidates are grouped by (2: example.com)')
+    parser.add_argument('--min-clients', default=2, type=int, help='clients a candidate should be queried by')
+    parser.add_argument('--output', default=None, type=str, help='write json results to this path', metavar='path')
+    return parser.parse_args()
+
+
+# fields of query records written by QueryLog.Log in json format
+_REQUIRED = frozenset(('ts', 'client', 'qname', 'qtype', 'rcode', 'ttl', 'local'))
+
+
+class Columns:
+    """
+    query log records as numpy columns. names, clients, qtypes and rcodes are dictionary encoded: columns hold
+    integer codes into vocabularies, so memory is a few bytes per record plus one string per distinct value
+    """
+    FIELDS = ('qname', 'client', 'qtype', 'rcode')
+    DTYPES = {**{x: np.int32 for x in FIELDS}, 'ts': np.float64, 'ttl': np.int64, 'local': bool}
+
+    def __init__(self):
+        self.vocabularies = {x: {} for x in self.FIELDS}
+        self._chunks = {x: [] for x in self.DTYPES}
+        self.columns = {}
+        self.invalid = 0
+
+    def __len__(self):
+        return len(self.columns['ts']) if self.columns else 0
+
+    def __getattr__(self, item):
+        try:
+            return self.__dict__['columns'][item]
+        except KeyError:
+            raise AttributeError(item)
+
+    def values(self, field):
+        """
+        :return: values of field by code
+        """
+        return list(self.vocabularies[field])
+
+    def add(self, records):
+        """
+        append a chunk of records (dicts)
+        """
+        for field, dtype in self.DTYPES.items():
+            vocabulary = self.vocabularies.get(field)
+            if vocabulary is not None:
+                values = [vocabulary.setdefault(x[field], len(vocabulary)) for x in records]
+            else:
+                values = [x[field] for x in records]
+            self._chunks[field].append(np.array(values, dtype=dtype))
+
+    def finish(self):
+        """
+        join chunks into columns ordered by time (logs of several files or server processes are interleaved)
+        """
+        columns = {k_: np.concatenate(v_) if v_ else np.array([], dtype=self.DTYPES[k_])
+                   for k_, v_ in self._chunks.items()}
+        self._chunks = {k_: [] for k_ in self._chunks}
+        order = np.argsort(columns['ts'], kind='stable')
+        self.columns = {k_: v_[order] for k_, v_ in columns.items()}
+        return self
+
+
+def _open(path):
+    return gzip.open(path, 'rt') if path.endswith('.gz') else open(path)
+
+
+def load(paths, chunk_size=CHUNK_SIZE):
+    """
+    read json lines of paths chunk by chunk into columns. lines which are not query records are counted and skipped
+    """
+    columns = Columns()
+    for path in paths:
+        with _open(path) as f_:
+            while True:
+                lines = [x for x in itertools.islice(f_, chunk_size) if x.strip()]
+                if not lines:
+                    break
+                records = _parse(lines)
+                columns.invalid += len(lines) - len(records)
+                columns.add(records)
+    return columns.finish()
+
+
+def _parse(lines):
+    try:
+        # one json document per chunk is parsed much faster than a document per line
+        records = json.loads(f'[{",".join(lines)}]')
+    except ValueError:
+        records = []
+        for line in lines:
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                pass
+    return [x for x in records if isinstance(x, dict) and x.keys() >= _REQUIRED]
+
+
+def _top(codes, values, count, total):
+    counts = np.bincount(codes, minlength=len(values))
+    top = np.argsort(-counts, kind='stable')[:count]
+    return [{'value': values[x], 'queries': int(counts[x]), 'share': round(counts[x] / total, 4)}
+            for x in top if counts[x]]
+
+
+def frequencies(columns: Columns, top=20):
+    """
+    :return: most queried names, most active clients, qtype and rcode distributions, and share of queries of top
+        10/100/1000 names
+    """
+    total = len(columns)
+    if not total:
+        return {'queries': 0}
+    counts = np.sort(np.bincount(columns.qname))[::-1]
+    covered = np.cumsum(counts)
+    return {
+        'queries': total, 'names': len(columns.vocabularies['qname']),
+        'clients': len(columns.vocabularies['client']), 'local': round(float(columns.local.mean()), 4),
+        'top_names': _top(columns.qname, columns.values('qname'), top, total),
+        'top_clients': _top(columns.client, columns.values('client'), top, total),
+        'qtypes': _top(columns.qtype, columns.values('qtype'), top, total),
+        'rcodes': _top(columns.rcode, columns.values('rcode'), top, total),
+        'top_names_share': {n_: round(float(covered[min(n_, len(covered)) - 1]) / total, 4) for n_ in (10, 100, 1000)},
+    }
+
+
+def previous_access(keys):
+    """
+    :return: position of previous access of the same key for each access (-1 for first accesses)
+    """
+    order = np.argsort(keys, kind='stable')
+    same = keys[order[1:]] == keys[order[:-1]]
+    previous = np.full(len(keys), -1, dtype=np.int64)
+    previous[order[1:][same]] = order[:-1][same]
+    return previous
+
+
+def earlier_greater(values):
+    """
+    :return: for each position i, number of positions j < i with values[j] > values[i]
+    notes:
+        - bottom-up merge sort: at each level every element of a right run counts greater elements of its left run
+          with one searchsorted over all (group, value) ordered left runs, so work is vectorized over the whole array
+          in log2(n) levels
+    """
+    n = len(values)
+    counts = np.zeros(n, dtype=np.int64)
+    if n < 2:
+        return counts
+    values = values.astype(np.int64) - values.min()
+    span = int(values.max()) + 1
+    indexes, positions = np.arange(n), np.arange(n)
+    width = 1
+    while width < n:
+        group = positions // (2 * width)
+        left = (positions // width) % 2 == 0
+        # runs of width are sorted, so left runs are sorted by (group, value) as a whole
+        keys = group * span + values
+        left_keys, right_keys, right_group = keys[left], keys[~left], group[~left]
+        counts[indexes[~left]] += np.searchsorted(left_keys, (right_group + 1) * span, side='left') - \
+            np.searchsorted(left_keys, right_keys, side='right')
+        # merge runs pairwise (stable sort of presorted runs)
+        order = np.argsort(keys, kind='stable')
+        values, indexes = values[order], indexes[order]
+        width *= 2
+    return counts
+
+
+def fresh_accesses(keys, ts, ttls):
+    """
+    :return: whether answer of each access is within its ttl in an unbounded cache. answers are refetched (with ttl of
+        that access) when their ttl has passed
+    """
+    fresh = [False] * len(keys)
+    expires = {}
+    for i_, (key, now, ttl) in enumerate(zip(keys.tolist(), ts.tolist(), ttls.tolist())):
+        if now < expires.get(key, now):
+            fresh[i_] = True
+        else:
+            expires[key] = now + ttl
+    return np.array(fresh, dtype=bool)
+
+
+def reuse_distances(keys, ts, ttls):
+    """
+    lru stack distance of each access: number of distinct keys accessed since previous access of the same key. an
+    access is a hit in an lru cache of size n if its distance is less than n. cold accesses and accesses after ttl of
+    the answer has passed are misses whatever the size (-1)
+    notes:
+        - distinct keys between previous access p and access i are accesses j in (p, i) minus the ones whose key is
+          accessed again before i, i.e. j < i with previous[j] > p: distance = i - p - 1 - earlier_greater(previous)
+    """
+    previous = previous_access(keys)
+    distances = np.arange(len(keys)) - previous - 1 - earlier_greater(previous)
+    distances[(previous < 0) | ~fresh_accesses(keys, ts, ttls)] = -1
+    return distances
+
+
+def cache_curve(columns: Columns, sizes=CACHE_SIZES, target=0.95, sample_rate=1.):
+    """
+    simulate answer cache (lru eviction and ttl expiry) over upstream queries (qname, qtype) of log
+    notes:
+        - expiry is simulated as in an unbounded cache (answer is refetched when its ttl has passed)
+        - with sample_rate < 1 only keys whose hash falls in the rate are simulated and their distances are scaled up
+          by 1 / rate (SHARDS). it bounds time and memory of very large logs; curves of a few very popular names are
+          noisy at low rates
+        - one answer cache of a server process is simulated; server processes keep their own caches
+    """
+    upstream = ~columns.local
+    keys = columns.qname[upstream].astype(np.uint64) * np.uint64(max(1, len(columns.vocabularies['qtype']))) + \
+        columns.qtype[upstream].astype(np.uint64)
+    ts, ttls = columns.ts[upstream], columns.ttl[upstream]
+    total = len(keys)
+    if sample_rate < 1:
+        with np.errstate(over='ignore'):
+            sampled = (keys * _HASH) % np.uint64(1 << 32) < np.uint64(int(sample_rate * (1 << 32)))
+        keys, ts, ttls = keys[sampled], ts[sampled], ttls[sampled]
+    result = {'queries': total, 'simulated': len(keys), 'sample_rate': round(sample_rate, 6)}
+    if not len(keys):
+        return {**result, 'curve': [], 'max_hit_ratio': 0., 'target': target, 'target_size': None}
+    distances = reuse_distances(keys, ts, ttls)
+    hits = np.sort(distances[distances >= 0] / sample_rate)
+    simulated = len(keys)
+    curve = [{'size': x, 'hit_ratio': round(np.searchsorted(hits, x, side='left') / simulated, 4)} for x in sizes]
+    needed = int(math.ceil(target * simulated))
+    # smallest size which makes needed accesses hits: distance of the needed-th nearest reuse plus one
+    target_size = int(math.floor(hits[needed - 1])) + 1 if 0 < needed <= len(hits) else None
+    return {**result, 'curve': curve, 'max_hit_ratio': round(len(hits) / simulated, 4), 'target': target,
+            'target_size': target_size}
+
+
+def base_name(name, labels=2):
+    parts = name.split('.')
+    return '.'.join(parts[-labels:]) if len(parts) > labels else name
+
+
+def candidates(columns: Columns, suffix_labels=2, top=20, min_clients=2):
+    """
+    domains (grouped by their last suffix_labels labels) whose upstream queries would be saved most by a list entry
+    (e.g. BlackList or LocalDB). entries are "*.<domain>" for its subdomains and the domain itself if it was queried
+    :return: candidates with upstream queries, distinct clients and names, and nxdomain ratio
+    """
+    names = columns.values('qname')
+    bases = {}
+    base_codes = np.array([bases.setdefault(base_name(x, suffix_labels), len(bases)) for x in names] or [0],
+                          dtype=np.int64)
+    upstream = ~columns.local
+    qname = columns.qname[upstream]
+    base = base_codes[qname]
+    queries = np.bincount(base, minlength=len(bases))
+    clients = np.bincount(np.unique(base * len(columns.vocabularies['client']) + columns.client[upstream]) //
+                          max(1, len(columns.vocabularies['client'])), minlength=len(bases))
+    distinct = np.unique(qname)
+    distinct_names = np.bincount(base_codes[distinct], minlength=len(bases))
+    nxdomain = columns.vocabularies['rcode'].get('NXDOMAIN')
+    nxdomains = np.bincount(base, weights=columns.rcode[upstream] == nxdomain, minlength=len(bases)) \
+        if nxdomain is not None else np.zeros(len(bases))
+    queried_itself = np.zeros(len(bases), dtype=bool)
+    for code in distinct.tolist():
+        if base_name(names[code], suffix_labels) == names[code]:
+            queried_itself[base_codes[code]] = True
+    base_values = list(bases)
+    result = []
+    for code in np.argsort(-queries, kind='stable').tolist():
+        if len(result) >= top or not queries[code]:
+            break
+        if clients[code] < min_clients:
+            continue
+        domain = base_values[code]
+        entries = ([domain] if queried_itself[code] else []) + \
+            ([f'*.{domain}'] if distinct_names[code] > int(queried_itself[code]) else [])
+        result.append({'domain': domain, 'entries': entries, 'queries': int(queries[code]),
+                       'clients': int(clients[code]), 'names': int(distinct_names[code]),
+                       'nxdomain_ratio': round(float(nxdomains[code]) / queries[code], 4)})
+    return result
+
+
+def print_table(title, rows, columns):
+    print(f'\n{title}')
+    print(''.join(f'{x:>18}' for x in columns))
+    for r_ in rows:
+        row = []
+        for c_ in columns:
+            v_ = r_[c_]
+            v_ = ' '.join(v_) if isinstance(v_, list) else v_
+            row.append(f'{v_:>18.4f}' if isinstance(v_, float) else f'{str(v_):>18}')
+        print(''.join(row))
+
+
+def main(args):
+    start = time.perf_counter()
+    columns = load(args.paths, args.chunk_size)
+    loaded = time.perf_counter()
+    freq = frequencies(columns, args.top)
+    curve = cache_curve(columns, args.cache_sizes, args.target, args.sample_rate)
+    result = {
+        'records': len(columns), 'invalid': columns.invalid, 'frequencies': freq, 'cache': curve,
+        'candidates': candidates(columns, args.suffix_labels, args.top, args.min_clients),
+        'load_seconds': round(loaded - start, 3), 'analysis_seconds': round(time.perf_counter() - loaded, 3),
+    }
+    print(f'{result["records"]} records ({result["invalid"]} invalid lines) loaded in {result["load_seconds"]}s, '
+          f'analyzed in {result["analysis_seconds"]}s')
+    if columns:
+        print(f'{freq["names"]} names, {freq["clients"]} clients, {freq["local"]:.2%} answered by plugins. '
+              f'top 10/100/1000 names: {list(freq["top_names_share"].values())} of queries')
+        print_table('most queried names', freq['top_names'], ['value', 'queries', 'share'])
+        print_table('most active clients', freq['top_clients'], ['value', 'queries', 'share'])
+        print_table('rcodes', freq['rcodes'], ['value', 'queries', 'share'])
+        print_table(f'answer cache ({curve["simulated"]} of {curve["queries"]} upstream queries simulated)',
+                    curve['curve'], ['size', 'hit_ratio'])
+        print(f'max hit ratio (ttl bound): {curve["max_hit_ratio"]}. size for {curve["target"]} hit ratio: '
+              f'{curve["target_size"] or "unreachable"}')
+        print_table('list candidates', result['candidates'],
+                    ['domain', 'queries', 'clients', 'names', 'nxdomain_ratio', 'entries'])
+    if args.output:
+        with open(args.output, 'w') as f_:
+            json.dump(result, f_, indent=2)
+    return result
+
+
+if __name__ == '__main__':
+    main(read_cli())
@@ -0,0 +1,401 @@
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import random
+import socket
+import statistics
+import subprocess
+import sys
+import time
+
+import dns.message
+import dotenv
+
+ZONE_SIZE = 1000
+BLOCKED_SIZE = 1000
+BENCH_ZONE = 'bench.test'
+BLOCKED_ZONE = 'blocked.test'
+MISSING_ZONE = 'missing.test'
+RESPONSE_IP = '10.0.0.1'
+# seconds to wait for benchmark server messages (startup, cpu time reports)
+SERVER_TIMEOUT = 30
+
+# weight of each name category in a query mix
+# hit: popular names resolvable by upstream, blocked: names in black list, nxdomain: unique names unknown to upstream
+QUERY_MIXES = {
+    'cache-hit': {'hit': 0.90, 'blocked': 0.05, 'nxdomain': 0.05},
+    'blocklist': {'hit': 0.30, 'blocked': 0.60, 'nxdomain': 0.10},
+    'nxdomain': {'hit': 0.10, 'blocked': 0.10, 'nxdomain': 0.80},
+}
+
+PLUGIN_CONFIGS = {
+    'none': [],
+    'querylog': ['QueryLog.Log'],
+    'blacklist': ['Authoritative.BlackList'],
+    'blacklist-bloom': ['Authoritative.BlackList'],
+    'localdb': ['Authoritative.LocalDB'],
+}
+
+# extra environment variables of plugin configurations
+PLUGIN_ENVS = {
+    'blacklist-bloom': {'DNSPY__PLUGIN__AUTHORITATIVE__BLOOM_FILTER': 'true'},
+}
+
+_REDIS_URI_FAKE = 'redis://fakeredis:6379/0'
+
+
+def read_cli():
+    parser = argparse.ArgumentParser(description='Benchmark DNS proxy server against a local stub upstream')
+    parser.add_argument('--env-file', default=None, type=str, help='path to env file for base configuration',
+                        metavar='path')
+    parser.add_argument('--mix', nargs='+', default=list(QUERY_MIXES.keys()), choices=QUERY_MIXES.keys(),
+                        help='query mixes to replay')
+    parser.add_argument('--config', nargs='+', default=list(PLUGIN_CONFIGS.keys()), choices=PLUGIN_CONFIGS.keys(),
+                        help='plugin configurations to benchmark')
+    parser.add_argument('--qps', default=1000, type=int, help='target queries per second')
+    parser.add_argument('--duration', default=10., type=float, help='seconds to replay each scenario')
+    parser.add_argument('--timeout', default=2., type=float, help='seconds to wait for a response before loss')
+    parser.add_argument('--redis-uri', default=None, type=str,
+                        help='redis server to use for Authoritative plugins. fakeredis is used if not set')
+    parser.add_argument('--seed', default=0, type=int, help='random seed for query generation')
+    parser.add_argument('--upstream-zone', default=None, type=str, metavar='path',
+                        help='zone file for stub upstream. generated bench zone is used if not set')
+    parser.add_argument('--upstream-latency', default=0., type=float, help='stub upstream latency in seconds')
+    parser.add_argument('--upstream-jitter', default=0., type=float, help='stub upstream random extra latency')
+    parser.add_argument('--upstream-loss', default=0., type=float, help='stub upstream loss rate [0-1]')
+    parser.add_argument('--upstream-truncation', default=0., type=float, help='stub upstream truncation rate [0-1]')
+    parser.add_argument('--upstream-servfail', default=0., type=float, help='stub upstream SERVFAIL rate [0-1]')
+    parser.add_argument('--startup', default=0, type=int, metavar='N',
+                        help='instead of load test, measure cold start time of Server.py over N runs per config')
+    parser.add_argument('--output', default=None, type=str, help='write json results to this path', metavar='path')
+    args = parser.parse_args()
+    if args.env_file:
+        dotenv.load_dotenv(args.env_file)
+    return args
+
+
+def zone_names():
+    return [f'host{i}.{BENCH_ZONE}' for i in range(ZONE_SIZE)]
+
+
+def blocked_names():
+    return [f'ad{i}.{BLOCKED_ZONE}' for i in range(BLOCKED_SIZE)]
+
+
+class QueryGenerator:
+    """
+    generate query names for a mix. popular names follow a zipf like distribution
+    """
+
+    def __init__(self, mix: dict, seed=0):
+        self.random = random.Random(seed)
+        self.categories = list(mix.keys())
+        self.weights = list(mix.values())
+        self.names = {'hit': zone_names(), 'blocked': blocked_names()}
+        self.cum_weights = {k: self._zipf_weights(len(v)) for k, v in self.names.items()}
+        self.counter = 0
+
+    @staticmethod
+    def _zipf_weights(n, s=1.):
+        weights = []
+        total = 0.
+        for i_ in range(1, n + 1):
+            total += 1. / (i_ ** s)
+            weights.append(total)
+        return weights
+
+    def __next__(self):
+        category = self.random.choices(self.categories, self.weights)[0]
+        if category == 'nxdomain':
+            self.counter += 1
+            return f'nx{self.counter}-{self.random.getrandbits(32)}.{MISSING_ZONE}'
+        return self.random.choices(self.names[category], cum_weights=self.cum_weights[category])[0]
+
+    def __iter__(self):
+        return self
+
+
+class LoadClient(asyncio.protocols.DatagramProtocol):
+    """
+    open loop load generator. sends queries at a constant rate and matches responses by message id
+    """
+
+    def __init__(self, target, generator, qps, duration, timeout):
+        self.target = target
+        self.generator = generator
+        self.qps = qps
+        self.duration = duration
+        self.timeout = timeout
+        self.transport = None
+        self.pending = {}
+        self.latencies = []
+        self.sent = 0
+        self.lost = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        now = time.perf_counter()
+        qid = int.from_bytes(data[:2], 'big')
+        sent_at = self.pending.pop(qid, None)
+        if sent_at is not None:
+            self.latencies.append(now - sent_at)
+
+    def _send(self):
+        qid = self.sent % 65536
+        if qid in self.pending:
+            self.lost += 1
+        query = dns.message.make_query(next(self.generator), 'A')
+        query.id = qid
+        self.pending[qid] = time.perf_counter()
+        self.transport.sendto(query.to_wire(), self.target)
+        self.sent += 1
+
+    async def run(self):
+        start = time.perf_counter()
+        while True:
+            elapsed = time.perf_counter() - start
+            if elapsed >= self.duration:
+                break
+            for _ in range(int(elapsed * self.qps) - self.sent):
+                self._send()
+            await asyncio.sleep(0.001)
+        deadline = time.perf_counter() + self.timeout
+        while self.pending and time.perf_counter() < deadline:
+            await asyncio.sleep(0.01)
+        self.lost += len(self.pending)
+        return time.perf_counter() - start
+
+
+def _percentile(values, p):
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(p / 100. * (len(values) - 1))))
+    return values[index]
+
+
+def stub_options(args):
+    return dict(
+        latency=getattr(args, 'upstream_latency', 0.),
+        jitter=getattr(args, 'upstream_jitter', 0.),
+        loss=getattr(args, 'upstream_loss', 0.),
+        truncation=getattr(args, 'upstream_truncation', 0.),
+        servfail=getattr(args, 'upstream_servfail', 0.),
+        seed=args.seed,
+    )
+
+
+def _serve(env: dict, conn, zone_file=None, options=None):
+    """
+    run stub upstream and server in a separate process so that its cpu time can be measured apart from load generator
+    note: reported cpu time includes the stub upstream which shares the process with server
+    """
+    os.environ.update(env)
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    asyncio.get_event_loop().run_until_complete(_serve_async(conn, zone_file, options or {}))
+
+
+async def _serve_async(conn, zone_file, options):
+    import DNS.Config
+    import DNS.Core
+    from DNS.Stub import StubDNSServer
+
+    if zone_file:
+        upstream = StubDNSServer.from_file(zone_file, **options)
+    else:
+        upstream = StubDNSServer({x: ['192.0.2.1'] for x in zone_names()}, **options)
+    await upstream.start()
+    os.environ['DNSPY__UPSTREAM_IP'], os.environ['DNSPY__UPSTREAM_PORT'] = map(str, upstream.address)
+    DNS.Config.Configuration.load()
+    server = DNS.Core.UDPDNSServer()
+    await _init_redis(server)
+    await server.start()
+
+    loop = asyncio.get_running_loop()
+    conn.send(server.transport.get_extra_info('sockname')[:2])
+    while True:
+        command = await loop.run_in_executor(None, conn.recv)
+        if command == 'cpu':
+            conn.send(time.process_time())
+        elif command == 'stop':
+            break
+    await server.stop()
+    await upstream.stop()
+
+
+async def _init_redis(server):
+    plugins = [x for x in server.plugins if hasattr(x, 'redis')]
+    if not plugins:
+        return
+    if os.environ['DNSPY__PLUGIN__AUTHORITATIVE__REDIS_URI'] == _REDIS_URI_FAKE:
+        # noinspection PyPackageRequirements
+        import fakeredis.aioredis
+        redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        for p_ in plugins:
+            p_.redis = redis
+    for p_ in plugins:
+        key = p_.config.redis_key_A
+        names = [*blocked_names(), f'*.{BLOCKED_ZONE}']
+        if p_.__class__.__name__ == 'LocalDB':
+            await p_.redis.hset(key, mapping={x: RESPONSE_IP for x in names})
+        else:
+            await p_.redis.sadd(key, *names)
+        if getattr(p_.config, 'bloom_filter', False):
+            await p_.rebuild_filter()
+
+
+def scenario_env(config_name, args):
+    return {
+        'DNSPY__LOCAL_IP': '127.0.0.1',
+        'DNSPY__LOCAL_PORT': '0',
+        'DNSPY__PLUGINS': json.dumps(PLUGIN_CONFIGS[config_name]),
+        'DNSPY__PLUGIN__AUTHORITATIVE__REDIS_URI': args.redis_uri or _REDIS_URI_FAKE,
+        'DNSPY__PLUGIN__AUTHORITATIVE.BLACKLIST__RESPONSE_IP': json.dumps([RESPONSE_IP]),
+        'LOGURU_LEVEL': os.environ.get('LOGURU_LEVEL', 'WARNING'),
+        **PLUGIN_ENVS.get(config_name, {}),
+    }
+
+
+def _receive(conn, process, timeout=SERVER_TIMEOUT):
+    """
+    receive a message from server process. fails instead of blocking forever if server process dies
+    """
+    deadline = time.monotonic() + timeout
+    while not conn.poll(0.1):
+        if not process.is_alive():
+            raise RuntimeError(f'benchmark server exited with code {process.exitcode}')
+        if time.monotonic() > deadline:
+            raise RuntimeError(f'benchmark server did not respond in {timeout} seconds')
+    try:
+        return conn.recv()
+    except EOFError:
+        process.join(1)
+        raise RuntimeError(f'benchmark server exited with code {process.exitcode}')
+
+
+def run_scenario(config_name, mix_name, args):
+    env = scenario_env(config_name, args)
+    ctx = multiprocessing.get_context('spawn')
+    conn, child_conn = ctx.Pipe()
+    process = ctx.Process(target=_serve, args=(env, child_conn, getattr(args, 'upstream_zone', None),
+                                               stub_options(args)), daemon=True)
+    process.start()
+    child_conn.close()
+    try:
+        target = _receive(conn, process)
+        conn.send('cpu')
+        cpu_start = _receive(conn, process)
+        loop = asyncio.new_event_loop()
+        try:
+            result = loop.run_until_complete(_load(target, mix_name, args))
+        finally:
+            loop.close()
+        conn.send('cpu')
+        cpu_end = _receive(conn, process)
+        conn.send('stop')
+        process.join(5)
+    finally:
+        if process.is_alive():
+            process.terminate()
+    result.update(config=config_name, mix=mix_name)
+    answered = result['answered']
+    result['cpu_us_per_query'] = (cpu_end - cpu_start) / answered * 1e6 if answered else None
+    return result
+
+
+async def _load(target, mix_name, args):
+    loop = asyncio.get_running_loop()
+    generator = QueryGenerator(QUERY_MIXES[mix_name], seed=args.seed)
+    client = LoadClient(target, generator, args.qps, args.duration, args.timeout)
+    transport, _ = await loop.create_datagram_endpoint(lambda: client, remote_addr=target)
+    try:
+        elapsed = await client.run()
+    finally:
+        transport.close()
+    latencies = sorted(client.latencies)
+    return dict(
+        target_qps=args.qps,
+        sent=client.sent,
+        answered=len(latencies),
+        lost=client.lost,
+        qps=len(latencies) / elapsed,
+        **{f'p{k}_ms': (lambda x: x * 1e3 if x is not None else None)(_percentile(latencies, v))
+           for k, v in [('50', 50), ('99', 99), ('999', 99.9)]}
+    )
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as s_:
+        s_.bind(('127.0.0.1', 0))
+        return s_.getsockname()[1]
+
+
+def measure_startup(config_name, args):
+    """
+    time from spawning Server.py until its listener is bound ("server started" log)
+    """
+    env = {
+        **os.environ,
+        **scenario_env(config_name, args),
+        'DNSPY__LOCAL_PORT': str(_free_port()),
+        'LOGURU_LEVEL': 'WARNING',
+    }
+    timings = []
+    for _ in range(args.startup):
+        start = time.perf_counter()
+        process = subprocess.Popen([sys.executable, 'Server.py'], env=env, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, text=True)
+        try:
+            for line in process.stdout:
+                if 'server started' in line:
+                    timings.append(time.perf_counter() - start)
+                    break
+            else:
+                raise RuntimeError(f'server failed to start with config {config_name}')
+        finally:
+            process.terminate()
+            process.wait()
+    return dict(
+        config=config_name,
+        runs=len(timings),
+        min_ms=min(timings) * 1e3,
+        median_ms=statistics.median(timings) * 1e3,
+        max_ms=max(timings) * 1e3,
+    )
+
+
+def print_results(results, columns=None):
+    columns = columns or ['config', 'mix', 'sent', 'answered', 'lost', 'qps', 'p50_ms', 'p99_ms', 'p999_ms',
+                          'cpu_us_per_query']
+    print(''.join(f'{x:>18}' for x in columns))
+    for r_ in results:
+        row = []
+        for c_ in columns:
+            v_ = r_[c_]
+            row.append(f'{v_:>18.3f}' if isinstance(v_, float) else f'{str(v_):>18}')
+        print(''.join(row))
+
+
+def main(args):
+    results = []
+    if args.startup:
+        for config_name in args.config:
+            results.append(measure_startup(config_name, args))
+        print_results(results, ['config', 'runs', 'min_ms', 'median_ms', 'max_ms'])
+    else:
+        for config_name in args.config:
+            for mix_name in args.mix:
+                results.append(run_scenario(config_name, mix_name, args))
+        print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f_:
+            json.dump(results, f_, indent=2)
+    return results
+
+
+if __name__ == '__main__':
+    os.chdir(os.path.dirname(os.path.realpath(__file__)))
+    main(read_cli())
@@ -0,0 +1,139 @@
+import os
+import time
+
+import dns.exception
+import dns.name
+import dns.rdataclass
+import dns.rdatatype
+from aiohttp import web
+
+import DNS.RedisTopology
+from DNS.Logging import logger
+
+
+def _cache_key_text(key):
+    text = f'{key[0].to_text()} {dns.rdataclass.to_text(key[2])} {dns.rdatatype.to_text(key[1])}'
+    # ECS scoped answers
+    return text if len(key) == 3 else f'{text} {key[4]}/{key[5]}'
+
+
+class AdminServer:
+    """
+    http api to inspect and operate a running server process. it has no authentication, so it should only listen on
+    a loopback address
+    notes:
+        - GET /status: in-flight queries, plugin chain, cache, upstream and rate limit summary
+        - GET /plugins: guard counters and hook timings of each plugin. GET /cache?top=n: cache counters and most hit
+          answers. GET /redis: connection pools (and topology) of redis clients of plugins. GET /upstream: upstream
+          connections and health. GET /memory: usage of memory budget by component
+        - POST /cache/flush?name=<name>: remove answers of name (all names without it) from answer cache and shared
+          cache. other server processes keep their own answer cache
+        - POST /reload: reload configuration (as SIGHUP). POST /lists/reload: reload Authoritative lists now.
+          POST /profiler: toggle profiler (as SIGUSR1)
+    """
+
+    def __init__(self, dns_server, local_ip='127.0.0.1', local_port=8053):
+        self.dns_server = dns_server
+        self.local_addr = (local_ip, local_port)
+        self.runner = None
+        app = web.Application()
+        app.add_routes([
+            web.get('/status', self.status), web.get('/plugins', self.plugins), web.get('/cache', self.cache),
+            web.get('/redis', self.redis), web.get('/upstream', self.upstream), web.get('/memory', self.memory),
+            web.post('/cache/flush', self.flush), web.post('/reload', self.reload),
+            web.post('/lists/reload', self.reload_lists), web.post('/profiler', self.profiler),
+        ])
+        self.app = app
+
+    @property
+    def address(self):
+        return self.runner.addresses[0][:2]
+
+    async def start(self):
+        self.runner = web.AppRunner(self.app, access_log=None)
+        await self.runner.setup()
+        await web.TCPSite(self.runner, *self.local_addr).start()
+        logger.warning(f'admin api started on {self.address}')
+
+    async def stop(self):
+        if self.runner is not None:
+            await self.runner.cleanup()
+            self.runner = None
+
+    def _cache_state(self):
+        cache = self.dns_server.cache
+        lookups = cache.hits + cache.misses
+        state = {'size': len(cache), 'capacity': cache.size, 'hits': cache.hits, 'misses': cache.misses,
+                 'stale_hits': cache.stale_hits, 'hit_ratio': round(cache.hits / lookups, 4) if lookups else 0.}
+        shared = self.dns_server.shared_cache
+        if shared is not None:
+            state['shared_cache'] = {'slots': shared.slots, 'hits': shared.hits, 'misses': shared.misses}
+        return state
+
+    def _upstream_state(self):
+        return {**self.dns_server.upstream.state(), **self.dns_server.upstream_health.state()}
+
+    async def status(self, _):
+        server = self.dns_server
+        limiter = server.rate_limiter
+        return web.json_response({
+            'pid': os.getpid(), 'worker': server.worker, 'uptime': round(time.time() - server.started_at, 3),
+            'in_flight': server.chain.in_flight, 'plugins': server.chain.names,
+            'background_tasks': len(server._background_tasks), 'cache': self._cache_state(),
+            'upstream': self._upstream_state(), 'rate_limit': None if limiter is None else limiter.counters,
+            'profiling': server.profiler.active, 'memory': server.memory.state()['total'],
+        })
+
+    async def plugins(self, _):
+        return web.json_response(self.dns_server.chain.stats())
+
+    async def cache(self, request):
+        try:
+            count = int(request.query.get('top', 10))
+        except ValueError:
+            raise web.HTTPBadRequest(text='top should be an integer')
+        cache = self.dns_server.cache
+        now = cache.clock()
+        top = [{'key': _cache_key_text(k_), 'hits': v_.hits, 'ttl': v_.ttl, 'remaining': round(v_.remaining(now), 3)}
+               for k_, v_ in cache.top(count)]
+        return web.json_response({**self._cache_state(), 'top': top})
+
+    async def redis(self, _):
+        state = {}
+        for p_ in self.dns_server.plugins:
+            client = getattr(p_, 'redis', None)
+            if client is None:
+                continue
+            name = self.dns_server.chain.plugin_name(p_)
+            state[name] = client.state() if isinstance(client, DNS.RedisTopology.RoutedRedis) else \
+                DNS.RedisTopology.pool_state(client)
+        return web.json_response(state)
+
+    async def upstream(self, _):
+        return web.json_response(self._upstream_state())
+
+    async def memory(self, _):
+        return web.json_response(self.dns_server.memory.state())
+
+    async def flush(self, request):
+        name = request.query.get('name')
+        try:
+            name = None if name is None else dns.name.from_text(name)
+        except dns.exception.DNSException as e:
+            raise web.HTTPBadRequest(text=f'invalid name [{e}]')
+        return web.json_response(self.dns_server.flush(name))
+
+    async def reload(self, _):
+        return web.json_response({'reloaded': await self.dns_server.reload(), 'plugins': self.dns_server.chain.names})
+
+    async def reload_lists(self, _):
+        result = {}
+        for p_ in self.dns_server.plugins:
+            if hasattr(p_, 'reload_lists'):
+                result[self.dns_server.chain.plugin_name(p_)] = await p_.reload_lists()
+        logger.warning(f'lists reloaded: {result}')
+        return web.json_response(result)
+
+    async def profiler(self, _):
+        self.dns_server.profiler.toggle()
+        return web.json_response({'profiling': self.dns_server.profiler.active})
@@ -0,0 +1,79 @@
+import asyncio
+from typing import Awaitable, Callable, List
+
+
+class MicroBatcher:
+    """
+    collect items submitted by concurrent tasks and process them together with one handler call
+    notes:
+        - a batch is handled when window seconds passed since its first item or when it has max_size items, whichever
+          comes first. so a lone item waits at most window seconds
+        - handler gets the list of items and returns their results in the same order. if it raises, every item of the
+          batch gets the exception
+        - batches and items counters can be used to see how well items are coalesced
+    """
+
+    def __init__(self, handler: Callable[[list], Awaitable[list]], window=0.001, max_size=64):
+        self.handler = handler
+        self.window = window
+        self.max_size = max_size
+        self._items = []
+        self._futures: List[asyncio.Future] = []
+        self._timer = None
+        self._tasks = set()
+        self.batches = 0
+        self.items = 0
+
+    async def submit(self, item):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._items.append(item)
+        self._futures.append(future)
+        if len(self._items) >= self.max_size:
+            self.flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window, self.flush)
+        return await future
+
+    def flush(self):
+        """
+        hand collected items to handler now
+        """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        items, futures = self._items, self._futures
+        self._items, self._futures = [], []
+        if not items:
+            return
+        self.batches += 1
+        self.items += len(items)
+        task = asyncio.get_running_loop().create_task(self._handle(items, futures))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _handle(self, items, futures):
+        try:
+            results = await self.handler(items)
+        except asyncio.CancelledError:
+            for future in futures:
+                future.cancel()
+            raise
+        except Exception as e:
+            for future in futures:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in zip(futures, results):
+            if not future.done():
+                future.set_result(result)
+
+    def close(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        for future in self._futures:
+            future.cancel()
+        self._items, self._futures = [], []
+        for task in self._tasks:
+            task.cancel()
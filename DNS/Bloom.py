@@ -0,0 +1,46 @@
+import hashlib
+import math
+
+
+class BloomFilter:
+    """
+    probabilistic set membership. "not in" answers are definite, "in" answers may be false positive with
+    probability of about error_rate when filter holds capacity items
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        capacity = max(1, capacity)
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hashes = max(1, int(round(self.size / capacity * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    @property
+    def nbytes(self):
+        return len(self.bits)
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        size = self.size
+        return [(h1 + i_ * h2) % size for i_ in range(self.hashes)]
+
+    def add(self, item: str):
+        bits = self.bits
+        for p_ in self._positions(item):
+            bits[p_ >> 3] |= 1 << (p_ & 7)
+        self.count += 1
+
+    def update(self, items):
+        for i_ in items:
+            self.add(i_)
+
+    def __contains__(self, item: str):
+        bits = self.bits
+        for p_ in self._positions(item):
+            if not bits[p_ >> 3] & (1 << (p_ & 7)):
+                return False
+        return True
@@ -0,0 +1,306 @@
+import heapq
+import mmap
+import os
+import struct
+import time
+from collections import Counter, OrderedDict
+
+import dns.flags
+import dns.message
+import dns.name
+import dns.rcode
+import dns.rdatatype
+
+import DNS.EDNS
+from DNS.Logging import logger
+
+
+_SNAPSHOT_MAGIC = b'DNSPYAC1'
+_SNAPSHOT_HEADER = struct.Struct('!8sI')
+# expiry (unix time), original ttl, hits, wire length
+_SNAPSHOT_RECORD = struct.Struct('!dIIH')
+
+
+# approximate memory of a cached answer: parsed message and entry, plus each of its rdatas (measured with tracemalloc)
+ENTRY_BYTES = 2550
+RDATA_BYTES = 70
+
+
+def entry_size(response: dns.message.Message):
+    return ENTRY_BYTES + RDATA_BYTES * sum(len(x) for x in (*response.answer, *response.authority,
+                                                              *response.additional))
+
+
+class CacheEntry:
+    __slots__ = ('response', 'ttl', 'stored_at', 'expires_at', 'hits', 'prefetching', 'nbytes')
+
+    def __init__(self, response: dns.message.Message, ttl, now):
+        self.response = response
+        self.ttl = ttl
+        self.stored_at = now
+        self.expires_at = now + ttl
+        self.hits = 0
+        self.prefetching = False
+        self.nbytes = entry_size(response)
+
+    def remaining(self, now):
+        return self.expires_at - now
+
+
+class AnswerCache:
+    """
+    LRU cache of upstream responses keyed by question
+    notes:
+        - only single question queries are cached
+        - ttl of an entry is minimum ttl of answer rrsets. negative responses are cached using SOA of authority
+          section, otherwise they are not cached
+        - expired entries are kept for stale_window seconds to be served if upstream fails (RFC 8767)
+        - popular entries (hits >= prefetch_hits) are reported for prefetch when remaining ttl drops below
+          prefetch_ratio of their original ttl
+        - answers to ECS queries are partitioned by the subnet of scope prefix returned by upstream. scopes seen for a
+          question are counted, so a lookup only probes subnets which may have an entry
+        - approximate memory of entries is kept in nbytes. shrink() evicts least recently used entries (used by
+          DNS.Memory.MemoryAccountant)
+    """
+
+    def __init__(self, size=10000, prefetch_hits=3, prefetch_ratio=0.1, stale_window=3600, stale_ttl=30,
+                 clock=time.monotonic):
+        self.size = size
+        self.prefetch_hits = prefetch_hits
+        self.prefetch_ratio = prefetch_ratio
+        self.stale_window = stale_window
+        self.stale_ttl = stale_ttl
+        self.clock = clock
+        self._entries = OrderedDict()
+        # question -> Counter of (family, scope prefix) of its scoped entries
+        self._scopes = {}
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def key(self, query: dns.message.Message, response: dns.message.Message = None):
+        """
+        :param response: upstream response to store. if None, key of an existing entry matching ECS of query is
+            looked up
+        :return: (name, rdtype, rdclass) or (name, rdtype, rdclass, family, network, scope) for ECS scoped answers
+        """
+        if self.size <= 0 or len(query.question) != 1:
+            return None
+        q_ = query.question[0]
+        key = q_.name, q_.rdtype, q_.rdclass
+        if response is not None:
+            subnet = DNS.EDNS.scoped_subnet(query, response)
+            return key if subnet is None else key + subnet
+        scopes = self._scopes.get(key)
+        if scopes:
+            for subnet in DNS.EDNS.candidate_subnets(query, scopes):
+                if key + subnet in self._entries:
+                    return key + subnet
+        return key
+
+    def _added(self, key):
+        if len(key) > 3:
+            self._scopes.setdefault(key[:3], Counter())[(key[3], key[5])] += 1
+
+    def _removed(self, key):
+        if len(key) > 3:
+            scopes = self._scopes[key[:3]]
+            scopes[(key[3], key[5])] -= 1
+            if scopes[(key[3], key[5])] <= 0:
+                del scopes[(key[3], key[5])]
+                if not scopes:
+                    del self._scopes[key[:3]]
+
+    def _store(self, key, entry):
+        previous = self._entries.get(key)
+        if previous is None:
+            self._added(key)
+        else:
+            self.nbytes -= previous.nbytes
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self.nbytes += entry.nbytes
+        while len(self._entries) > self.size:
+            self._evict()
+
+    def _evict(self):
+        key, entry = self._entries.popitem(last=False)
+        self._removed(key)
+        self.nbytes -= entry.nbytes
+        return entry.nbytes
+
+    def shrink(self, nbytes):
+        """
+        evict least recently used entries until nbytes are freed (or cache is empty)
+        :return: freed bytes
+        """
+        freed = 0
+        while freed < nbytes and self._entries:
+            freed += self._evict()
+        return freed
+
+    @staticmethod
+    def response_ttl(response: dns.message.Message):
+        if response.rcode() not in (dns.rcode.NOERROR, dns.rcode.NXDOMAIN):
+            return 0
+        if response.answer:
+            return min(x.ttl for x in response.answer)
+        for rrset in response.authority:
+            if rrset.rdtype == dns.rdatatype.SOA:
+                return min(rrset.ttl, rrset[0].minimum)
+        return 0
+
+    def peek(self, key):
+        """
+        :return: entry for the key (fresh or expired) without touching lru order and statistics
+        """
+        return self._entries.get(key)
+
+    def get(self, key):
+        """
+        :return: fresh entry for the key or None
+        """
+        if key is None:
+            return None
+        entry = self._entries.get(key)
+        if entry is None or entry.remaining(self.clock()) <= 0:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        entry.hits += 1
+        self.hits += 1
+        return entry
+
+    def get_stale(self, key):
+        """
+        :return: expired entry for the key which is still in stale window or None
+        """
+        if key is None:
+            return None
+        entry = self._entries.get(key)
+        if entry is None or -entry.remaining(self.clock()) > self.stale_window:
+            return None
+        self.stale_hits += 1
+        return entry
+
+    def should_prefetch(self, entry: CacheEntry):
+        if entry.prefetching or entry.hits < self.prefetch_hits:
+            return False
+        return entry.remaining(self.clock()) < entry.ttl * self.prefetch_ratio
+
+    def put(self, key, response: dns.message.Message, remaining=None):
+        """
+        :param remaining: remaining ttl if response has already spent some time in another cache
+        """
+        if key is None:
+            return None
+        ttl = self.response_ttl(response)
+        if ttl <= 0:
+            return None
+        now = self.clock()
+        entry = CacheEntry(response, ttl, now if remaining is None else now + remaining - ttl)
+        previous = self._entries.get(key)
+        if previous is not None:
+            # refreshed answers keep their popularity, so they are prefetched again without earning hits anew
+            entry.hits = previous.hits
+        self._store(key, entry)
+        return entry
+
+    def remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._removed(key)
+            self.nbytes -= entry.nbytes
+        return entry
+
+    def flush(self, name: dns.name.Name = None):
+        """
+        remove entries of name (all types, classes and subnets) or all entries if name is None
+        :return: removed keys
+        """
+        keys = [x for x in self._entries if name is None or x[0] == name]
+        for k_ in keys:
+            self.remove(k_)
+        return keys
+
+    def top(self, count=10):
+        """
+        :return: (key, entry) of most hit entries
+        """
+        return heapq.nlargest(count, self._entries.items(), key=lambda x: x[1].hits)
+
+    def make_response(self, query: dns.message.Message, entry: CacheEntry, stale=False):
+        """
+        build a response for query from cached entry with ttl decreased by the time spent in cache. EDNS options of
+        cached response are kept
+        """
+        elapsed = self.clock() - entry.stored_at
+        resp = dns.message.make_response(query, recursion_available=True)
+        if resp.edns >= 0 and entry.response.edns >= 0:
+            resp.use_edns(resp.edns, resp.ednsflags | (entry.response.ednsflags & int(dns.flags.DO)), resp.payload,
+                          options=entry.response.options)
+        resp.set_rcode(entry.response.rcode())
+        for section, cached in [(resp.answer, entry.response.answer), (resp.authority, entry.response.authority),
+                                (resp.additional, entry.response.additional)]:
+            for rrset in cached:
+                rrset_ = rrset.copy()
+                rrset_.ttl = min(rrset.ttl, self.stale_ttl) if stale else max(0, int(rrset.ttl - elapsed))
+                section.append(rrset_)
+        if stale:
+            logger.info(f'serving stale answer for {query.question[0].to_text()}')
+        return resp
+
+    def dump(self, path):
+        """
+        write cache entries (fresh and stale) into a binary snapshot file. expiry is stored as wall clock time so that
+        remaining ttl can be recomputed when snapshot is loaded by another process
+        """
+        now, wall = self.clock(), time.time()
+        records = []
+        for entry in self._entries.values():
+            wire = entry.response.to_wire()
+            records.append(_SNAPSHOT_RECORD.pack(wall + entry.remaining(now), entry.ttl, entry.hits, len(wire)))
+            records.append(wire)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f_:
+            f_.write(_SNAPSHOT_HEADER.pack(_SNAPSHOT_MAGIC, len(self._entries)))
+            f_.writelines(records)
+        os.replace(tmp_path, path)
+        logger.info(f'wrote {len(self._entries)} cache entries to {path}')
+
+    def load(self, path):
+        """
+        load entries from a snapshot file written by dump. entries which are beyond stale window are dropped
+        :return: number of loaded entries
+        """
+        now, wall = self.clock(), time.time()
+        loaded = 0
+        with open(path, 'rb') as f_:
+            if os.fstat(f_.fileno()).st_size < _SNAPSHOT_HEADER.size:
+                logger.warning(f'cache snapshot {path} is empty')
+                return 0
+            with mmap.mmap(f_.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                magic, count = _SNAPSHOT_HEADER.unpack_from(data, 0)
+                if magic != _SNAPSHOT_MAGIC:
+                    logger.warning(f'{path} is not a cache snapshot')
+                    return 0
+                offset = _SNAPSHOT_HEADER.size
+                for _ in range(count):
+                    expires, ttl, hits, length = _SNAPSHOT_RECORD.unpack_from(data, offset)
+                    offset += _SNAPSHOT_RECORD.size
+                    wire = data[offset:offset + length]
+                    offset += length
+                    remaining = expires - wall
+                    if remaining + self.stale_window <= 0:
+                        continue
+                    response = dns.message.from_wire(wire)
+                    entry = CacheEntry(response, ttl, now + remaining - ttl)
+                    entry.hits = hits
+                    self._store(self.key(response, response), entry)
+                    loaded += 1
+        logger.info(f'loaded {loaded} cache entries from {path}')
+        return loaded
@@ -1,19 +1,18 @@
-import atexit
+import ast
 import importlib
-import inspect
 import json
 import os.path
-import pickle
 import pkgutil
 from ipaddress import IPv4Address
 from os import environ
-from typing import Optional, List
+from typing import Dict, Optional, List
 
+import dotenv
 from pydantic import BaseSettings, conint, create_model, Field
 
+import DNS.SharedCache
 from DNS.Logging import logger
 from DNS.Logging import reload as relog
-from Plugins.Base import BasePlugin
 
 port_type = conint(ge=0, le=65353)
 
@@ -22,17 +21,138 @@ class _BaseSettingType(BaseSettings):
     local_ip: IPv4Address = Field(title='local ip to bind', default='127.0.0.1')
     local_port: port_type = Field(title='local port to bind', default='5053')
     workers: int = Field(title='number of workers', default=1)
+    processes: int = Field(title='number of server processes sharing local port (SO_REUSEPORT)', default=1, ge=1)
+    doh_port: Optional[port_type] = Field(title='local port of DNS over HTTPS (http/2) listener. None disables it',
+                                          default=None)
+    doh_path: str = Field(title='url path of DNS over HTTPS queries', default='/dns-query')
+    doh_cert_file: Optional[str] = Field(title='certificate chain of DNS over HTTPS listener. cleartext h2c if None',
+                                         default=None)
+    doh_key_file: Optional[str] = Field(title='private key of DNS over HTTPS certificate', default=None)
     upstream_ip: IPv4Address = Field(title='upstream DNS server ip', default='8.8.8.8')
     upstream_port: port_type = Field(title='upstream DNS server port', default=53)
+    upstream_timeout: float = Field(title='seconds to wait for upstream response', default=2.)
+    upstream_transport: str = Field(title='protocol to query upstream with [udp|tls]. tls is DNS over TLS (use port 853)',
+                                    default='udp', regex='^(udp|tls)$')
+    upstream_tls_hostname: Optional[str] = Field(title='name to verify upstream certificate against. upstream ip if '
+                                                       'None', default=None)
+    upstream_tls_ca_file: Optional[str] = Field(title='ca bundle to verify upstream certificate. system store if None',
+                                                default=None)
+    upstream_tls_pool_size: int = Field(title='number of persistent tls connections to upstream', default=2, ge=1)
+    ecs_mode: str = Field(title='EDNS client subnet sent upstream [strip|forward|synthesize]. synthesize makes one from '
+                                'client address if client sent none', default='forward',
+                          regex='^(strip|forward|synthesize)$')
+    ecs_ipv4_prefix: int = Field(title='max source prefix of ipv4 client subnet sent upstream', default=24, ge=0, le=32)
+    ecs_ipv6_prefix: int = Field(title='max source prefix of ipv6 client subnet sent upstream', default=56, ge=0, le=128)
     plugins: List[str] = Field(title='plugins to activate', default=[])
+    plugin_batch_window: float = Field(title='seconds to collect concurrent queries for plugins with batch hooks. 0 '
+                                             'disables batching', default=0, ge=0)
+    plugin_batch_size: int = Field(title='max queries handed to a batch hook at once', default=64, ge=1)
+    plugin_budget: float = Field(title='seconds a plugin hook may take for a query. 0 disables budget. can be set per '
+                                       'plugin with hook_budget', default=0, ge=0)
+    plugin_fail: str = Field(title='what to do when a plugin hook fails or exceeds its budget [open|closed]. open skips '
+                                   'the plugin, closed answers SERVFAIL', default='open', regex='^(open|closed)$')
+    plugin_breaker_threshold: int = Field(title='consecutive failures of a plugin which trip its circuit breaker. 0 '
+                                                'disables breaker', default=5, ge=0)
+    plugin_breaker_cooldown: float = Field(title='seconds a tripped plugin is skipped before it is tried again',
+                                           default=10., gt=0)
+    cache_size: int = Field(title='max number of cached upstream answers. 0 disables cache', default=10000, ge=0)
+    cache_prefetch_hits: int = Field(title='hits needed for a cached answer to be refreshed before expiry', default=3)
+    cache_prefetch_ratio: float = Field(title='refresh popular answers when this fraction of ttl remains [0-1]',
+                                        default=0.1, ge=0, le=1)
+    cache_stale_window: int = Field(title='seconds after expiry to serve stale answers if upstream fails',
+                                    default=3600, ge=0)
+    cache_stale_ttl: int = Field(title='ttl of stale answers', default=30, ge=0)
+    cache_snapshot_path: Optional[str] = Field(
+        title='file to save answer cache into periodically and on shutdown, and to load it from on startup',
+        default=None
+    )
+    shared_cache_slots: int = Field(
+        title='number of slots of answer cache shared between server processes. 0 disables it', default=65536, ge=0
+    )
+    shared_cache_slot_size: int = Field(title='bytes per shared cache slot. larger answers are not shared',
+                                        default=1024, ge=256, le=DNS.SharedCache.MAX_SLOT_SIZE)
+    cache_snapshot_interval: int = Field(title='seconds between answer cache snapshots', default=300, gt=0)
+    rate_limit: float = Field(title='queries per second allowed per client network. 0 disables rate limiting',
+                              default=0, ge=0)
+    rate_limit_burst: Optional[int] = Field(title='queries a client network can send at once. defaults to rate_limit',
+                                            default=None, ge=1)
+    rate_limit_action: str = Field(title='answer to over limit queries [drop|slip|refuse]. slip answers every '
+                                         'rate_limit_slip-th one with TC=1 and drops others', default='slip',
+                                   regex='^(drop|slip|refuse)$')
+    rate_limit_slip: int = Field(title='answer every n-th over limit query with TC=1 (slip action)', default=2, ge=0)
+    rate_limit_ipv4_prefix: int = Field(title='prefix length of ipv4 client networks', default=24, ge=1, le=32)
+    rate_limit_ipv6_prefix: int = Field(title='prefix length of ipv6 client networks', default=56, ge=1, le=128)
+    rate_limit_table_size: int = Field(title='max number of client networks tracked', default=100000, ge=1)
+    memory_budget: int = Field(title='approximate bytes of memory caches, tables and indexes of a server process may '
+                                     'use. caches are shrunk when usage is over it. 0 only accounts usage',
+                               default=0, ge=0)
+    memory_check_interval: float = Field(title='seconds between memory usage checks', default=1., gt=0)
+    trace: bool = Field(title='record spans of pipeline stages and plugin hooks for each query', default=False)
+    trace_sample_rate: float = Field(title='fraction of queries to trace [0-1]', default=1., ge=0, le=1)
+    trace_slow_threshold: float = Field(title='log traced queries slower than this (seconds) with spans breakdown',
+                                        default=0.1)
+    profile_dir: str = Field(title='directory to write profiling stats (profiling is toggled by SIGUSR1)',
+                             default='.')
+    admin_ip: IPv4Address = Field(title='local ip of admin http api. keep it on a loopback address',
+                                  default='127.0.0.1')
+    admin_port: Optional[port_type] = Field(title='port of admin http api. None disables it. server process n (with '
+                                                  'processes > 1) listens on admin_port + n', default=None)
 
     class Config:
         env_prefix = 'DNSPY__'
+        allow_mutation = False
+
+
+def _hook_config():
+    """
+    guard settings added to config of every plugin class. None falls back to plugin_* settings
+    """
+    return {
+        'hook_budget': (Optional[float], Field(title='overrides plugin_budget for this plugin', default=None, ge=0)),
+        'hook_fail': (Optional[str], Field(title='overrides plugin_fail for this plugin [open|closed]', default=None,
+                                           regex='^(open|closed)$')),
+        'hook_breaker_threshold': (
+            Optional[int], Field(title='overrides plugin_breaker_threshold for this plugin', default=None, ge=0)
+        ),
+        'hook_breaker_cooldown': (
+            Optional[float], Field(title='overrides plugin_breaker_cooldown for this plugin', default=None, gt=0)
+        ),
+    }
+
+
+class PluginConfig:
+    """
+    immutable module level and class level config data of a plugin
+    """
+
+    def __init__(self, data: dict):
+        for k_, v_ in data.items():
+            object.__setattr__(self, k_, v_)
+
+    def __setattr__(self, key, value):
+        raise TypeError('plugin config is immutable. use replace() to get a modified copy')
+
+    def __delattr__(self, item):
+        raise TypeError('plugin config is immutable')
+
+    def __eq__(self, other):
+        return isinstance(other, PluginConfig) and self.__dict__ == other.__dict__
+
+    def __repr__(self):
+        return f'PluginConfig({self.__dict__})'
+
+    def dict(self):
+        return dict(self.__dict__)
+
+    def replace(self, **kwargs):
+        return PluginConfig({**self.__dict__, **kwargs})
 
 
 class Configuration:
-    RUNTIME_FILE = './.config.runtime'
     PLUGIN_PACKAGE = 'Plugins'
+    # env file given on command line and variables which were set from it. re-read on reload
+    env_file: Optional[str] = None
+    _env_file_keys = set()
 
     @staticmethod
     def global_config(config):
@@ -40,38 +160,105 @@ class Configuration:
         relog()
 
     @classmethod
-    def get_all_plugins(cls):
-        def _plugin_check(obj):
-            if inspect.isclass(obj):
-                if issubclass(obj, BasePlugin):
-                    return True
-            return False
+    def discover_plugins(cls):
+        """
+        find plugin classes and their docstrings by parsing source of plugin modules. modules are not imported
+        """
+
+        def _base_name(node):
+            if isinstance(node, ast.Attribute):
+                return node.attr
+            if isinstance(node, ast.Name):
+                return node.id
+            return None
 
         def _plugin_name_check(name):
             return name != 'BasePlugin' and not name.startswith('_')
 
-        plugin_modules = [name for _, name, _ in pkgutil.iter_modules([cls.PLUGIN_PACKAGE])]
-        plugin_modules = [(module, importlib.import_module(f'{cls.PLUGIN_PACKAGE}.{module}')) for module in
-                          plugin_modules]
-        plugin_classes = {x[0]: [y for y in inspect.getmembers(x[1], _plugin_check) if _plugin_name_check(y[0])]
-                          for x in plugin_modules}
-        plugin_classes = {f'{k}.{v_[0]}': v_[1] for k, v in plugin_classes.items() for v_ in v}
-        return plugin_classes
+        classes = []
+        for module_info in pkgutil.iter_modules([cls.PLUGIN_PACKAGE]):
+            path = os.path.join(module_info.module_finder.path, module_info.name)
+            path = os.path.join(path, '__init__.py') if module_info.ispkg else path + '.py'
+            with open(path) as f_:
+                tree = ast.parse(f_.read(), path)
+            for node in tree.body:
+                if isinstance(node, ast.ClassDef):
+                    bases = {_base_name(x) for x in node.bases}
+                    classes.append((module_info.name, node.name, bases, ast.get_docstring(node)))
+
+        plugin_bases = {'BasePlugin'}
+        while True:
+            found = {x[1] for x in classes if x[2] & plugin_bases} - plugin_bases
+            if not found:
+                break
+            plugin_bases |= found
+        return {f'{x[0]}.{x[1]}': x[3] for x in classes if x[1] in plugin_bases and _plugin_name_check(x[1])}
 
     @classmethod
-    def _get_plugin_conf(cls, plugin: str):
+    def get_plugin_class(cls, plugin: str):
         module, plug = plugin.split('.')
         plugin_module = importlib.import_module(f'{cls.PLUGIN_PACKAGE}.{module}')
-        plugin_class = getattr(plugin_module, plug)
+        return getattr(plugin_module, plug)
+
+    @classmethod
+    def _get_plugin_conf(cls, plugin: str):
+        module = plugin.split('.')[0]
+        plugin_class = cls.get_plugin_class(plugin)
+        plugin_module = importlib.import_module(plugin_class.__module__)
         conf_module = {f'Plugin__{module}__' + x: y for x, y in getattr(plugin_module, 'CONFIG', {}).items()}
-        conf_plugin = {f'Plugin__{plugin}__' + x: y for x, y in getattr(plugin_class, 'CONFIG', {}).items()}
+        conf_plugin = {f'Plugin__{plugin}__' + x: y for x, y in {**_hook_config(),
+                                                                  **getattr(plugin_class, 'CONFIG', {})}.items()}
         conf = {**conf_module, **conf_plugin}
 
         return conf
 
+    @classmethod
+    def _settings_model(cls, plugins):
+        plugins_conf = {}
+        for i_ in plugins:
+            conf = cls._get_plugin_conf(i_)
+            plugins_conf.update(conf)
+        return create_model('settings_model', __base__=_BaseSettingType, **plugins_conf)
+
+    @staticmethod
+    def build_plugin_config(settings, plugin: str):
+        """
+        extract module level and class level config data of plugin from settings
+        """
+        module_pref = 'Plugin__' + plugin.split('.')[0] + '__'
+        class_pref = 'Plugin__' + plugin + '__'
+        conf_module = {x[len(module_pref):]: y for x, y in settings if x.startswith(module_pref)}
+        conf_class = {x[len(class_pref):]: y for x, y in settings if x.startswith(class_pref)}
+        return PluginConfig({**conf_module, **conf_class})
+
+    @classmethod
+    def load_env_file(cls, path):
+        """
+        set environment variables from env file. variables of process environment take precedence, except those which
+        were set by a previous call (so that changed values are picked up on reload)
+        """
+        values = dotenv.dotenv_values(path)
+        for k_ in cls._env_file_keys - set(values.keys()):
+            environ.pop(k_, None)
+        keys = set()
+        for k_, v_ in values.items():
+            if v_ is None or (k_ in environ and k_ not in cls._env_file_keys):
+                continue
+            environ[k_] = v_
+            keys.add(k_)
+        cls.env_file = path
+        cls._env_file_keys = keys
+
+    @classmethod
+    def activate(cls, data):
+        global Settings, PluginConfigs
+        PluginConfigs = {x: cls.build_plugin_config(data, x) for x in data.plugins}
+        Settings = data
+        cls.global_config(data)
+
     @classmethod
     def load(cls, active_all_plugins=False):
-        plugins_all = cls.get_all_plugins()
+        plugins_all = cls.discover_plugins()
         plugins_active_ = plugins_all if active_all_plugins else json.loads(environ.get('DNSPY__PLUGINS', '[]'))
         plugins_active = []
         for i_ in plugins_active_:
@@ -80,42 +267,34 @@ class Configuration:
                 continue
             plugins_active.append(i_)
 
-        plugins_conf = {}
-        for i_ in plugins_active:
-            conf = cls._get_plugin_conf(i_)
-            plugins_conf.update(conf)
-
-        def _clean_exit():
-            if os.path.isfile(cls.RUNTIME_FILE):
-                os.remove(cls.RUNTIME_FILE)
-
-        settings_model = create_model('settings_model', __base__=_BaseSettingType, **plugins_conf)
-        data = settings_model(_env_file=None)
-        data.plugins = plugins_active
-        with open(cls.RUNTIME_FILE, 'wb') as f_:
-            pickle.dump(data.dict(), f_)
-        atexit.register(_clean_exit)
-        global _settings
-        _settings = data
-        cls.global_config(data)
+        settings_model = cls._settings_model(plugins_active)
+        data = settings_model(_env_file=None, plugins=plugins_active)
+        cls.activate(data)
         return cls
 
+    @classmethod
+    def reload(cls):
+        """
+        re-read env file (if any) and environment and activate new configuration
+        """
+        if cls.env_file:
+            cls.load_env_file(cls.env_file)
+        return cls.load()
+
+    @staticmethod
+    def plugin_config(plugin: str):
+        conf = PluginConfigs.get(plugin)
+        if conf is None:
+            conf = PluginConfigs[plugin] = Configuration.build_plugin_config(Settings, plugin)
+        return conf
+
 
 def __getattr__(name):
     if name == 'Settings':
-        global _settings
-        if _settings is not None:
-            logger.trace('reading configuration from cache')
-            return _settings
-        if os.path.isfile(Configuration.RUNTIME_FILE):
-            logger.trace('reading configuration from runtime file')
-            with open(Configuration.RUNTIME_FILE, 'rb') as f_:
-                _settings = pickle.load(f_)
-                return _settings
-        else:
-            logger.warning('configuration is not initiated yet')
-            return None
+        logger.warning('configuration is not initiated yet')
+        return None
+    raise AttributeError(f'module {__name__} has no attribute {name}')
 
 
-_settings: Optional[_BaseSettingType] = None
 Settings: Optional[_BaseSettingType]
+PluginConfigs: Dict[str, PluginConfig] = {}
@@ -0,0 +1,89 @@
+from typing import List, Optional
+
+import dns.message
+import dns.rdatatype
+import dns.rrset
+
+
+def suffix_keys(qname: str) -> List[str]:
+    """
+    names to look up for a lowercased domain name from the most specific one, in DNS.Utilities.iterative_candidates
+    format (e.g.: a.example.com -> a.example.com, *.example.com, *.com, *..)
+    """
+    if qname == '.':
+        return ['.']
+    labels = qname.split('.')
+    return [qname] + ['*.' + '.'.join(labels[i_:]) for i_ in range(1, len(labels))] + ['*..']
+
+
+class QueryContext:
+    """
+    state of a query passed to plugin hooks (on_query, on_response)
+    notes:
+        - qname (lowercased, without trailing dot), qtype and qclass of first question are decoded once when query
+          is parsed. labels and suffix keys (names to look wildcard lists up with) are computed on first use
+        - response is built on first access, so plugins which only read the query don't pay for it
+        - answer() answers the first question locally: the question is removed from query (so it is not resolved
+          upstream) and rrset is added to response
+    """
+    __slots__ = ('query', 'address', 'client', 'qname', 'qtype', 'qclass', '_question', '_labels', '_suffixes',
+                 '_response')
+
+    def __init__(self, query: dns.message.Message, address):
+        self.query = query
+        self.address = address
+        self.client = address[0] if address else None
+        # question of client is kept for the response even if plugins remove questions from query
+        self._question = list(query.question)
+        if query.question:
+            q_ = query.question[0]
+            self.qname = q_.name.to_text(True).lower()
+            self.qtype = q_.rdtype
+            self.qclass = q_.rdclass
+        else:
+            self.qname, self.qtype, self.qclass = '', None, None
+        self._labels = None
+        self._suffixes = None
+        self._response: Optional[dns.message.Message] = None
+
+    @property
+    def labels(self):
+        if self._labels is None:
+            self._labels = tuple(self.qname.split('.')) if self.qname != '.' else ()
+        return self._labels
+
+    @property
+    def suffixes(self) -> List[str]:
+        if self._suffixes is None:
+            self._suffixes = suffix_keys(self.qname)
+        return self._suffixes
+
+    @property
+    def response(self) -> dns.message.Message:
+        if self._response is None:
+            self._response = dns.message.make_response(self.query, recursion_available=True)
+            self._response.question = list(self._question)
+        return self._response
+
+    @response.setter
+    def response(self, value: dns.message.Message):
+        self._response = value
+
+    @property
+    def pending(self):
+        """
+        whether first question of client is still to be resolved
+        """
+        return bool(self.query.question) and self.query.question[0] is self._question[0]
+
+    def answer(self, rrset: dns.rrset.RRset):
+        """
+        answer first question with rrset (name of rrset is set to question name)
+        """
+        q_ = self._question[0]
+        rrset.name = q_.name
+        self.query.question.remove(q_)
+        self.response.answer.append(rrset)
+
+    def __repr__(self):
+        return f'<QueryContext {self.client} {self.qname} {dns.rdatatype.to_text(self.qtype) if self.qtype else ""}>'
@@ -1,11 +1,28 @@
 import asyncio
-import importlib
+import os.path
+import signal
+import struct
+import time
 from abc import abstractmethod
 
-import dns.asyncquery
+import dns.exception
 import dns.message
+import dns.name
+import dns.rcode
+import dns.rdatatype
 
+import DNS.Admin
+import DNS.Batch
+import DNS.Cache
 import DNS.Config
+import DNS.Context
+import DNS.DoH
+import DNS.EDNS
+import DNS.Guard
+import DNS.Memory
+import DNS.RateLimit
+import DNS.Tracing
+import DNS.Upstream
 from DNS.Logging import logger
 
 
@@ -14,6 +31,26 @@ class UDPAsyncServer(asyncio.protocols.DatagramProtocol):
 
     def __init__(self, *args, **kwargs):
         self.local_addr = (DNS.Config.Settings.local_ip.__str__(), DNS.Config.Settings.local_port)
+        self.rate_limiter = self._init_rate_limiter()
+
+    @staticmethod
+    def _rate_limit_settings():
+        return {k_: v_ for k_, v_ in DNS.Config.Settings if k_.startswith('rate_limit')}
+
+    @staticmethod
+    def _init_rate_limiter():
+        settings = DNS.Config.Settings
+        if not settings.rate_limit:
+            return None
+        return DNS.RateLimit.RateLimiter(
+            rate=settings.rate_limit,
+            burst=settings.rate_limit_burst,
+            table_size=settings.rate_limit_table_size,
+            ipv4_prefix=settings.rate_limit_ipv4_prefix,
+            ipv6_prefix=settings.rate_limit_ipv6_prefix,
+            action=settings.rate_limit_action,
+            slip=settings.rate_limit_slip
+        )
 
     def factory(self):
         return self
@@ -23,6 +60,15 @@ class UDPAsyncServer(asyncio.protocols.DatagramProtocol):
 
     def datagram_received(self, data, addr):
         logger.debug(f'received an udp data from {addr}:{data}')
+        if self.rate_limiter is not None:
+            decision = self.rate_limiter.check(addr[0])
+            if decision != DNS.RateLimit.ALLOW:
+                # answered from raw bytes, before parsing and plugins
+                resp = None if decision == DNS.RateLimit.DROP else \
+                    DNS.RateLimit.error_response(data, truncated=decision == DNS.RateLimit.SLIP)
+                if resp is not None:
+                    self.transport.sendto(resp, addr)
+                return
         loop = asyncio.get_event_loop()
         loop.create_task(self.handle_inbound_packet(data, addr))
 
@@ -32,7 +78,8 @@ class UDPAsyncServer(asyncio.protocols.DatagramProtocol):
 
     async def start(self):
         loop = asyncio.get_running_loop()
-        self.transport, _ = await loop.create_datagram_endpoint(self.factory, local_addr=self.local_addr)
+        self.transport, _ = await loop.create_datagram_endpoint(self.factory, local_addr=self.local_addr,
+                                                                reuse_port=DNS.Config.Settings.processes > 1)
         logger.warning('server started')
 
     async def stop(self):
@@ -40,18 +87,212 @@ class UDPAsyncServer(asyncio.protocols.DatagramProtocol):
         logger.warning('server stopped')
 
 
+class PluginChain:
+    """
+    active plugins of server in order. a query runs all its hooks on the chain which was active when it arrived, so a
+    reloaded chain can be swapped in while queries drain on the old one
+    """
+    __slots__ = ('names', 'plugins', 'span_names', 'batchers', 'guards', 'timings', 'in_flight', '_drained')
+
+    def __init__(self, names, plugins):
+        self.names = list(names)
+        self.plugins = plugins
+        self.span_names = {
+            id(x): (f'before_resolve {self.plugin_name(x)}', f'after_resolve {self.plugin_name(x)}') for x in plugins
+        }
+        # before_resolve of batch capable plugins goes through a batcher shared by concurrent queries
+        self.batchers = {}
+        settings = DNS.Config.Settings
+        if settings.plugin_batch_window > 0:
+            self.batchers = {
+                id(x): DNS.Batch.MicroBatcher(self._batch_handler(x), settings.plugin_batch_window,
+                                              settings.plugin_batch_size) for x in plugins if x.BATCH
+            }
+        self.guards = {id(x): self._init_guard(x) for x in plugins}
+        # calls, total and max seconds of each hook of plugins (including time waiting for batch)
+        self.timings = {id(x): {'on_query': [0, 0., 0.], 'on_response': [0, 0., 0.]} for x in plugins}
+        self.in_flight = 0
+        self._drained = None
+
+    @staticmethod
+    def plugin_name(plugin):
+        return f'{plugin.__class__.__module__.split(".")[-1]}.{plugin.__class__.__name__}'
+
+    @classmethod
+    def _init_guard(cls, plugin):
+        settings, config = DNS.Config.Settings, plugin.config
+
+        def _setting(name):
+            value = getattr(config, f'hook_{name}', None)
+            return getattr(settings, f'plugin_{name}') if value is None else value
+
+        return DNS.Guard.PluginGuard(cls.plugin_name(plugin), budget=_setting('budget') or None, fail=_setting('fail'),
+                                     breaker_threshold=_setting('breaker_threshold'),
+                                     breaker_cooldown=_setting('breaker_cooldown'))
+
+    def stats(self):
+        """
+        :return: guard counters, breaker state and hook timings of each plugin
+        """
+        return {
+            self.plugin_name(x): {
+                **self.guards[id(x)].counters, 'tripped': self.guards[id(x)].tripped,
+                'hooks': {k_: {'calls': v_[0], 'avg_ms': round(v_[1] / v_[0] * 1e3, 3) if v_[0] else 0.,
+                               'max_ms': round(v_[2] * 1e3, 3)} for k_, v_ in self.timings[id(x)].items()}
+            } for x in self.plugins
+        }
+
+    @classmethod
+    def build(cls, names, previous: 'PluginChain' = None, previous_configs=None):
+        """
+        create plugins of names using loaded configuration. leading plugins of previous chain whose class and config are
+        unchanged are reused (a plugin gets its preceding plugins on init, so reuse stops at the first changed one)
+        """
+        plugins = []
+        reusable = previous is not None
+        for i_, name in enumerate(names):
+            if reusable and i_ < len(previous.names) and previous.names[i_] == name and \
+                    (previous_configs or {}).get(name) == DNS.Config.Configuration.plugin_config(name):
+                plugins.append(previous.plugins[i_])
+                continue
+            reusable = False
+            plugins.append(DNS.Config.Configuration.get_plugin_class(name)(plugins))
+        return cls(names, plugins)
+
+    def enter(self):
+        self.in_flight += 1
+
+    def exit(self):
+        self.in_flight -= 1
+        if self.in_flight == 0 and self._drained is not None:
+            self._drained.set()
+
+    async def drain(self):
+        """
+        wait until queries running on this chain are finished
+        """
+        if self.in_flight:
+            self._drained = asyncio.Event()
+            await self._drained.wait()
+
+    def close(self):
+        for batcher in self.batchers.values():
+            batcher.close()
+
+    @staticmethod
+    def _batch_handler(plugin):
+        async def _handler(contexts):
+            await plugin.on_query_batch(contexts)
+            return [None] * len(contexts)
+
+        return _handler
+
+    def _timed(self, plugin, hook, start):
+        timing = self.timings[id(plugin)][hook]
+        elapsed = time.perf_counter() - start
+        timing[0] += 1
+        timing[1] += elapsed
+        if elapsed > timing[2]:
+            timing[2] = elapsed
+
+    async def on_query(self, plugin, context):
+        batcher = self.batchers.get(id(plugin))
+        start = time.perf_counter()
+        try:
+            await self.guards[id(plugin)].run(plugin.on_query if batcher is None else batcher.submit, context)
+        finally:
+            self._timed(plugin, 'on_query', start)
+
+    async def on_response(self, plugin, context):
+        start = time.perf_counter()
+        try:
+            await self.guards[id(plugin)].run(plugin.on_response, context)
+        finally:
+            self._timed(plugin, 'on_response', start)
+
+
 class UDPDNSServer(UDPAsyncServer):
     def __init__(self, *args, **kwargs):
         super(UDPDNSServer, self).__init__(*args, **kwargs)
 
-        plugins = []
-        for i_ in DNS.Config.Settings.plugins:
-            module_, class_ = i_.split('.')
-            module = f'{DNS.Config.Configuration.PLUGIN_PACKAGE}.{module_}'
-            module = importlib.import_module(module)
-            plugins.append(getattr(module, class_)(plugins))
-        self.plugins = plugins
-        pass
+        self.chain = PluginChain.build(DNS.Config.Settings.plugins)
+        self.tracer = self._init_tracer()
+        self.profiler = DNS.Tracing.Profiler(DNS.Config.Settings.profile_dir)
+        self.cache = self._init_cache()
+        self.upstream = DNS.Upstream.create(DNS.Config.Settings)
+        self.upstream_health = DNS.Upstream.Health()
+        self.shared_cache = kwargs.get('shared_cache', None)
+        # index of forked server process. each process keeps its own cache snapshot
+        self.worker = kwargs.get('worker', None)
+        self._background_tasks = set()
+        self._snapshot_task = None
+        self.doh = self._init_doh()
+        self.admin = self._init_admin()
+        self.memory = self._init_memory()
+        self.started_at = time.time()
+
+    @property
+    def plugins(self):
+        return self.chain.plugins
+
+    @staticmethod
+    def _init_tracer():
+        return DNS.Tracing.Tracer(
+            enabled=DNS.Config.Settings.trace,
+            slow_threshold=DNS.Config.Settings.trace_slow_threshold,
+            sample_rate=DNS.Config.Settings.trace_sample_rate
+        )
+
+    def _init_doh(self):
+        settings = DNS.Config.Settings
+        if settings.doh_port is None:
+            return None
+        return DNS.DoH.DoHServer(self, local_ip=settings.local_ip.__str__(), local_port=settings.doh_port,
+                                 path=settings.doh_path, cert_file=settings.doh_cert_file,
+                                 key_file=settings.doh_key_file)
+
+    def _init_admin(self):
+        settings = DNS.Config.Settings
+        if settings.admin_port is None:
+            return None
+        return DNS.Admin.AdminServer(self, local_ip=settings.admin_ip.__str__(),
+                                     local_port=settings.admin_port + (self.worker or 0))
+
+    def _init_memory(self):
+        settings = DNS.Config.Settings
+        memory = DNS.Memory.MemoryAccountant(settings.memory_budget, settings.memory_check_interval)
+        # cache and rate limiter are looked up on each check, so they can be replaced by reload
+        memory.register('cache', DNS.Memory.Component(lambda: self.cache.nbytes, lambda x: self.cache.shrink(x),
+                                                      DNS.Memory.PRIORITY_CACHE))
+        memory.register('rate_limit', DNS.Memory.Component(
+            lambda: self.rate_limiter.nbytes if self.rate_limiter is not None else 0,
+            lambda x: self.rate_limiter.shrink(x) if self.rate_limiter is not None else 0,
+            DNS.Memory.PRIORITY_RATE_LIMIT
+        ))
+        if self.shared_cache is not None:
+            memory.register('shared_cache', DNS.Memory.Component(lambda: self.shared_cache.nbytes))
+        self._register_plugins_memory(memory)
+        return memory
+
+    def _register_plugins_memory(self, memory: DNS.Memory.MemoryAccountant):
+        memory.unregister('plugin:')
+        for p_ in self.plugins:
+            for k_, v_ in p_.memory_components().items():
+                memory.register(f'plugin:{self.chain.plugin_name(p_)}:{k_}', v_)
+
+    @staticmethod
+    def _upstream_settings():
+        return {k_: v_ for k_, v_ in DNS.Config.Settings if k_.startswith('upstream_')}
+
+    @staticmethod
+    def _cache_settings():
+        settings = DNS.Config.Settings
+        return dict(size=settings.cache_size, prefetch_hits=settings.cache_prefetch_hits,
+                    prefetch_ratio=settings.cache_prefetch_ratio, stale_window=settings.cache_stale_window,
+                    stale_ttl=settings.cache_stale_ttl)
+
+    def _init_cache(self):
+        return DNS.Cache.AnswerCache(**self._cache_settings())
 
     @staticmethod
     async def _run_func_or_coroutine(func, *args, **kwargs):
@@ -59,22 +300,257 @@ class UDPDNSServer(UDPAsyncServer):
             return await func(*args, **kwargs)
         return func(*args, **kwargs)
 
+    async def reload(self):
+        """
+        reload configuration and swap a rebuilt plugin chain in. unchanged plugins and answer cache (if its settings
+        are unchanged) are kept. plugins which are not reused are closed after queries running on old chain drain.
+        if new configuration or plugins fail to load, old configuration is kept
+        :return: whether reload succeeded
+        """
+        settings, configs = DNS.Config.Settings, dict(DNS.Config.PluginConfigs)
+        cache_settings, rate_limit_settings = self._cache_settings(), self._rate_limit_settings()
+        upstream_settings = self._upstream_settings()
+        try:
+            DNS.Config.Configuration.reload()
+            chain = PluginChain.build(DNS.Config.Settings.plugins, self.chain, configs)
+        except Exception as e:
+            logger.exception(f'reload failed, keeping current configuration [{e}]')
+            DNS.Config.Configuration.activate(settings)
+            return False
+        for i_ in ['local_ip', 'local_port', 'processes', 'workers', 'shared_cache_slots', 'shared_cache_slot_size',
+                   'doh_port', 'doh_path', 'doh_cert_file', 'doh_key_file', 'admin_ip', 'admin_port']:
+            if getattr(settings, i_) != getattr(DNS.Config.Settings, i_):
+                logger.warning(f'{i_} change needs restart')
+        old, self.chain = self.chain, chain
+        self.tracer = self._init_tracer()
+        if self._rate_limit_settings() != rate_limit_settings:
+            self.rate_limiter = self._init_rate_limiter()
+        self.profiler.output_dir = DNS.Config.Settings.profile_dir
+        if self._cache_settings() != cache_settings:
+            logger.info('answer cache settings changed. starting with an empty cache')
+            self.cache = self._init_cache()
+        upstream = None
+        if self._upstream_settings() != upstream_settings:
+            upstream, self.upstream = self.upstream, DNS.Upstream.create(DNS.Config.Settings)
+            self.upstream_health = DNS.Upstream.Health()
+        self._register_plugins_memory(self.memory)
+        if (self.memory.budget, self.memory.check_interval) != (DNS.Config.Settings.memory_budget,
+                                                                DNS.Config.Settings.memory_check_interval):
+            self.memory.stop()
+            self.memory.budget = DNS.Config.Settings.memory_budget
+            self.memory.check_interval = DNS.Config.Settings.memory_check_interval
+            self.memory.start()
+        logger.warning(f'configuration reloaded. plugins: {chain.names}')
+        await old.drain()
+        old.close()
+        if upstream is not None:
+            await upstream.close()
+        for p_ in old.plugins:
+            if p_ not in chain.plugins:
+                await self._run_func_or_coroutine(p_.close)
+        return True
+
+    def _reload_signal(self):
+        task = asyncio.get_running_loop().create_task(self.reload())
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    @property
+    def cache_snapshot_path(self):
+        path = DNS.Config.Settings.cache_snapshot_path
+        if path and self.worker is not None:
+            return f'{path}.{self.worker}'
+        return path
+
+    def load_cache_snapshot(self):
+        path = self.cache_snapshot_path
+        if not path or not os.path.isfile(path):
+            return
+        try:
+            self.cache.load(path)
+        except (OSError, ValueError, struct.error, dns.exception.DNSException) as e:
+            logger.error(f'failed to load cache snapshot {path} [{e}]')
+
+    def save_cache_snapshot(self):
+        path = self.cache_snapshot_path
+        if not path:
+            return
+        try:
+            self.cache.dump(path)
+        except OSError as e:
+            logger.error(f'failed to save cache snapshot {path} [{e}]')
+
+    async def _snapshot_loop(self):
+        while True:
+            await asyncio.sleep(DNS.Config.Settings.cache_snapshot_interval)
+            self.save_cache_snapshot()
+
+    async def start(self):
+        self.load_cache_snapshot()
+        await super(UDPDNSServer, self).start()
+        if self.doh is not None:
+            await self.doh.start()
+        if self.admin is not None:
+            await self.admin.start()
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self.profiler.toggle)
+            asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, self._reload_signal)
+        except (NotImplementedError, RuntimeError, AttributeError) as e:
+            logger.warning(f'profiling and reload signal handlers are not available [{e}]')
+        if DNS.Config.Settings.cache_snapshot_path:
+            self._snapshot_task = asyncio.get_running_loop().create_task(self._snapshot_loop())
+        self.memory.start()
+
+    async def stop(self):
+        self.profiler.stop()
+        self.memory.stop()
+        if self._snapshot_task:
+            self._snapshot_task.cancel()
+            self._snapshot_task = None
+        self.save_cache_snapshot()
+        if self.doh is not None:
+            await self.doh.stop()
+        if self.admin is not None:
+            await self.admin.stop()
+        self.chain.close()
+        for p_ in self.plugins:
+            await self._run_func_or_coroutine(p_.close)
+        await self.upstream.close()
+        await super(UDPDNSServer, self).stop()
+
+    async def query_upstream(self, query):
+        health, start = self.upstream_health, time.perf_counter()
+        try:
+            resp = await self.upstream.query(query)
+        except (dns.exception.DNSException, OSError) as e:
+            health.failure(e)
+            raise
+        health.success(time.perf_counter() - start)
+        return resp
+
+    def flush(self, name: dns.name.Name = None):
+        """
+        remove answers of name (or all answers) from answer cache and shared cache
+        :return: number of removed answers of each cache
+        """
+        removed = {'cache': len(self.cache.flush(name))}
+        if self.shared_cache is not None:
+            removed['shared_cache'] = self.shared_cache.expire(b'' if name is None else f'{name.to_text().lower()}|'
+                                                               .encode())
+        logger.warning(f'flushed {removed} answers of {"all names" if name is None else name}')
+        return removed
+
+    def _cache_put(self, query, resp):
+        key = self.cache.key(query, resp)
+        entry = self.cache.put(key, resp)
+        # answers scoped to a client subnet are kept out of shared cache, which is keyed by question only
+        if entry and self.shared_cache is not None and len(key) == 3:
+            self.shared_cache.put(self.shared_cache.key(*key), resp.to_wire(), entry.ttl)
+        return entry
+
+    def _shared_cache_get(self, key):
+        found = self.shared_cache.get(self.shared_cache.key(*key))
+        if found is None:
+            return None
+        wire, _, remaining = found
+        return self.cache.put(key, dns.message.from_wire(wire), remaining=remaining)
+
+    async def _prefetch(self, key, query):
+        entry = self.cache.peek(key)
+        try:
+            resp = await self.query_upstream(query)
+            if resp.rcode() != dns.rcode.SERVFAIL:
+                self._cache_put(query, resp)
+                logger.debug(f'prefetched {query.question[0].to_text()}')
+        except (dns.exception.DNSException, OSError) as e:
+            logger.warning(f'prefetch of {query.question[0].to_text()} failed [{e}]')
+        finally:
+            # entry is not replaced if refresh failed or its answer was not cacheable. allow another prefetch
+            if entry is not None and self.cache.peek(key) is entry:
+                entry.prefetching = False
+
+    async def resolve(self, query):
+        """
+        resolve query through answer cache and upstream. popular answers are refreshed in background before expiry
+        and expired answers are served if upstream fails
+        """
+        key = self.cache.key(query)
+        entry = self.cache.get(key)
+        if entry is None and key is not None and len(key) == 3 and self.shared_cache is not None:
+            entry = self._shared_cache_get(key)
+        if entry:
+            if self.cache.should_prefetch(entry):
+                entry.prefetching = True
+                task = asyncio.get_running_loop().create_task(self._prefetch(key, query))
+                self._background_tasks.add(task)
+                task.add_done_callback(self._background_tasks.discard)
+            return self.cache.make_response(query, entry)
+        try:
+            with DNS.Tracing.span('upstream'):
+                resp = await self.query_upstream(query)
+        except (dns.exception.DNSException, OSError) as e:
+            logger.warning(f'upstream failed for {query.question[0].to_text()} [{e}]')
+            entry = self.cache.get_stale(key)
+            if entry:
+                return self.cache.make_response(query, entry, stale=True)
+            resp = dns.message.make_response(query, recursion_available=True)
+            resp.set_rcode(dns.rcode.SERVFAIL)
+            return resp
+        if resp.rcode() == dns.rcode.SERVFAIL:
+            entry = self.cache.get_stale(key)
+            if entry:
+                return self.cache.make_response(query, entry, stale=True)
+        self._cache_put(query, resp)
+        return resp
+
+    async def handle_query(self, data, addr) -> dns.message.Message:
+        """
+        run query pipeline (parse, plugins hooks, resolve) for a wire query received over any transport
+        :return: response message
+        """
+        chain = self.chain
+        chain.enter()
+        try:
+            with DNS.Tracing.span('parse'):
+                context = DNS.Context.QueryContext(dns.message.from_wire(data, 0), addr)
+            trace = DNS.Tracing.current()
+            if trace:
+                trace.name = f'{addr} {context.qname} {dns.rdatatype.to_text(context.qtype) if context.qtype else ""}'
+            logger.opt(lazy=True).debug('reading DNS query from {}: {}', lambda: addr,
+                                        lambda: context.query.to_text().replace('\n', '\\n'))
+            try:
+                for f_ in chain.plugins:
+                    with DNS.Tracing.span(chain.span_names[id(f_)][0]):
+                        await chain.on_query(f_, context)
+                query = context.query
+                if len(query.question) > 0:
+                    # response of client is built before query's EDNS is changed for upstream
+                    resp = context.response
+                    settings = DNS.Config.Settings
+                    client_ecs = DNS.EDNS.prepare_query(query, context.client, settings.ecs_mode,
+                                                        settings.ecs_ipv4_prefix, settings.ecs_ipv6_prefix)
+                    resp_ = await self.resolve(query)
+                    DNS.EDNS.merge_response(resp, resp_, client_ecs)
+                for f_ in chain.plugins:
+                    with DNS.Tracing.span(chain.span_names[id(f_)][1]):
+                        await chain.on_response(f_, context)
+            except DNS.Guard.PluginFailure as e:
+                logger.warning(f'answering SERVFAIL to {addr}: {e}')
+                context.response = dns.message.make_response(
+                    dns.message.from_wire(data, 0), recursion_available=True
+                )
+                context.response.set_rcode(dns.rcode.SERVFAIL)
+            logger.opt(lazy=True).debug('writing DNS query to {}: {}', lambda: addr,
+                                        lambda: context.response.to_text().replace('\n', '\\n'))
+            return context.response
+        finally:
+            chain.exit()
+
     async def handle_inbound_packet(self, data, addr):
-        query = dns.message.from_wire(data, 0)
-        resp = dns.message.make_response(query, recursion_available=True)
-        query_str = query.to_text().replace('\n', '\\n')
-        logger.debug(f'reading DNS query from {addr}: {query_str}')
-        for f_ in self.plugins:
-            query, resp = await self._run_func_or_coroutine(f_.before_resolve, query, resp, addr)
-        if len(query.question) > 0:
-            resp_ = await dns.asyncquery.udp(
-                query,
-                DNS.Config.Settings.upstream_ip.__str__(),
-                port=DNS.Config.Settings.upstream_port
-            )
-            resp.answer += resp_.answer
-        for f_ in self.plugins:
-            query, resp = await self._run_func_or_coroutine(f_.after_resolve, query, resp, addr)
-        resp_str = resp.to_text().replace('\n', '\\n')
-        logger.debug(f'writing DNS query to {addr}: {resp_str}')
-        self.transport.sendto(resp.to_wire(), addr)
+        trace = self.tracer.start(addr)
+        try:
+            resp = await self.handle_query(data, addr)
+            with DNS.Tracing.span('send'):
+                self.transport.sendto(resp.to_wire(), addr)
+        finally:
+            self.tracer.finish(trace)
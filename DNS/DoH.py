@@ -0,0 +1,219 @@
+import asyncio
+import base64
+import binascii
+import ssl
+from typing import Dict, Optional
+from urllib.parse import parse_qs, urlsplit
+
+import dns.exception
+import h2.config
+import h2.connection
+import h2.events
+import h2.exceptions
+
+import DNS.Cache
+import DNS.Tracing
+from DNS.Logging import logger
+
+CONTENT_TYPE = 'application/dns-message'
+MAX_MESSAGE = 65535
+
+
+class _Stream:
+    __slots__ = ('headers', 'body', 'window')
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.body = bytearray()
+        self.window: Optional[asyncio.Event] = None
+
+
+class _DoHConnection(asyncio.Protocol):
+    """
+    one http/2 connection. each stream carries a query and is answered independently, so many queries of a client
+    are multiplexed over the connection
+    """
+
+    def __init__(self, server: 'DoHServer'):
+        self.server = server
+        self.h2 = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=False,
+                                                                             header_encoding='utf-8'))
+        self.transport: Optional[asyncio.Transport] = None
+        self.peer = None
+        self.streams: Dict[int, _Stream] = {}
+        self.tasks = set()
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info('peername')
+        self.server.connections.add(self)
+        self.h2.initiate_connection()
+        self.transport.write(self.h2.data_to_send())
+
+    def connection_lost(self, exc):
+        self.server.connections.discard(self)
+        for t_ in self.tasks:
+            t_.cancel()
+        for stream in self.streams.values():
+            if stream.window is not None:
+                stream.window.set()
+
+    def data_received(self, data):
+        try:
+            events = self.h2.receive_data(data)
+        except h2.exceptions.ProtocolError as e:
+            logger.debug(f'http/2 protocol error from {self.peer} [{e}]')
+            self.transport.write(self.h2.data_to_send())
+            self.transport.close()
+            return
+        for event in events:
+            if isinstance(event, h2.events.RequestReceived):
+                self.streams[event.stream_id] = _Stream(dict(event.headers))
+                if event.stream_ended:
+                    self._dispatch(event.stream_id)
+            elif isinstance(event, h2.events.DataReceived):
+                stream = self.streams.get(event.stream_id)
+                self.h2.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                if stream is None:
+                    continue
+                stream.body += event.data
+                if len(stream.body) > MAX_MESSAGE:
+                    self._respond(event.stream_id, 413)
+                if event.stream_ended:
+                    self._dispatch(event.stream_id)
+            elif isinstance(event, h2.events.StreamEnded):
+                self._dispatch(event.stream_id)
+            elif isinstance(event, h2.events.StreamReset):
+                self.streams.pop(event.stream_id, None)
+            elif isinstance(event, h2.events.WindowUpdated):
+                for id_, stream in self.streams.items():
+                    if stream.window is not None and (event.stream_id in (0, id_)):
+                        stream.window.set()
+            elif isinstance(event, h2.events.ConnectionTerminated):
+                self.transport.close()
+        self.transport.write(self.h2.data_to_send())
+
+    def _dispatch(self, stream_id):
+        stream = self.streams.get(stream_id)
+        if stream is None or stream.window is not None:
+            return
+        stream.window = asyncio.Event()
+        task = asyncio.get_running_loop().create_task(self._handle(stream_id, stream))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def _query_wire(self, stream: _Stream):
+        """
+        :return: (wire query, None) or (None, http error status)
+        """
+        method = stream.headers.get(':method')
+        url = urlsplit(stream.headers.get(':path', ''))
+        if url.path != self.server.path:
+            return None, 404
+        if method == 'GET':
+            value = parse_qs(url.query).get('dns')
+            if not value:
+                return None, 400
+            try:
+                return base64.urlsafe_b64decode(value[0] + '=' * (-len(value[0]) % 4)), None
+            except (binascii.Error, ValueError):
+                return None, 400
+        if method == 'POST':
+            if stream.headers.get('content-type') != CONTENT_TYPE:
+                return None, 415
+            return bytes(stream.body), None
+        return None, 405
+
+    async def _handle(self, stream_id, stream: _Stream):
+        data, status = self._query_wire(stream)
+        if data is None:
+            self._respond(stream_id, status)
+            return
+        tracer = self.server.dns_server.tracer
+        trace = tracer.start(self.peer)
+        try:
+            try:
+                resp = await self.server.dns_server.handle_query(data, self.peer)
+            except (dns.exception.DNSException, ValueError) as e:
+                logger.debug(f'bad DoH query from {self.peer} [{e}]')
+                self._respond(stream_id, 400)
+                return
+            wire = resp.to_wire()
+            headers = [('content-type', CONTENT_TYPE), ('content-length', str(len(wire))),
+                       ('cache-control', f'max-age={DNS.Cache.AnswerCache.response_ttl(resp)}')]
+            with DNS.Tracing.span('send'):
+                await self._send(stream_id, stream, 200, headers, wire)
+        finally:
+            tracer.finish(trace)
+
+    def _respond(self, stream_id, status):
+        stream = self.streams.pop(stream_id, None)
+        if stream is None or self.transport.is_closing():
+            return
+        try:
+            self.h2.send_headers(stream_id, [(':status', str(status)), ('content-length', '0')], end_stream=True)
+        except h2.exceptions.ProtocolError:
+            return
+        self.transport.write(self.h2.data_to_send())
+
+    async def _send(self, stream_id, stream: _Stream, status, headers, body: bytes):
+        try:
+            self.h2.send_headers(stream_id, [(':status', str(status)), *headers])
+            while body:
+                if self.transport.is_closing():
+                    return
+                window = min(self.h2.local_flow_control_window(stream_id), self.h2.max_outbound_frame_size)
+                if window <= 0:
+                    self.transport.write(self.h2.data_to_send())
+                    stream.window.clear()
+                    await stream.window.wait()
+                    continue
+                self.h2.send_data(stream_id, body[:window])
+                body = body[window:]
+            self.h2.end_stream(stream_id)
+            self.transport.write(self.h2.data_to_send())
+        except h2.exceptions.ProtocolError as e:
+            # stream was reset by client
+            logger.debug(f'failed to answer DoH stream {stream_id} of {self.peer} [{e}]')
+        finally:
+            self.streams.pop(stream_id, None)
+
+
+class DoHServer:
+    """
+    DNS over HTTPS listener (RFC 8484) feeding queries to the pipeline of a UDPDNSServer
+    notes:
+        - http/2 only: over tls (negotiated by alpn "h2") or cleartext with prior knowledge (h2c) if no certificate
+          is given
+        - GET with base64url "dns" parameter and POST with application/dns-message body are supported on path
+        - cache-control max-age of answers is their ttl (minimum of answer rrsets or negative ttl)
+    """
+
+    def __init__(self, dns_server, local_ip='127.0.0.1', local_port=443, path='/dns-query', cert_file=None,
+                 key_file=None):
+        self.dns_server = dns_server
+        self.local_addr = (local_ip, local_port)
+        self.path = path
+        self.ssl_context = None
+        if cert_file:
+            self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+            self.ssl_context.load_cert_chain(cert_file, key_file)
+            self.ssl_context.set_alpn_protocols(['h2'])
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.connections = set()
+
+    @property
+    def address(self):
+        return self.server.sockets[0].getsockname()[:2]
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.server = await loop.create_server(lambda: _DoHConnection(self), *self.local_addr, ssl=self.ssl_context,
+                                               reuse_port=True)
+        logger.warning(f'DoH server started on {self.address} [{"tls" if self.ssl_context else "h2c"}]')
+
+    async def stop(self):
+        self.server.close()
+        for connection in list(self.connections):
+            connection.transport.close()
+        await self.server.wait_closed()
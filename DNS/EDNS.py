@@ -0,0 +1,119 @@
+import ipaddress
+
+import dns.edns
+import dns.flags
+import dns.message
+
+STRIP = 'strip'
+FORWARD = 'forward'
+SYNTHESIZE = 'synthesize'
+
+def client_subnet(message: dns.message.Message):
+    """
+    :return: ECS option of message or None
+    """
+    for option in message.options:
+        if option.otype == dns.edns.ECS:
+            return option
+    return None
+
+
+def network(address: str, prefix):
+    """
+    :return: address masked to prefix as text
+    """
+    return str(ipaddress.ip_network(f'{address}/{prefix}', strict=False).network_address)
+
+
+def subnet_option(address: str, prefix, scope=0):
+    return dns.edns.ECSOption(network(address, prefix), prefix, scope)
+
+
+def prepare_query(query: dns.message.Message, host, mode=FORWARD, ipv4_prefix=24, ipv6_prefix=56):
+    """
+    set ECS option of query (in place) before it is sent upstream
+    notes:
+        - strip: ECS option of client is removed
+        - forward: ECS option of client is kept, source prefix is shortened to ipv4_prefix / ipv6_prefix
+        - synthesize: as forward, and an ECS option is made from client address if client didn't send one. a client
+          sending source prefix 0 asked for its address not to be used, so it is kept as is
+    :return: ECS option which client sent or None
+    """
+    client_ecs = client_subnet(query)
+    options = [x for x in query.options if x.otype != dns.edns.ECS]
+    ecs = None
+    if mode != STRIP:
+        if client_ecs is not None:
+            max_prefix = ipv4_prefix if client_ecs.family == 1 else ipv6_prefix
+            ecs = client_ecs
+            if client_ecs.srclen > max_prefix:
+                ecs = subnet_option(client_ecs.address, max_prefix)
+        elif mode == SYNTHESIZE and host:
+            try:
+                address = ipaddress.ip_address(host.split('%')[0])
+            except ValueError:
+                address = None
+            if address is not None:
+                address = getattr(address, 'ipv4_mapped', None) or address
+                ecs = subnet_option(str(address), ipv4_prefix if address.version == 4 else ipv6_prefix)
+    if ecs is not None:
+        options.append(ecs)
+    if ecs is not None or client_ecs is not None:
+        if query.edns < 0:
+            query.use_edns(0, 0, options=options)
+        else:
+            query.use_edns(query.edns, query.ednsflags, query.payload, options=options)
+    return client_ecs
+
+
+def scoped_subnet(query: dns.message.Message, response: dns.message.Message):
+    """
+    subnet an answer to query is valid for, from scope prefix returned by upstream (RFC 7871 7.3)
+    :return: (family, network, scope prefix) or None if answer is valid for all clients
+    """
+    ecs = client_subnet(query)
+    if ecs is None or ecs.srclen == 0:
+        return None
+    response_ecs = client_subnet(response)
+    if response_ecs is None or response_ecs.scopelen == 0:
+        return None
+    scope = min(response_ecs.scopelen, ecs.srclen)
+    return ecs.family, network(ecs.address, scope), scope
+
+
+def candidate_subnets(query: dns.message.Message, scopes):
+    """
+    subnets a cached answer to query may be stored under, longest scope first
+    :param scopes: scope prefixes seen for the question as (family, scope)
+    """
+    ecs = client_subnet(query)
+    if ecs is None or ecs.srclen == 0:
+        return
+    for family, scope in sorted(scopes, key=lambda x: -x[1]):
+        if family == ecs.family and scope <= ecs.srclen:
+            yield family, network(ecs.address, scope), scope
+
+
+def merge_response(response: dns.message.Message, upstream: dns.message.Message, client_ecs=None):
+    """
+    copy sections, rcode and EDNS of upstream response into response made for client (in place)
+    notes:
+        - rcode of upstream is kept only if response has no answer of its own (e.g. given by a plugin)
+        - EDNS options are passed through if client used EDNS. ECS is returned only to a client which sent it, with
+          client's own subnet and scope of upstream
+    """
+    own_answer = bool(response.answer)
+    response.answer += upstream.answer
+    response.authority += upstream.authority
+    response.additional += upstream.additional
+    if response.edns >= 0:
+        options = [x for x in upstream.options if x.otype != dns.edns.ECS]
+        if client_ecs is not None:
+            upstream_ecs = client_subnet(upstream)
+            scope = min(upstream_ecs.scopelen, client_ecs.srclen) if upstream_ecs is not None else 0
+            options.append(dns.edns.ECSOption(client_ecs.address, client_ecs.srclen, scope))
+        ednsflags = (response.ednsflags & ~int(dns.flags.DO)) | (upstream.ednsflags & int(dns.flags.DO))
+        response.use_edns(response.edns, ednsflags, response.payload, options=options)
+    if not own_answer:
+        response.set_rcode(upstream.rcode())
+    return response
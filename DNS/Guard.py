@@ -0,0 +1,95 @@
+import asyncio
+import time
+
+from DNS.Logging import logger
+
+OPEN = 'open'
+CLOSED = 'closed'
+
+
+class PluginFailure(Exception):
+    """
+    raised by a fail-closed plugin guard. the query is answered with SERVFAIL
+    """
+
+    def __init__(self, plugin, reason):
+        super(PluginFailure, self).__init__(f'{plugin} {reason}')
+        self.plugin = plugin
+        self.reason = reason
+
+
+class PluginGuard:
+    """
+    time budget, failure mode and circuit breaker of hooks of a plugin
+    notes:
+        - a hook which runs longer than budget seconds is cancelled (no budget if None). a hook which raises is
+          handled the same way
+        - on failure the plugin is skipped for that query (fail "open") or the query is answered SERVFAIL ("closed")
+        - after breaker_threshold consecutive failures the breaker trips: hooks are not called for breaker_cooldown
+          seconds and fail mode is applied right away. then one call is let through; breaker closes if it succeeds
+          (breaker_threshold 0 disables breaker)
+        - calls, overruns, errors, skipped (by breaker) and trips are counted in counters
+    """
+
+    def __init__(self, name, budget=None, fail=OPEN, breaker_threshold=5, breaker_cooldown=10., clock=time.monotonic):
+        self.name = name
+        self.budget = budget
+        self.fail = fail
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.clock = clock
+        self.failures = 0
+        self.open_until = None
+        self._probing = False
+        self.counters = {'calls': 0, 'overruns': 0, 'errors': 0, 'skipped': 0, 'trips': 0}
+
+    @property
+    def tripped(self):
+        return self.open_until is not None
+
+    def _failed(self, reason):
+        self.failures += 1
+        self._probing = False
+        if self.breaker_threshold and (self.failures >= self.breaker_threshold or self.tripped):
+            if not self.tripped:
+                self.counters['trips'] += 1
+                logger.error(f'circuit breaker of {self.name} tripped after {self.failures} failures. skipping it '
+                             f'for {self.breaker_cooldown}s')
+            self.open_until = self.clock() + self.breaker_cooldown
+        if self.fail == CLOSED:
+            raise PluginFailure(self.name, reason)
+
+    async def run(self, func, *args):
+        """
+        await func(*args) under budget and breaker. returns None if plugin was skipped (fail-open)
+        :raise PluginFailure: if plugin failed or was skipped and fail mode is closed
+        """
+        if self.open_until is not None:
+            if self._probing or self.clock() < self.open_until:
+                self.counters['skipped'] += 1
+                if self.fail == CLOSED:
+                    raise PluginFailure(self.name, 'is tripped')
+                return None
+            # cooldown is over. let one call probe the plugin
+            self._probing = True
+        self.counters['calls'] += 1
+        try:
+            if self.budget is None:
+                result = await func(*args)
+            else:
+                result = await asyncio.wait_for(func(*args), self.budget)
+        except asyncio.TimeoutError:
+            self.counters['overruns'] += 1
+            logger.warning(f'{self.name} exceeded its budget of {self.budget}s')
+            return self._failed('exceeded its budget')
+        except Exception as e:
+            self.counters['errors'] += 1
+            logger.exception(f'{self.name} failed [{e}]')
+            return self._failed('raised an error')
+        if self.failures or self.tripped:
+            if self.tripped:
+                logger.warning(f'circuit breaker of {self.name} closed')
+            self.failures = 0
+            self.open_until = None
+            self._probing = False
+        return result
@@ -0,0 +1,115 @@
+import asyncio
+from typing import Callable, Dict, Optional
+
+from DNS.Logging import logger
+
+# components with lower priority are shrunk first
+PRIORITY_CACHE = 10
+PRIORITY_RATE_LIMIT = 20
+PRIORITY_INDEX = 30
+
+
+class Component:
+    """
+    a memory consumer. usage returns its approximate size in bytes, shrink(nbytes) frees about nbytes and returns
+    freed bytes. components without shrink are only accounted
+    """
+    __slots__ = ('usage', 'shrink', 'priority')
+
+    def __init__(self, usage: Callable[[], int], shrink: Optional[Callable[[int], int]] = None,
+                 priority=PRIORITY_CACHE):
+        self.usage = usage
+        self.shrink = shrink
+        self.priority = priority
+
+
+class MemoryAccountant:
+    """
+    one memory budget of a server process shared by its caches, tables and indexes
+    notes:
+        - total usage is checked every check_interval seconds. when it is over budget, shrinkable components are asked
+          to give memory back in priority order (answer cache, then rate limit table, then plugin filters) until usage
+          is down to low_water fraction of budget, so components are not shrunk again on each check
+        - usage is approximate: entries are counted with size estimates and fixed structures with their allocated
+          size. structures shared between processes (shared cache, index file pages) are counted in each process
+        - budget 0 only accounts usage (visible in admin api)
+        - checks, over budget checks and freed bytes are counted in counters
+    """
+
+    def __init__(self, budget=0, check_interval=1., low_water=0.9):
+        self.budget = budget
+        self.check_interval = check_interval
+        self.low_water = low_water
+        self.components: Dict[str, Component] = {}
+        self.counters = {'checks': 0, 'over_budget': 0, 'freed': 0}
+        self._task = None
+        # set while unshrinkable usage alone is over budget, so it is logged once
+        self._short = False
+
+    def register(self, name, component: Component):
+        """
+        add component (replaces a component with the same name)
+        """
+        self.components[name] = component
+
+    def unregister(self, prefix):
+        """
+        remove components whose names start with prefix
+        """
+        for name in [x for x in self.components if x.startswith(prefix)]:
+            del self.components[name]
+
+    def usage(self) -> Dict[str, int]:
+        return {k_: int(v_.usage()) for k_, v_ in self.components.items()}
+
+    def check(self):
+        """
+        shrink components if total usage is over budget
+        :return: freed bytes
+        """
+        self.counters['checks'] += 1
+        if not self.budget:
+            return 0
+        usage = self.usage()
+        total = sum(usage.values())
+        if total <= self.budget:
+            self._short = False
+            return 0
+        self.counters['over_budget'] += 1
+        excess, freed = total - int(self.budget * self.low_water), 0
+        for name, component in sorted(self.components.items(), key=lambda x: x[1].priority):
+            if freed >= excess:
+                break
+            if component.shrink is None or not usage[name]:
+                continue
+            freed_ = component.shrink(min(excess - freed, usage[name]))
+            logger.info(f'memory over budget [{total}/{self.budget} bytes]. shrunk {name} by {freed_} bytes')
+            freed += freed_
+        self.counters['freed'] += freed
+        if freed < total - self.budget:
+            if not self._short:
+                logger.warning(f'memory budget {self.budget} bytes is too small. {total - freed} bytes are used '
+                               f'after shrinking all components: {usage}')
+            self._short = True
+        return freed
+
+    def state(self):
+        usage = self.usage()
+        return {'budget': self.budget, 'total': sum(usage.values()), 'components': usage, **self.counters}
+
+    async def _check_loop(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            try:
+                self.check()
+            except Exception as e:
+                logger.exception(f'memory check failed [{e}]')
+
+    def start(self):
+        if self.budget and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._check_loop())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
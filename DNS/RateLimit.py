@@ -0,0 +1,131 @@
+import socket
+import struct
+import time
+from collections import OrderedDict
+
+_HEADER = struct.Struct('!HHHHHH')
+_QR = 0x8000
+_TC = 0x0200
+_OPCODE_RD = 0x7900
+_RCODE_REFUSED = 5
+
+ALLOW = 'allow'
+DROP = 'drop'
+SLIP = 'slip'
+REFUSE = 'refuse'
+
+
+def client_key(host: str, ipv4_prefix=24, ipv6_prefix=56):
+    """
+    integer key of client network (address masked to prefix). ipv6 keys are offset so they never collide with ipv4
+    """
+    try:
+        return int.from_bytes(socket.inet_aton(host), 'big') >> (32 - ipv4_prefix)
+    except OSError:
+        value = int.from_bytes(socket.inet_pton(socket.AF_INET6, host.split('%')[0]), 'big')
+        return (1 << 128) | (value >> (128 - ipv6_prefix))
+
+
+def error_response(data: bytes, truncated=False):
+    """
+    build a response with empty answer (TC=1 or REFUSED) for a raw query without parsing it with dnspython. question
+    section is copied as is
+    :return: wire response or None if data is not a well formed single question query
+    """
+    if len(data) < _HEADER.size:
+        return None
+    id_, flags, qdcount, _, _, _ = _HEADER.unpack_from(data, 0)
+    if flags & _QR or qdcount != 1:
+        return None
+    offset = _HEADER.size
+    while True:
+        if offset >= len(data):
+            return None
+        length = data[offset]
+        if length == 0:
+            offset += 1
+            break
+        if length & 0xC0:
+            return None
+        offset += length + 1
+    offset += 4
+    if offset > len(data):
+        return None
+    flags = _QR | (flags & _OPCODE_RD) | (_TC if truncated else _RCODE_REFUSED)
+    return _HEADER.pack(id_, flags, 1, 0, 0, 0) + data[_HEADER.size:offset]
+
+
+# approximate memory of a bucket of table (key, bucket list and its lru node; measured with tracemalloc)
+BUCKET_BYTES = 210
+
+
+class RateLimiter:
+    """
+    response rate limiting with a token bucket per client network
+    notes:
+        - each bucket is refilled with rate tokens per second up to burst. a query takes one token
+        - buckets are kept in an lru table of table_size. a bucket dropped from table is refilled anyway by the time
+          its client is seen again (unless table is too small for active clients), so eviction acts as aging
+        - over limit queries get action: drop, refuse (REFUSED) or slip. with slip every slip-th over limit query is
+          answered with TC=1 (client can retry over tcp) and the others are dropped
+        - decisions are counted in counters
+    """
+
+    def __init__(self, rate, burst=None, table_size=100000, ipv4_prefix=24, ipv6_prefix=56, action=SLIP, slip=2,
+                 clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst or rate
+        self.table_size = table_size
+        self.ipv4_prefix = ipv4_prefix
+        self.ipv6_prefix = ipv6_prefix
+        self.action = action
+        self.slip = slip
+        self.clock = clock
+        # key -> [tokens, last refill time, over limit count]
+        self._buckets = OrderedDict()
+        self.counters = {ALLOW: 0, DROP: 0, SLIP: 0, REFUSE: 0}
+
+    def __len__(self):
+        return len(self._buckets)
+
+    @property
+    def nbytes(self):
+        return len(self._buckets) * BUCKET_BYTES
+
+    def shrink(self, nbytes):
+        """
+        drop least recently seen buckets worth nbytes. their clients start again with a full bucket
+        :return: freed bytes
+        """
+        count = min(len(self._buckets), -(-nbytes // BUCKET_BYTES))
+        for _ in range(count):
+            self._buckets.popitem(last=False)
+        return count * BUCKET_BYTES
+
+    def check(self, host: str):
+        """
+        take a token for client and decide what to do with its query
+        :return: one of ALLOW, DROP, SLIP, REFUSE
+        """
+        key = client_key(host, self.ipv4_prefix, self.ipv6_prefix)
+        now = self.clock()
+        buckets = self._buckets
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = [self.burst, now, 0]
+            if len(buckets) > self.table_size:
+                buckets.popitem(last=False)
+        else:
+            buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] >= 1:
+            bucket[0] -= 1
+            decision = ALLOW
+        else:
+            bucket[2] += 1
+            decision = self.action
+            if decision == SLIP and (self.slip <= 0 or bucket[2] % self.slip):
+                decision = DROP
+        self.counters[decision] += 1
+        return decision
@@ -0,0 +1,386 @@
+import asyncio
+import bisect
+import time
+import urllib.parse
+from typing import Dict, List, Optional, Tuple
+
+import aioredis
+import aioredis.exceptions
+import aioredis.sentinel
+
+from DNS.Logging import logger
+
+SINGLE = 'single'
+REPLICA = 'replica'
+SENTINEL = 'sentinel'
+CLUSTER = 'cluster'
+
+SLOTS = 16384
+# commands which can be served by replicas. any other command goes to primary of its key
+READS = frozenset(['get', 'hget', 'hmget', 'hlen', 'hscan_iter', 'scard', 'sismember', 'smembers', 'sscan_iter'])
+
+Address = Tuple[str, int]
+
+
+def _crc16_table():
+    table = []
+    for i_ in range(256):
+        crc = i_ << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021 if crc & 0x8000 else crc << 1) & 0xffff
+        table.append(crc)
+    return table
+
+
+_CRC16_TABLE = _crc16_table()
+
+
+def key_slot(key) -> int:
+    """
+    redis cluster hash slot of key (crc16 xmodem of key or of its {hash tag})
+    """
+    key = key.encode() if isinstance(key, str) else key
+    start = key.find(b'{')
+    if start != -1:
+        end = key.find(b'}', start + 1)
+        if end > start + 1:
+            key = key[start + 1:end]
+    crc = 0
+    for b_ in key:
+        crc = ((crc << 8) & 0xffff) ^ _CRC16_TABLE[(crc >> 8) ^ b_]
+    return crc % SLOTS
+
+
+def parse_address(address: str) -> Address:
+    host, _, port = address.rpartition(':')
+    return host.strip('[]'), int(port)
+
+
+def node_uri(uri: str, address: Address) -> str:
+    """
+    uri of a node at address with credentials, db and options of uri
+    """
+    parts = urllib.parse.urlsplit(uri)
+    host = f'[{address[0]}]' if ':' in address[0] else address[0]
+    netloc = f'{parts.netloc.rpartition("@")[0]}@' if '@' in parts.netloc else ''
+    return urllib.parse.urlunsplit(parts._replace(netloc=f'{netloc}{host}:{address[1]}'))
+
+
+class _ReadOnlyConnection(aioredis.Connection):
+    """
+    connection to a cluster replica. READONLY lets it serve reads of slots of its primary
+    """
+
+    async def on_connect(self):
+        await super(_ReadOnlyConnection, self).on_connect()
+        await self.send_command('READONLY')
+        await self.read_response()
+
+
+def create_client(uri: str, readonly=False):
+    kwargs = {'connection_class': _ReadOnlyConnection} if readonly and uri.startswith('redis://') else {}
+    return aioredis.from_url(uri, encoding='utf-8', decode_responses=True, **kwargs)
+
+
+def pool_state(client):
+    """
+    connections of connection pool of an aioredis client
+    """
+    pool = client.connection_pool
+    return {'created': pool._created_connections, 'in_use': len(pool._in_use_connections),
+            'available': len(pool._available_connections), 'max': pool.max_connections}
+
+
+class RedisNode:
+    __slots__ = ('address', 'client', 'latency')
+
+    def __init__(self, address: Address, client):
+        self.address = address
+        self.client = client
+        # smoothed ping round trip in seconds. None if node did not respond to last ping
+        self.latency: Optional[float] = None
+
+
+class Shard:
+    __slots__ = ('start', 'end', 'primary', 'replicas')
+
+    def __init__(self, start, end, primary: Address, replicas: List[Address]):
+        self.start = start
+        self.end = end
+        self.primary = primary
+        self.replicas = replicas
+
+
+class RedisTopology:
+    """
+    redis nodes used by Authoritative plugins. writes go to primary of a key and reads to the node with lowest latency
+    notes:
+        - single: only uri. replica: uri is primary; replicas are listed addresses and the ones reported by INFO
+          replication of primary. sentinel: primary and replicas of service are asked from sentinels. cluster: uri is
+          a seed node; slots and their nodes are read with CLUSTER SLOTS and keys are routed by hash slot
+        - read_from: primary, replica (lowest latency replica, primary if none responds) or nearest (lowest latency
+          node of primary and replicas)
+        - topology is refreshed and nodes are pinged (latency is smoothed) every refresh_interval seconds. a MOVED
+          reply schedules a refresh right away
+        - credentials, db and options of uri are used for every node
+    """
+
+    def __init__(self, uri=None, mode=SINGLE, replicas=(), sentinels=(), service=None, read_from='nearest',
+                 refresh_interval=10., client_factory=None):
+        self.uri = uri or 'redis://localhost:6379'
+        self.mode = mode
+        self.replicas = [parse_address(x) for x in replicas]
+        self.service = service
+        self.read_from = read_from
+        self.refresh_interval = refresh_interval
+        self.client_factory = create_client if client_factory is None else client_factory
+        self.sentinel = aioredis.sentinel.Sentinel([parse_address(x) for x in sentinels], socket_timeout=1) \
+            if mode == SENTINEL else None
+        self.nodes: Dict[Address, RedisNode] = {}
+        self.shards: List[Shard] = []
+        self._starts: List[int] = []
+        self._seed: Optional[Address] = None
+        if mode != SENTINEL:
+            parts = urllib.parse.urlsplit(self.uri)
+            self._seed = (parts.hostname or 'localhost', parts.port or 6379)
+            self._set_shards([Shard(0, SLOTS - 1, self._seed, [])])
+        self._refreshed = asyncio.Event()
+        self._task = asyncio.get_event_loop().create_task(self._refresh_loop())
+
+    def _node(self, address: Address, readonly=False) -> RedisNode:
+        node = self.nodes.get(address)
+        if node is None:
+            node = self.nodes[address] = RedisNode(address, self.client_factory(node_uri(self.uri, address), readonly))
+        return node
+
+    def _set_shards(self, shards: List[Shard]):
+        for s_ in shards:
+            self._node(s_.primary)
+            for r_ in s_.replicas:
+                self._node(r_, readonly=self.mode == CLUSTER)
+        shards.sort(key=lambda x: x.start)
+        used = {x.primary for x in shards} | {y for x in shards for y in x.replicas}
+        for a_ in set(self.nodes) - used:
+            logger.info(f'redis node {a_[0]}:{a_[1]} left topology')
+            self._close_client(self.nodes.pop(a_).client)
+        self.shards = shards
+        self._starts = [x.start for x in shards]
+
+    @staticmethod
+    def _close_client(client):
+        asyncio.get_event_loop().create_task(client.close())
+
+    def shard(self, key=None) -> Shard:
+        if not self.shards:
+            raise aioredis.exceptions.ConnectionError('redis topology is not discovered yet')
+        if self.mode != CLUSTER or key is None:
+            return self.shards[0]
+        slot = key_slot(key)
+        shard = self.shards[bisect.bisect_right(self._starts, slot) - 1]
+        if not shard.start <= slot <= shard.end:
+            raise aioredis.exceptions.ConnectionError(f'slot {slot} is not served by any known redis node')
+        return shard
+
+    def primary(self, key=None):
+        return self.nodes[self.shard(key).primary].client
+
+    def reader(self, key=None):
+        shard = self.shard(key)
+        if self.read_from == 'primary':
+            return self.nodes[shard.primary].client
+        nodes = [self.nodes[x] for x in shard.replicas]
+        if self.read_from == 'nearest':
+            nodes.append(self.nodes[shard.primary])
+        nodes = [x for x in nodes if x.latency is not None]
+        if not nodes:
+            return self.nodes[shard.primary].client
+        return min(nodes, key=lambda x: x.latency).client
+
+    async def _discover(self) -> List[Shard]:
+        if self.mode == SENTINEL:
+            primary = await self.sentinel.discover_master(self.service)
+            replicas = await self.sentinel.discover_slaves(self.service)
+            return [Shard(0, SLOTS - 1, (str(primary[0]), int(primary[1])),
+                          [(str(x[0]), int(x[1])) for x in replicas])]
+        if self.mode == REPLICA:
+            info = await self.nodes[self._seed].client.info('replication')
+            found = [(x['ip'], int(x['port'])) for k_, x in info.items()
+                     if k_.startswith('slave') and isinstance(x, dict) and x.get('state', 'online') == 'online']
+            return [Shard(0, SLOTS - 1, self._seed, list(dict.fromkeys([*self.replicas, *found])))]
+        if self.mode == CLUSTER:
+            # any known node can report slots. seed is tried last, it may have left cluster
+            candidates = [x.primary for x in self.shards if x.primary != self._seed] + [self._seed]
+            error = aioredis.exceptions.ConnectionError('no redis node reported cluster slots')
+            for a_ in candidates:
+                try:
+                    slots = await self._node(a_).client.cluster('SLOTS')
+                except (aioredis.exceptions.RedisError, OSError) as e:
+                    error = e
+                    continue
+                # a node which has not joined cluster yet reports no slots
+                if not slots:
+                    continue
+                return [Shard(int(x[0]), int(x[1]), (str(x[2][0]), int(x[2][1])),
+                              [(str(y[0]), int(y[1])) for y in x[3:]]) for x in slots]
+            raise error
+        return [Shard(0, SLOTS - 1, self._seed, [])]
+
+    async def _ping(self, node: RedisNode):
+        start = time.monotonic()
+        try:
+            await asyncio.wait_for(node.client.ping(), self.refresh_interval)
+        except (aioredis.exceptions.RedisError, OSError, asyncio.TimeoutError) as e:
+            if node.latency is not None:
+                logger.warning(f'redis node {node.address[0]}:{node.address[1]} is not responding [{e}]')
+            node.latency = None
+            return
+        latency = time.monotonic() - start
+        node.latency = latency if node.latency is None else node.latency * 0.7 + latency * 0.3
+
+    async def refresh(self):
+        """
+        rediscover nodes and measure their latency
+        """
+        shards = await self._discover()
+        if [(x.start, x.end, x.primary, x.replicas) for x in shards] != \
+                [(x.start, x.end, x.primary, x.replicas) for x in self.shards]:
+            logger.info(f'redis topology ({self.mode}): ' + ', '.join(
+                f'{x.start}-{x.end} {x.primary[0]}:{x.primary[1]} ({len(x.replicas)} replicas)' for x in shards))
+            self._set_shards(shards)
+        if self.read_from != 'primary':
+            await asyncio.gather(*[self._ping(x) for x in list(self.nodes.values())])
+
+    def moved(self):
+        """
+        called on a MOVED reply: slots were reassigned, so topology is refreshed without waiting for next interval
+        """
+        self._refreshed.set()
+
+    async def _refresh_loop(self):
+        while True:
+            try:
+                await self.refresh()
+            except (aioredis.exceptions.RedisError, OSError) as e:
+                logger.error(f'failed to refresh redis topology ({self.mode}) [{e}]')
+            self._refreshed.clear()
+            try:
+                await asyncio.wait_for(self._refreshed.wait(), self.refresh_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def state(self):
+        """
+        :return: shards and latency and connection pool of each node
+        """
+        return {
+            'mode': self.mode, 'read_from': self.read_from,
+            'shards': [{'slots': f'{x.start}-{x.end}', 'primary': f'{x.primary[0]}:{x.primary[1]}',
+                        'replicas': [f'{y[0]}:{y[1]}' for y in x.replicas]} for x in self.shards],
+            'nodes': {f'{x[0]}:{x[1]}': {'latency_ms': None if y.latency is None else round(y.latency * 1e3, 3),
+                                         **pool_state(y.client)} for x, y in self.nodes.items()},
+        }
+
+    async def close(self):
+        if self._task:
+            self._task.cancel()
+            self._task = None
+        for n_ in self.nodes.values():
+            await n_.client.close()
+        if self.sentinel is not None:
+            for s_ in self.sentinel.sentinels:
+                await s_.close()
+
+
+class _RoutedPipeline:
+    """
+    pipeline of RoutedRedis. commands are grouped by the node they are routed to and each group is sent as one
+    pipeline (concurrently). results are returned in order of commands
+    """
+
+    def __init__(self, redis: 'RoutedRedis', transaction):
+        self.redis = redis
+        self.transaction = transaction
+        self.commands = []
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def _add(key, *args, **kwargs):
+            self.commands.append((name, key, args, kwargs))
+            return self
+
+        return _add
+
+    async def execute(self):
+        groups = {}
+        for i_, (name, key, _, _) in enumerate(self.commands):
+            client = self.redis.client_for(name, key)
+            groups.setdefault(id(client), (client, []))[1].append(i_)
+        results = [None] * len(self.commands)
+
+        async def _run(client, indexes):
+            async with client.pipeline(transaction=self.transaction) as pipe:
+                for i__ in indexes:
+                    name_, key_, args, kwargs = self.commands[i__]
+                    getattr(pipe, name_)(key_, *args, **kwargs)
+                for i__, r_ in zip(indexes, await self.redis.checked(pipe.execute())):
+                    results[i__] = r_
+
+        try:
+            await asyncio.gather(*[_run(*x) for x in groups.values()])
+        finally:
+            self.commands = []
+        return results
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_):
+        self.commands = []
+
+
+class RoutedRedis:
+    """
+    aioredis like client over a RedisTopology. commands whose first argument is a key are routed by it: READS to
+    reader of key and others to primary of key. pipelines are split per node (a transaction covers commands of one
+    node only)
+    """
+
+    def __init__(self, topology: RedisTopology):
+        self.topology = topology
+
+    def client_for(self, command, key):
+        return self.topology.reader(key) if command in READS else self.topology.primary(key)
+
+    async def checked(self, awaitable):
+        try:
+            return await awaitable
+        except aioredis.exceptions.ResponseError as e:
+            if str(e).startswith(('MOVED', 'ASK')):
+                self.topology.moved()
+            raise
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        def _command(key, *args, **kwargs):
+            result = getattr(self.client_for(name, key), name)(key, *args, **kwargs)
+            # scan iterators are returned as is
+            return self.checked(result) if asyncio.iscoroutine(result) else result
+
+        return _command
+
+    def xreadgroup(self, groupname, consumername, streams, **kwargs):
+        return self.checked(self.topology.primary(next(iter(streams))).xreadgroup(groupname, consumername, streams,
+                                                                                  **kwargs))
+
+    def pipeline(self, transaction=True):
+        return _RoutedPipeline(self, transaction)
+
+    def state(self):
+        return self.topology.state()
+
+    async def close(self):
+        await self.topology.close()
@@ -0,0 +1,161 @@
+import multiprocessing
+import struct
+import time
+import zlib
+from multiprocessing import shared_memory
+
+from DNS.Logging import logger
+
+# seq, key length, value length, ttl, expiry (unix time)
+_SLOT_HEADER = struct.Struct('=IHHId')
+_SEQ = struct.Struct('=I')
+# key and value lengths are stored as unsigned 16 bit integers
+MAX_SLOT_SIZE = 0xFFFF + _SLOT_HEADER.size
+
+
+class SharedAnswerCache:
+    """
+    answer cache shared between server processes in a shared memory segment
+    notes:
+        - open addressing hash table of fixed size slots. each slot holds a key and a pre-encoded wire response
+        - readers are lock free: each slot has a sequence number which is odd while a writer is updating the slot.
+          readers retry if it is odd or changed during the read
+        - writers are serialized with striped locks (slot index modulo number of stripes)
+        - responses larger than slot size are not cached
+        - must be created before worker processes are forked. creator process unlinks the segment on close()
+    """
+    MAX_PROBE = 8
+    READ_RETRIES = 4
+
+    def __init__(self, slots=65536, slot_size=1024, stripes=64):
+        if not _SLOT_HEADER.size < slot_size <= MAX_SLOT_SIZE:
+            raise ValueError(f'slot size should be in ({_SLOT_HEADER.size}, {MAX_SLOT_SIZE}]')
+        self.slots = slots
+        self.slot_size = slot_size
+        self.max_value = slot_size - _SLOT_HEADER.size
+        self._shm = shared_memory.SharedMemory(create=True, size=slots * slot_size)
+        self._locks = [multiprocessing.Lock() for _ in range(stripes)]
+        self._owner = multiprocessing.current_process().pid
+        self.hits = 0
+        self.misses = 0
+        logger.info(f'shared cache created with {slots} slots of {slot_size} bytes')
+
+    @property
+    def nbytes(self):
+        return self.slots * self.slot_size
+
+    def count(self):
+        """
+        number of fresh entries. scans whole table
+        """
+        now = time.time()
+        buf = self._shm.buf
+        count = 0
+        for i_ in range(self.slots):
+            _, key_len, _, _, expires = _SLOT_HEADER.unpack_from(buf, i_ * self.slot_size)
+            if key_len and expires > now:
+                count += 1
+        return count
+
+    @staticmethod
+    def key(name, rdtype, rdclass):
+        return f'{name.to_text().lower()}|{rdtype}|{rdclass}'.encode()
+
+    def _slot_offsets(self, key):
+        index = zlib.crc32(key) % self.slots
+        for probe in range(self.MAX_PROBE):
+            slot = (index + probe) % self.slots
+            yield slot, slot * self.slot_size
+
+    def _read_slot(self, offset):
+        """
+        :return: (key, value, ttl, expires) of a consistent slot state or None if slot is being written
+        """
+        buf = self._shm.buf
+        for _ in range(self.READ_RETRIES):
+            seq, key_len, value_len, ttl, expires = _SLOT_HEADER.unpack_from(buf, offset)
+            if seq & 1:
+                continue
+            start = offset + _SLOT_HEADER.size
+            key = bytes(buf[start:start + key_len])
+            value = bytes(buf[start + key_len:start + key_len + value_len])
+            if _SEQ.unpack_from(buf, offset)[0] == seq:
+                return key, value, ttl, expires
+        return None
+
+    def get(self, key: bytes):
+        """
+        :return: (wire response, original ttl, remaining ttl) of a fresh entry or None
+        """
+        now = time.time()
+        for _, offset in self._slot_offsets(key):
+            slot = self._read_slot(offset)
+            if slot is None:
+                continue
+            key_, value, ttl, expires = slot
+            if not key_:
+                break
+            if key_ == key:
+                if expires <= now:
+                    break
+                self.hits += 1
+                return value, ttl, expires - now
+        self.misses += 1
+        return None
+
+    def put(self, key: bytes, value: bytes, ttl, remaining=None):
+        if len(key) + len(value) > self.max_value or ttl <= 0:
+            return False
+        now = time.time()
+        expires = now + (ttl if remaining is None else remaining)
+        buf = self._shm.buf
+        target = None
+        for slot, offset in self._slot_offsets(key):
+            _, key_len, _, _, expires_ = _SLOT_HEADER.unpack_from(buf, offset)
+            if not key_len or expires_ <= now:
+                target = target or (slot, offset)
+                if not key_len:
+                    break
+                continue
+            start = offset + _SLOT_HEADER.size
+            if bytes(buf[start:start + key_len]) == key:
+                target = (slot, offset)
+                break
+        slot, offset = target or next(self._slot_offsets(key))
+        with self._locks[slot % len(self._locks)]:
+            seq = _SEQ.unpack_from(buf, offset)[0]
+            _SEQ.pack_into(buf, offset, seq + 1)
+            start = offset + _SLOT_HEADER.size
+            buf[start:start + len(key)] = key
+            buf[start + len(key):start + len(key) + len(value)] = value
+            _SLOT_HEADER.pack_into(buf, offset, seq + 1, len(key), len(value), ttl, expires)
+            _SEQ.pack_into(buf, offset, (seq + 2) & 0xFFFFFFFF)
+        return True
+
+    def expire(self, prefix: bytes = b''):
+        """
+        mark entries whose key starts with prefix (e.g. name part of key) as expired. scans whole table
+        :return: number of expired entries
+        """
+        now = time.time()
+        buf = self._shm.buf
+        count = 0
+        for slot in range(self.slots):
+            offset = slot * self.slot_size
+            start = offset + _SLOT_HEADER.size
+            _, key_len, _, _, expires = _SLOT_HEADER.unpack_from(buf, offset)
+            if not key_len or expires <= now or not bytes(buf[start:start + key_len]).startswith(prefix):
+                continue
+            # key is kept, so probe sequences which pass this slot are not cut
+            with self._locks[slot % len(self._locks)]:
+                seq, key_len, value_len, ttl, _ = _SLOT_HEADER.unpack_from(buf, offset)
+                _SEQ.pack_into(buf, offset, seq + 1)
+                _SLOT_HEADER.pack_into(buf, offset, seq + 1, key_len, value_len, ttl, 0)
+                _SEQ.pack_into(buf, offset, (seq + 2) & 0xFFFFFFFF)
+            count += 1
+        return count
+
+    def close(self):
+        self._shm.close()
+        if multiprocessing.current_process().pid == self._owner:
+            self._shm.unlink()
@@ -0,0 +1,234 @@
+import mmap
+import os
+import struct
+import time
+from abc import abstractmethod
+from typing import Iterable, List, Optional, Tuple
+
+from DNS.Logging import logger
+
+_INDEX_MAGIC = b'DNSPYIX1'
+_INDEX_HEADER = struct.Struct('!8sI')
+_OFFSET = struct.Struct('!I')
+_LENGTH = struct.Struct('!H')
+
+
+def reverse_name(name: str):
+    """
+    reverse labels of a domain name so that names of a zone sort next to each other (*.example.com -> com.example.*)
+    """
+    return '.'.join(reversed(name.split('.')))
+
+
+def read_source(path) -> Iterable[Tuple[str, str]]:
+    """
+    read index source file: one entry per line as "name" (for sets) or "name value" (for hashes, e.g.
+    "example.com 1.2.3.4;5.6.7.8"). lines starting with # are ignored
+    """
+    with open(path) as f_:
+        for line in f_:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            name, _, value = line.partition(' ')
+            yield name, value.strip()
+
+
+def compile_index(entries: Iterable[Tuple[str, str]], path):
+    """
+    write a sorted index of (name, value) entries to be memory mapped by IndexFile. file is written to a temporary
+    path and renamed, so running servers never see a partially written index
+    layout: header (magic, count) | offsets of records (uint32) | records (uint16 length + reversed name,
+            uint16 length + value) sorted by reversed name
+    """
+    records = {}
+    for name, value in entries:
+        records[reverse_name(name).encode()] = value.encode()
+    offsets = []
+    data = []
+    position = 0
+    for key in sorted(records.keys()):
+        value = records[key]
+        record = _LENGTH.pack(len(key)) + key + _LENGTH.pack(len(value)) + value
+        offsets.append(position)
+        data.append(record)
+        position += len(record)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f_:
+        f_.write(_INDEX_HEADER.pack(_INDEX_MAGIC, len(offsets)))
+        f_.writelines(_OFFSET.pack(x) for x in offsets)
+        f_.writelines(data)
+    os.replace(tmp_path, path)
+    logger.info(f'compiled {len(offsets)} entries into {path}')
+    return len(offsets)
+
+
+class IndexFile:
+    """
+    memory mapped index written by compile_index. lookups are binary searches over reversed names
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f_:
+            stat = os.fstat(f_.fileno())
+            self.identity = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            self._mmap = mmap.mmap(f_.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = _INDEX_HEADER.unpack_from(self._mmap, 0)
+        if magic != _INDEX_MAGIC:
+            self._mmap.close()
+            raise ValueError(f'{path} is not a compiled index')
+        self._data_start = _INDEX_HEADER.size + self.count * _OFFSET.size
+
+    @property
+    def nbytes(self):
+        return len(self._mmap)
+
+    def __len__(self):
+        return self.count
+
+    def _record(self, index):
+        data = self._mmap
+        offset = self._data_start + _OFFSET.unpack_from(data, _INDEX_HEADER.size + index * _OFFSET.size)[0]
+        key_len = _LENGTH.unpack_from(data, offset)[0]
+        offset += _LENGTH.size
+        return data, offset, key_len
+
+    def get(self, name: str) -> Optional[str]:
+        """
+        :return: value of name ('' for set entries) or None if name is not in index
+        """
+        key = reverse_name(name).encode()
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            data, offset, key_len = self._record(middle)
+            key_ = data[offset:offset + key_len]
+            if key_ < key:
+                low = middle + 1
+            elif key_ > key:
+                high = middle
+            else:
+                offset += key_len
+                value_len = _LENGTH.unpack_from(data, offset)[0]
+                offset += _LENGTH.size
+                return data[offset:offset + value_len].decode()
+        return None
+
+    def close(self):
+        self._mmap.close()
+
+
+class BaseStorage:
+    """
+    read only name lookups used by Authoritative plugins. method names and arguments follow redis commands
+    """
+
+    @abstractmethod
+    async def hget(self, key, field) -> Optional[str]:
+        """
+        :return: value of field (a domain name) in hash key or None
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    async def sismember(self, key, member) -> bool:
+        """
+        :return: whether member (a domain name) is in set key
+        """
+        raise NotImplementedError
+
+    async def hget_many(self, key, fields) -> List[Optional[str]]:
+        """
+        :return: values of fields in hash key (None for missing ones) in order of fields
+        """
+        return [await self.hget(key, x) for x in fields]
+
+    async def sismember_many(self, key, members) -> List[bool]:
+        """
+        :return: membership of each member in set key in order of members
+        """
+        return [await self.sismember(key, x) for x in members]
+
+    def close(self):
+        pass
+
+
+class RedisStorage(BaseStorage):
+    def __init__(self, redis):
+        """
+        :param redis: aioredis client or DNS.RedisTopology.RoutedRedis (reads are routed to replicas)
+        """
+        self.redis = redis
+
+    async def hget(self, key, field):
+        return await self.redis.hget(key, field)
+
+    async def sismember(self, key, member):
+        return await self.redis.sismember(key, member)
+
+    async def hget_many(self, key, fields):
+        if not fields:
+            return []
+        return await self.redis.hmget(key, fields)
+
+    async def sismember_many(self, key, members):
+        # one round trip for all members (SMISMEMBER needs redis 6.2)
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for member in members:
+                pipe.sismember(key, member)
+            return [bool(x) for x in await pipe.execute()]
+
+
+class FileStorage(BaseStorage):
+    """
+    storage backed by a compiled index file (see compile_index). file pages are shared between processes through
+    page cache. the file is checked for replacement at most every check_interval seconds and swapped atomically when
+    it changes
+    notes:
+        - key argument of lookups is ignored. each index file holds one list
+    """
+
+    def __init__(self, path, check_interval=1.):
+        self.path = path
+        self.check_interval = check_interval
+        self._index = IndexFile(path)
+        self._next_check = time.monotonic() + check_interval
+        logger.info(f'loaded index {path} with {len(self._index)} entries')
+
+    @property
+    def index(self) -> IndexFile:
+        now = time.monotonic()
+        if now >= self._next_check:
+            self._next_check = now + self.check_interval
+            self.reload()
+        return self._index
+
+    def reload(self, force=False):
+        try:
+            stat = os.stat(self.path)
+        except OSError as e:
+            logger.error(f'failed to check index {self.path} [{e}]')
+            return False
+        if not force and (stat.st_ino, stat.st_mtime_ns, stat.st_size) == self._index.identity:
+            return False
+        try:
+            index = IndexFile(self.path)
+        except (OSError, ValueError, struct.error) as e:
+            logger.error(f'failed to load index {self.path} [{e}]')
+            return False
+        old, self._index = self._index, index
+        old.close()
+        logger.info(f'reloaded index {self.path} with {len(index)} entries')
+        return True
+
+    # noinspection PyUnusedLocal
+    async def hget(self, key, field):
+        return self.index.get(field)
+
+    # noinspection PyUnusedLocal
+    async def sismember(self, key, member):
+        return self.index.get(member) is not None
+
+    def close(self):
+        self._index.close()
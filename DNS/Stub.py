@@ -0,0 +1,159 @@
+import asyncio
+import json
+import random
+import struct
+
+import dns.edns
+import dns.flags
+import dns.message
+import dns.rcode
+import dns.rdatatype
+
+import DNS.Utilities
+from DNS.Logging import logger
+
+
+class StubDNSServer(asyncio.protocols.DatagramProtocol):
+    """
+    minimal in-process authoritative DNS server. can be used as upstream for tests and benchmarks
+    notes:
+        - zone is a dict of domains (without trailing dot) to list of ips (e.g.: {example.com: [ip1, ip2, ...]})
+        - currently just supports "A" type question and response
+        - any other name is answered with NXDOMAIN
+        - upstream misbehaviour can be injected: latency (+ random jitter) before answering and rate [0-1] of
+          lost, truncated (TC flag without answer) and SERVFAIL responses
+        - start_stream() additionally serves length framed queries over tcp or tls (RFC 7766/7858). queries of a
+          connection are answered as soon as each is ready, so with jitter they are answered out of order
+        - with ecs_scope, EDNS client subnet of queries is echoed back with that scope prefix (like a geo aware CDN).
+          received subnets are kept in subnets
+    """
+    transport: asyncio.transports.DatagramTransport = None
+    stream_server: asyncio.AbstractServer = None
+
+    def __init__(self, zone=None, local_ip='127.0.0.1', local_port=0, ttl=300, latency=0., jitter=0., loss=0.,
+                 truncation=0., servfail=0., seed=None, ecs_scope=None):
+        self.zone = {k.lower().rstrip('.'): v for k, v in (zone or {}).items()}
+        self.local_addr = (local_ip, local_port)
+        self.ttl = ttl
+        self.latency = latency
+        self.jitter = jitter
+        self.loss = loss
+        self.truncation = truncation
+        self.servfail = servfail
+        self.random = random.Random(seed)
+        self.ecs_scope = ecs_scope
+        self.subnets = []
+        self.received = 0
+        self.stream_connections = 0
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """
+        create stub server from a zone file. file can be a json dict in zone format or a text file with one
+        record per line as "domain ip1 ip2 ..." (lines starting with # are ignored)
+        """
+        with open(path) as f_:
+            content = f_.read()
+        if path.endswith('.json'):
+            return cls(json.loads(content), **kwargs)
+        zone = {}
+        for line in content.splitlines():
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            name, *addresses = line.split()
+            zone.setdefault(name, []).extend(addresses)
+        return cls(zone, **kwargs)
+
+    @property
+    def address(self):
+        return self.transport.get_extra_info('sockname')[:2]
+
+    def factory(self):
+        return self
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def _schedule(self, reply, data, peer):
+        self.received += 1
+        if self.loss and self.random.random() < self.loss:
+            logger.debug(f'stub upstream dropping query from {peer}')
+            return
+        delay = self.latency + (self.random.uniform(0, self.jitter) if self.jitter else 0.)
+        if delay > 0:
+            asyncio.get_event_loop().call_later(delay, reply, data, peer)
+        else:
+            reply(data, peer)
+
+    def datagram_received(self, data, addr):
+        self._schedule(self._reply, data, addr)
+
+    def _reply(self, data, addr):
+        if not self.transport.is_closing():
+            self.transport.sendto(self.answer(data), addr)
+
+    async def _handle_stream(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        def _reply(data, _):
+            if not writer.is_closing():
+                wire = self.answer(data)
+                writer.write(struct.pack('!H', len(wire)) + wire)
+
+        self.stream_connections += 1
+        peer = writer.get_extra_info('peername')
+        try:
+            while True:
+                length = struct.unpack('!H', await reader.readexactly(2))[0]
+                self._schedule(_reply, await reader.readexactly(length), peer)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    @property
+    def stream_address(self):
+        return self.stream_server.sockets[0].getsockname()[:2]
+
+    async def start_stream(self, ssl=None):
+        """
+        :param ssl: ssl.SSLContext to serve DNS over TLS. plain tcp if None
+        """
+        self.stream_server = await asyncio.start_server(self._handle_stream, *self.local_addr, ssl=ssl)
+        logger.info(f'stub upstream started on {self.stream_address} [{"tls" if ssl else "tcp"}]')
+
+    def answer(self, data):
+        query = dns.message.from_wire(data)
+        resp = dns.message.make_response(query)
+        if self.servfail and self.random.random() < self.servfail:
+            resp.set_rcode(dns.rcode.SERVFAIL)
+            return resp.to_wire()
+        if self.truncation and self.random.random() < self.truncation:
+            resp.flags |= dns.flags.TC
+            return resp.to_wire()
+        ecs = next((x for x in query.options if x.otype == dns.edns.ECS), None)
+        if ecs is not None:
+            self.subnets.append(f'{ecs.address}/{ecs.srclen}')
+            if self.ecs_scope is not None:
+                resp.use_edns(0, resp.ednsflags, resp.payload,
+                              options=[dns.edns.ECSOption(ecs.address, ecs.srclen, min(self.ecs_scope, ecs.srclen))])
+        for q_ in query.question:
+            addresses = self.zone.get(q_.name.to_text(True).lower())
+            if addresses is None:
+                resp.set_rcode(dns.rcode.NXDOMAIN)
+                continue
+            if q_.rdtype == dns.rdatatype.A:
+                resp.answer.append(DNS.Utilities.create_rrset(dns.rdatatype.A, q_.name, addresses=addresses,
+                                                              ttl=self.ttl))
+        return resp.to_wire()
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.transport, _ = await loop.create_datagram_endpoint(self.factory, local_addr=self.local_addr)
+        logger.info(f'stub upstream started on {self.address}')
+
+    async def stop(self):
+        self.transport.close()
+        if self.stream_server is not None:
+            self.stream_server.close()
+            await self.stream_server.wait_closed()
+        logger.info('stub upstream stopped')
@@ -0,0 +1,161 @@
+import contextvars
+import cProfile
+import os
+import random
+import time
+
+from DNS.Logging import logger
+
+_current_trace = contextvars.ContextVar('dnspy_trace', default=None)
+
+
+class _Span:
+    __slots__ = ('trace', 'name', 'start')
+
+    def __init__(self, trace, name):
+        self.trace = trace
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        end = time.perf_counter()
+        self.trace.spans.append((self.name, self.start - self.trace.start, end - self.start))
+        return False
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Trace:
+    """
+    spans recorded for a single query. spans are (name, offset from query start, duration) tuples in seconds
+    """
+    __slots__ = ('name', 'start', 'end', 'spans', '_token')
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.perf_counter()
+        self.end = None
+        self.spans = []
+        self._token = None
+
+    @property
+    def duration(self):
+        return (self.end or time.perf_counter()) - self.start
+
+    def span(self, name):
+        return _Span(self, name)
+
+    def breakdown(self):
+        return ', '.join(f'{x[0]} @{x[1] * 1e3:.2f}ms: {x[2] * 1e3:.2f}ms' for x in self.spans)
+
+
+def current():
+    """
+    trace of current query or None
+    """
+    return _current_trace.get()
+
+
+def span(name):
+    """
+    record a span in trace of current query. no-op if current query is not traced
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return _NULL_SPAN
+    return trace.span(name)
+
+
+class Tracer:
+    """
+    create per query traces and report slow queries with their spans breakdown
+    """
+
+    def __init__(self, enabled=False, slow_threshold=0.1, sample_rate=1.):
+        self.enabled = enabled
+        self.slow_threshold = slow_threshold
+        self.sample_rate = sample_rate
+
+    def start(self, name):
+        if not self.enabled:
+            return None
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return None
+        trace = Trace(name)
+        trace._token = _current_trace.set(trace)
+        return trace
+
+    def finish(self, trace):
+        if trace is None:
+            return
+        trace.end = time.perf_counter()
+        _current_trace.reset(trace._token)
+        if trace.duration >= self.slow_threshold:
+            logger.warning(f'slow query {trace.name}: {trace.duration * 1e3:.2f}ms | {trace.breakdown()}')
+
+
+class Profiler:
+    """
+    process wide profiler which can be toggled at runtime. uses yappi (coroutine aware) if installed, otherwise
+    cProfile. stats are dumped in pstats format into output directory when profiling stops
+    """
+
+    def __init__(self, output_dir='.'):
+        self.output_dir = output_dir
+        self._profile = None
+        try:
+            import yappi
+            self._yappi = yappi
+        except ImportError:
+            self._yappi = None
+
+    @property
+    def active(self):
+        return self._profile is not None
+
+    def start(self):
+        if self.active:
+            return
+        if self._yappi:
+            self._yappi.set_clock_type('wall')
+            self._yappi.start()
+            self._profile = self._yappi
+        else:
+            self._profile = cProfile.Profile()
+            self._profile.enable()
+        logger.warning('profiling started')
+
+    def stop(self):
+        if not self.active:
+            return None
+        path = os.path.join(self.output_dir, f'dnspy-{os.getpid()}-{int(time.time())}.prof')
+        if self._yappi:
+            self._yappi.stop()
+            self._yappi.get_func_stats().save(path, type='pstat')
+            self._yappi.clear_stats()
+        else:
+            self._profile.disable()
+            self._profile.dump_stats(path)
+        self._profile = None
+        logger.warning(f'profiling stopped. stats written to {path}')
+        return path
+
+    def toggle(self):
+        if self.active:
+            return self.stop()
+        self.start()
+        return None
@@ -0,0 +1,206 @@
+import asyncio
+import itertools
+import ssl
+import struct
+from typing import Dict
+
+import dns.asyncquery
+import dns.exception
+import dns.message
+
+from DNS.Logging import logger
+
+_LENGTH = struct.Struct('!H')
+_ID = struct.Struct('!H')
+
+
+class Health:
+    """
+    outcome and latency of queries sent to upstream
+    """
+
+    def __init__(self):
+        self.queries = 0
+        self.failures = 0
+        # smoothed round trip of successful queries in seconds
+        self.latency = None
+        self.last_error = None
+
+    def success(self, elapsed):
+        self.queries += 1
+        self.latency = elapsed if self.latency is None else self.latency * 0.9 + elapsed * 0.1
+
+    def failure(self, error):
+        self.queries += 1
+        self.failures += 1
+        self.last_error = f'{error.__class__.__name__}: {error}'
+
+    def state(self):
+        return {'queries': self.queries, 'failures': self.failures,
+                'latency_ms': None if self.latency is None else round(self.latency * 1e3, 3),
+                'last_error': self.last_error}
+
+
+class UDPUpstream:
+    """
+    plain udp upstream. a new socket is used for each query
+    """
+
+    def __init__(self, ip, port=53, timeout=2.):
+        self.ip = ip
+        self.port = port
+        self.timeout = timeout
+
+    async def query(self, query: dns.message.Message) -> dns.message.Message:
+        return await dns.asyncquery.udp(query, self.ip, port=self.port, timeout=self.timeout)
+
+    def state(self):
+        return {'transport': 'udp', 'address': f'{self.ip}:{self.port}'}
+
+    async def close(self):
+        pass
+
+
+class _TLSConnection:
+    """
+    a long lived tls connection carrying many length framed queries at once. queries get a connection unique id on
+    wire and responses are matched back to their query by id, in any order
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+        self.pending: Dict[int, asyncio.Future] = {}
+        self._ids = itertools.cycle(range(1, 0x10000))
+        self._reader_task = asyncio.get_running_loop().create_task(self._read_loop())
+        self.closed = False
+
+    def _next_id(self):
+        for _ in range(0x10000):
+            id_ = next(self._ids)
+            if id_ not in self.pending:
+                return id_
+        raise dns.exception.DNSException('too many queries in flight on upstream connection')
+
+    async def _read_loop(self):
+        error = None
+        try:
+            while True:
+                length = _LENGTH.unpack(await self.reader.readexactly(_LENGTH.size))[0]
+                wire = await self.reader.readexactly(length)
+                future = self.pending.pop(_ID.unpack_from(wire, 0)[0], None)
+                if future is not None and not future.done():
+                    future.set_result(wire)
+        except (asyncio.IncompleteReadError, OSError, struct.error) as e:
+            error = e
+        finally:
+            self.close()
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(ConnectionError(f'upstream connection closed [{error}]'))
+            self.pending.clear()
+
+    async def query(self, wire: bytes, timeout):
+        if self.closed:
+            raise ConnectionError('upstream connection is closed')
+        id_ = self._next_id()
+        future = asyncio.get_running_loop().create_future()
+        self.pending[id_] = future
+        try:
+            self.writer.write(_LENGTH.pack(len(wire)) + _ID.pack(id_) + wire[_ID.size:])
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending.pop(id_, None)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.writer.close()
+            if asyncio.current_task() is not self._reader_task:
+                self._reader_task.cancel()
+
+
+class TLSUpstream:
+    """
+    DNS over TLS upstream (RFC 7858) with a pool of persistent pipelined connections
+    notes:
+        - each query goes to the connection of pool with the fewest queries in flight, so handshake cost is shared by
+          all queries sent over a connection's lifetime
+        - closed connections (idle timeout of upstream, errors) are reopened on demand. queries in flight on them fail
+          with ConnectionError
+        - asyncio doesn't expose tls session resumption, so a reopened connection does a full handshake
+    """
+
+    def __init__(self, ip, port=853, server_hostname=None, pool_size=2, timeout=2., ca_file=None):
+        self.ip = ip
+        self.port = port
+        self.server_hostname = server_hostname or ip
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.ssl_context = ssl.create_default_context(cafile=ca_file)
+        self._connections: list = [None] * pool_size
+        self._connecting: list = [None] * pool_size
+        self.connects = 0
+
+    async def _connect(self, slot):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(self.ip, self.port, ssl=self.ssl_context, server_hostname=self.server_hostname),
+            self.timeout
+        )
+        self.connects += 1
+        logger.info(f'connected to tls upstream {self.ip}:{self.port} [slot {slot}]')
+        connection = self._connections[slot] = _TLSConnection(reader, writer)
+        return connection
+
+    async def _connection(self) -> _TLSConnection:
+        live = [x for x in self._connections if x is not None and not x.closed]
+        if len(live) == self.pool_size:
+            return min(live, key=lambda x: len(x.pending))
+        slot = next(i_ for i_, x in enumerate(self._connections) if x is None or x.closed)
+        task = self._connecting[slot]
+        if task is None:
+            task = self._connecting[slot] = asyncio.get_running_loop().create_task(self._connect(slot))
+            task.add_done_callback(lambda _: self._connecting.__setitem__(slot, None))
+        if live and not task.done():
+            # don't wait for handshake if another connection is open
+            return min(live, key=lambda x: len(x.pending))
+        return await asyncio.shield(task)
+
+    async def query(self, query: dns.message.Message) -> dns.message.Message:
+        wire = query.to_wire()
+        try:
+            connection = await self._connection()
+            resp = await connection.query(wire, self.timeout)
+        except asyncio.TimeoutError:
+            raise dns.exception.Timeout(timeout=self.timeout)
+        except ssl.SSLError as e:
+            raise ConnectionError(f'tls upstream error [{e}]')
+        resp = dns.message.from_wire(wire[:_ID.size] + resp[_ID.size:])
+        if not query.is_response(resp):
+            raise dns.exception.FormError('upstream response does not match query')
+        return resp
+
+    def state(self):
+        live = [x for x in self._connections if x is not None and not x.closed]
+        return {'transport': 'tls', 'address': f'{self.ip}:{self.port}', 'connections': len(live),
+                'pool_size': self.pool_size, 'in_flight': sum(len(x.pending) for x in live), 'connects': self.connects}
+
+    async def close(self):
+        for task in self._connecting:
+            if task is not None:
+                task.cancel()
+        for connection in self._connections:
+            if connection is not None:
+                connection.close()
+
+
+def create(settings):
+    """
+    create upstream client of configured transport
+    """
+    ip = settings.upstream_ip.__str__()
+    if settings.upstream_transport == 'tls':
+        return TLSUpstream(ip, settings.upstream_port, server_hostname=settings.upstream_tls_hostname,
+                           pool_size=settings.upstream_tls_pool_size, timeout=settings.upstream_timeout,
+                           ca_file=settings.upstream_tls_ca_file)
+    return UDPUpstream(ip, settings.upstream_port, timeout=settings.upstream_timeout)
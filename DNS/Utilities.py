@@ -1,6 +1,6 @@
 import asyncio
-import copy
 
+import dns.name
 import dns.rdtypes
 import dns.rdtypes.IN.A
 
@@ -42,16 +42,25 @@ def _create_rrset_a(name: str, addresses: list, ttl):
     return resp
 
 
-async def async_iterative_lookup(name, func, tailing_dot=False):
-    _name = copy.deepcopy(name)
-    search = _name.to_text((not tailing_dot))
-    while True:
+def iterative_candidates(name, tailing_dot=False):
+    """
+    names to look up for a domain name from the most specific one: the name itself and then wildcard of each parent
+    (e.g.: a.example.com -> a.example.com, *.example.com, *.com, *.)
+    """
+    yield name.to_text((not tailing_dot))
+    while name != dns.name.root:
+        name = name.parent()
+        yield '*.' + name.to_text((not tailing_dot))
+
+
+async def async_iterative_lookup(name, func, tailing_dot=False, candidates=None):
+    result = None
+    search = None
+    for search in candidates if candidates is not None else iterative_candidates(name, tailing_dot):
         result = await func(search)
-        if _name == dns.name.root or result:
-            logger.debug(f'result for {name.to_text()} at {search} : {result}')
+        if result:
             break
-        _name = _name.parent()
-        search = '*.' + _name.to_text((not tailing_dot))
+    logger.debug(f'result for {name.to_text()} at {search} : {result}')
     return result
 
 
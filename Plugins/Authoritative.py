@@ -1,9 +1,10 @@
-import copy
+import asyncio
 from abc import abstractmethod
 from ipaddress import IPv4Address
 from typing import Optional, List
 
 import aioredis
+import aioredis.exceptions
 import dns.message
 import dns.rdtypes.ANY.CNAME
 import dns.rdtypes.IN.A
@@ -11,7 +12,13 @@ import dns.rrset
 from pydantic import Field
 from pydantic import RedisDsn
 
+import DNS.Bloom
 import DNS.Config
+import DNS.Context
+import DNS.Memory
+import DNS.RedisTopology
+import DNS.Storage
+import DNS.Tracing
 import DNS.Utilities
 from DNS.Logging import logger
 from Plugins.Base import BasePlugin
@@ -20,35 +27,290 @@ from Plugins.Base import BasePlugin
 # todo: cname response support [for A type request]
 
 CONFIG = {
-    'redis_uri': (RedisDsn, Field(title='redis server uri')),
-    'default_ttl': (int, Field(title='default ttl to assign to the answers', default=0))
+    'redis_uri': (Optional[RedisDsn], Field(title='redis server uri. required by plugins with redis storage',
+                                             default=None)),
+    'redis_topology': (
+        str,
+        Field(title='single: only redis_uri. replica: redis_uri is primary, reads are routed to its replicas. '
+                    'sentinel: primary and replicas of redis_sentinel_service are discovered from redis_sentinels. '
+                    'cluster: redis_uri is a seed node of a redis cluster', default='single',
+              regex='^(single|replica|sentinel|cluster)$')
+    ),
+    'redis_replicas': (
+        List[str],
+        Field(title='"host:port" of replicas of redis_uri [replica topology]. replicas reported by primary are used '
+                    'too', default=[])
+    ),
+    'redis_sentinels': (List[str], Field(title='"host:port" of sentinels [sentinel topology]', default=[])),
+    'redis_sentinel_service': (str, Field(title='service name of primary [sentinel topology]', default='mymaster')),
+    'redis_read_from': (
+        str,
+        Field(title='node to read from: primary, replica (lowest latency one) or nearest (lowest latency node). '
+                    'writes always go to primary', default='nearest', regex='^(primary|replica|nearest)$')
+    ),
+    'redis_refresh_interval': (
+        float,
+        Field(title='seconds between topology discovery and latency checks of redis nodes', default=10., gt=0)
+    ),
+    'index_check_interval': (
+        float, Field(title='seconds between checks of index files for replacement [file storage]', default=1., gt=0)
+    ),
+    'default_ttl': (int, Field(title='default ttl to assign to the answers', default=0)),
+    'bloom_filter': (
+        bool,
+        Field(title='keep a bloom filter of redis keys in memory to skip redis lookups for names which are not listed',
+              default=False)
+    ),
+    'bloom_error_rate': (float, Field(title='false positive rate of bloom filter', default=0.01, gt=0, lt=1)),
+    'bloom_check_interval': (
+        float,
+        Field(title='seconds between checks of redis key for changes (cardinality and "<key>:version"). filter is '
+                    'bypassed from a detected change until it is rebuilt', default=1., gt=0)
+    ),
 }
 
 
 class _Authoritative(BasePlugin):
+    # redis scan method to read all names of redis_key_A for bloom filter. None if plugin doesn't support filter
+    FILTER_SOURCE: Optional[str] = None
+    # storage method to look names of redis_key_A up with (and its batch variant "<LOOKUP>_many")
+    LOOKUP: Optional[str] = None
+    _redis_owned = False
+
     def _init_redis(self, redis=None):
-        return redis or aioredis.from_url(self.config.redis_uri, encoding="utf-8", decode_responses=True)
+        if redis is not None:
+            return redis
+        # plugins without topology config (e.g. Google403.Inquirer) connect to redis_uri only
+        topology = getattr(self.config, 'redis_topology', DNS.RedisTopology.SINGLE)
+        if self.config.redis_uri is None and topology != DNS.RedisTopology.SENTINEL:
+            if self.storage_type == 'redis':
+                raise ValueError(f'redis_uri is required by {self.__class__.__name__} with redis storage')
+            return None
+        if topology == DNS.RedisTopology.SINGLE:
+            return aioredis.from_url(self.config.redis_uri, encoding="utf-8", decode_responses=True)
+        self._redis_owned = True
+        return DNS.RedisTopology.RoutedRedis(DNS.RedisTopology.RedisTopology(
+            self.config.redis_uri, topology, replicas=self.config.redis_replicas,
+            sentinels=self.config.redis_sentinels, service=self.config.redis_sentinel_service,
+            read_from=self.config.redis_read_from, refresh_interval=self.config.redis_refresh_interval
+        ))
+
+    def _init_storage(self) -> DNS.Storage.BaseStorage:
+        if self.storage_type == 'file':
+            if not self.config.index_path:
+                raise ValueError(f'index_path is required by {self.__class__.__name__} with file storage')
+            return DNS.Storage.FileStorage(self.config.index_path, self.config.index_check_interval)
+        return DNS.Storage.RedisStorage(self.redis)
 
     def __init__(self, *args, **kwargs):
         super(_Authoritative, self).__init__(*args, **kwargs)
-        self.redis = self._init_redis(kwargs.get('redis', None))
+        self._redis = self._init_redis(kwargs.get('redis', None))
+        self.storage = self._init_storage()
+        self.filter: Optional[DNS.Bloom.BloomFilter] = None
+        # names added while filters are being built. applied to each new filter when its build is finished
+        self._filter_pending: List[list] = []
+        self._filter_task = None
+        if self.FILTER_SOURCE and self.config.bloom_filter and self.storage_type == 'redis':
+            self._filter_task = asyncio.get_event_loop().create_task(self._filter_loop())
+
+    @property
+    def storage_type(self):
+        # plugins without storage config (e.g. Google403.Inquirer) always use redis
+        return getattr(self.config, 'storage', 'redis')
+
+    @property
+    def redis(self):
+        return self._redis
+
+    @redis.setter
+    def redis(self, value):
+        self._redis = value
+        if isinstance(getattr(self, 'storage', None), DNS.Storage.RedisStorage):
+            self.storage.redis = value
+
+    @property
+    def filter_version_key(self):
+        """
+        writers which replace names of redis_key_A without changing its cardinality should INCR this key
+        """
+        return f'{self.config.redis_key_A}:version'
+
+    async def _filter_state(self):
+        key = self.config.redis_key_A
+        count = await (self.redis.hlen(key) if self.FILTER_SOURCE == 'hscan_iter' else self.redis.scard(key))
+        return count, await self.redis.get(self.filter_version_key)
+
+    async def _filter_loop(self):
+        state = None
+        while True:
+            try:
+                state_ = await self._filter_state()
+                if state_ != state:
+                    if state is not None:
+                        logger.info(f'{self.config.redis_key_A} changed. bypassing bloom filter until rebuilt')
+                        self.filter = None
+                    await self.rebuild_filter(state_[0])
+                    state = state_
+            except (aioredis.exceptions.RedisError, OSError) as e:
+                logger.error(f'failed to build bloom filter of {self.config.redis_key_A} [{e}]')
+            await asyncio.sleep(self.config.bloom_check_interval)
+
+    @staticmethod
+    def filter_capacity(count):
+        # headroom for names added until the next rebuild
+        return max(int(count * 1.25), 1024)
+
+    async def rebuild_filter(self, count=None):
+        """
+        build a new bloom filter from all names in redis_key_A and swap it with current one. names are hashed in
+        executor batch by batch so that event loop is not stalled by large lists
+        """
+        key = self.config.redis_key_A
+        if count is None:
+            count = (await self._filter_state())[0]
+        filter_ = DNS.Bloom.BloomFilter(self.filter_capacity(count), self.config.bloom_error_rate)
+        loop = asyncio.get_running_loop()
+        pending = []
+        self._filter_pending.append(pending)
+        try:
+            batch = []
+            async for i_ in getattr(self.redis, self.FILTER_SOURCE)(key, count=10000):
+                batch.append(i_[0] if isinstance(i_, tuple) else i_)
+                if len(batch) >= 10000:
+                    await loop.run_in_executor(None, filter_.update, batch)
+                    batch = []
+            await loop.run_in_executor(None, filter_.update, batch)
+            filter_.update(pending)
+        finally:
+            self._filter_pending.remove(pending)
+        self.filter = filter_
+        logger.info(f'bloom filter of {key} rebuilt with {filter_.count} names [{filter_.nbytes} bytes]')
+
+    async def reload_lists(self):
+        """
+        apply list changes now instead of at next change check: index file is reloaded [file storage] and bloom filter
+        is rebuilt [redis storage]
+        :return: summary of what was reloaded
+        """
+        if isinstance(self.storage, DNS.Storage.FileStorage):
+            return {'index': self.storage.path, 'reloaded': self.storage.reload(force=True),
+                    'names': len(self.storage.index)}
+        if self.FILTER_SOURCE and self.config.bloom_filter:
+            await self.rebuild_filter()
+            return {'key': self.config.redis_key_A, 'reloaded': True, 'names': self.filter.count}
+        return {'key': self.config.redis_key_A, 'reloaded': False}
+
+    def _drop_filter(self, nbytes):
+        filter_, self.filter = self.filter, None
+        if filter_ is None:
+            return 0
+        logger.warning(f'bloom filter of {self.config.redis_key_A} dropped to free memory. it is rebuilt when the key '
+                       f'changes or lists are reloaded')
+        return filter_.nbytes
+
+    def memory_components(self):
+        """
+        bloom filter (dropped when shrunk, lookups go to redis until it is rebuilt) and index file [file storage]
+        """
+        components = {}
+        if self._filter_task is not None:
+            components['filter'] = DNS.Memory.Component(lambda: self.filter.nbytes if self.filter is not None else 0,
+                                                        self._drop_filter, DNS.Memory.PRIORITY_INDEX)
+        if isinstance(self.storage, DNS.Storage.FileStorage):
+            components['index'] = DNS.Memory.Component(lambda: self.storage.index.nbytes,
+                                                       priority=DNS.Memory.PRIORITY_INDEX)
+        return components
+
+    def add_to_filter(self, *names):
+        """
+        add names which are added to redis_key_A to bloom filter, so they are visible before next rebuild
+        """
+        if self.filter is not None:
+            self.filter.update(names)
+        for pending in self._filter_pending:
+            pending.extend(names)
+
+    async def close(self):
+        if self._filter_task:
+            self._filter_task.cancel()
+            self._filter_task = None
+        self.storage.close()
+        # routed clients refresh topology in background
+        if self._redis_owned:
+            await self.redis.close()
+
+    def _filter_candidates(self, key, candidates):
+        """
+        :return: candidates to look up in key. the ones which are surely not listed are dropped if key has a bloom
+            filter
+        """
+        if self.filter is not None and key == self.config.redis_key_A:
+            return [x for x in candidates if x in self.filter]
+        return list(candidates)
+
+    async def lookup(self, key, candidates, func):
+        """
+        :param candidates: names to look up in order (e.g. QueryContext.suffixes)
+        :return: value of the first listed candidate or None
+        """
+        candidates = list(candidates)
+        name = candidates[0]
+        candidates = self._filter_candidates(key, candidates)
+        if not candidates:
+            logger.debug(f'{name} is not in bloom filter of {key}')
+            return None
+        logger.info(f'iterative lookup for {name} in {key} using {func} in {self.storage_type}')
+        with DNS.Tracing.span(f'{self.storage_type} {func} {key}'):
+            for candidate in candidates:
+                result = await getattr(self.storage, func)(key, candidate)
+                if result:
+                    return result
+        return None
 
     async def redis_iterative_lookup(self, key, name, func):
-        def _function(x):
-            return getattr(self.redis, func)(key, x)
+        return await self.lookup(key, DNS.Utilities.iterative_candidates(name), func)
+
+    async def batch_lookup(self, key, candidates_list, func):
+        """
+        lookup of many names with a single storage call. all candidates of all names (shared parents like *.com are
+        looked up once) are fetched at once instead of stopping at the first match
+        :return: result of each candidates list in order
+        """
+        candidates_list = [self._filter_candidates(key, x) for x in candidates_list]
+        unique = list(dict.fromkeys(x for c_ in candidates_list for x in c_))
+        if not unique:
+            return [None] * len(candidates_list)
+        logger.info(f'batch lookup for {len(candidates_list)} names in {key} using {func} in {self.storage_type}')
+        with DNS.Tracing.span(f'{self.storage_type} {func} batch {key}'):
+            values = dict(zip(unique, await getattr(self.storage, f'{func}_many')(key, unique)))
+        return [next((values[x] for x in c_ if values[x]), None) for c_ in candidates_list]
 
-        logger.info(f'iterative lookup for {name} in {key} using {func} in redis')
-        result = await DNS.Utilities.async_iterative_lookup(name, _function)
-        return result
+    def _answer(self, context: DNS.Context.QueryContext, result):
+        """
+        answer query of context (or leave it to upstream) according to lookup result of its name
+        """
+        raise NotImplementedError
 
     @staticmethod
-    def _manual_answer(questions, q, answers, a):
-        questions.remove(q)
-        answers.append(a)
+    def _applies(context: DNS.Context.QueryContext):
+        return context.qtype == dns.rdatatype.A and context.pending
 
-    @abstractmethod
-    async def before_resolve(self, query, response, *args, **kwargs):
-        return query, response
+    async def on_query(self, context):
+        if self._applies(context):
+            self._answer(context, await self.lookup(self.config.redis_key_A, context.suffixes, self.LOOKUP))
+
+    async def on_query_batch(self, contexts):
+        contexts = [x for x in contexts if self._applies(x)]
+        results = await self.batch_lookup(self.config.redis_key_A, [x.suffixes for x in contexts], self.LOOKUP)
+        for context, result in zip(contexts, results):
+            self._answer(context, result)
+
+    async def before_resolve(self, query, response, address=None, *args, **kwargs):
+        # message based api (first question only)
+        context = DNS.Context.QueryContext(query, address)
+        context.response = response
+        await self.on_query(context)
+        return context.query, context.response
 
     @abstractmethod
     async def after_resolve(self, query, response, *args, **kwargs):
@@ -60,28 +322,29 @@ class LocalDB(_Authoritative):
     """
     queries domain name from redis DB and response respectively. doesn't touch anything if answer not in local DB
     notes:
-        - data should be stored in redis db in a hash (e.g.: {example.com: ip1;ip2;...})
+        - data should be stored in redis db in a hash (e.g.: {example.com: ip1;ip2;...}) or in a compiled index file
+          with file storage (source lines like "example.com ip1;ip2")
         - currently just supports "A" type question and response
         - domains should be stored in db without trailing dot
         - subdomain wildcard is supported (e.g. *.google.com)
     """
+    FILTER_SOURCE = 'hscan_iter'
+    LOOKUP = 'hget'
+    BATCH = True
 
     CONFIG = {
         'redis_key_A': (str, Field(title='key to read resolve data from redis server [hash]', default='LocalDB')),
+        'storage': (str, Field(title='backend to read resolve data from [redis|file]', default='redis',
+                               regex='^(redis|file)$')),
+        'index_path': (Optional[str], Field(title='compiled index of resolve data (see Server.py --compile-index) '
+                                                  '[file storage]', default=None)),
     }
 
-    async def before_resolve(self, query, response, *args, **kwargs):
-        ttl = self.config.default_ttl
-        redis_key = self.config.redis_key_A
-        for q_ in query.question:
-            if q_.rdtype == dns.rdatatype.A:
-                name = q_.name
-                result = await self.redis_iterative_lookup(redis_key, name, 'hget')
-                if result:
-                    logger.info(f'found local record for {q_.to_text()} : {result}')
-                    r_ = DNS.Utilities.create_rrset(dns.rdatatype.A, q_.name, addresses=result.split(';'), ttl=ttl)
-                    self._manual_answer(query.question, q_, response.answer, r_)
-        return query, response
+    def _answer(self, context, result):
+        if result:
+            logger.info(f'found local record for {context.qname} : {result}')
+            context.answer(DNS.Utilities.create_rrset(dns.rdatatype.A, context.query.question[0].name,
+                                                      addresses=result.split(';'), ttl=self.config.default_ttl))
 
     async def after_resolve(self, query, response, *args, **kwargs):
         return query, response
@@ -92,13 +355,22 @@ class BlackList(_Authoritative):
     doesn't touch any questions except some hosts defined in redis db (as blacklisted) which will resolve
     to predefined ip
     notes:
-        - blacklisted domains should be stored in redis db in a set (e.g.: [example.com,*.example.com,...])
+        - blacklisted domains should be stored in redis db in a set (e.g.: [example.com,*.example.com,...]) or in a
+          compiled index file with file storage
         - currently just supports "A" type question and response
         - subdomain wildcard is supported (e.g. *.google.com)
     """
 
+    FILTER_SOURCE = 'sscan_iter'
+    LOOKUP = 'sismember'
+    BATCH = True
+
     CONFIG = {
         'redis_key_A': (str, Field(title='key to read blacklisted domains from redis server [set]', default='BLDB')),
+        'storage': (str, Field(title='backend to read blacklisted domains from [redis|file]', default='redis',
+                               regex='^(redis|file)$')),
+        'index_path': (Optional[str], Field(title='compiled index of blacklisted domains (see Server.py --compile-index) '
+                                                  '[file storage]', default=None)),
         'response_ip': (List[IPv4Address], Field(title='ips to response for blacklisted domains')),
         'ttl': (
             Optional[int],
@@ -106,22 +378,16 @@ class BlackList(_Authoritative):
         )
     }
 
-    async def before_resolve(self, query, response, *args, **kwargs):
-        redis_key = self.config.redis_key_A
+    def __init__(self, *args, **kwargs):
+        super(BlackList, self).__init__(*args, **kwargs)
         default_ip = [x.__str__() for x in self.config.response_ip]
         ttl = self.config.ttl or self.config.default_ttl
-        rrset = DNS.Utilities.create_rrset(dns.rdatatype.A, '_', addresses=default_ip, ttl=ttl)
-        for q_ in query.question:
-            if q_.rdtype == dns.rdatatype.A:
-                name = q_.name
-                result = await self.redis_iterative_lookup(redis_key, name, 'sismember')
-                if not result:
-                    continue
-                logger.info(f'{name.to_text()} is black listed. modifying ...')
-                rrset_ = copy.deepcopy(rrset)
-                rrset_.name = q_.name
-                self._manual_answer(query.question, q_, response.answer, rrset_)
-        return query, response
+        self.rrset = DNS.Utilities.create_rrset(dns.rdatatype.A, '_', addresses=default_ip, ttl=ttl)
+
+    def _answer(self, context, result):
+        if result:
+            logger.info(f'{context.qname} is black listed. modifying ...')
+            context.answer(self.rrset.copy())
 
     async def after_resolve(self, query, response, *args, **kwargs):
         return query, response
@@ -132,13 +398,22 @@ class WhiteList(_Authoritative):
     response all questions with predefined ip except some hosts defined in redis db (as whitelisted)
     which will be untouched
     notes:
-        - whitelisted domains should be stored in redis db in a set (e.g.: [example.com,*.example.com,...])
+        - whitelisted domains should be stored in redis db in a set (e.g.: [example.com,*.example.com,...]) or in a
+          compiled index file with file storage
         - currently just supports "A" type question and response
         - subdomain wildcard is supported (e.g. *.google.com)
     """
 
+    FILTER_SOURCE = 'sscan_iter'
+    LOOKUP = 'sismember'
+    BATCH = True
+
     CONFIG = {
         'redis_key_A': (str, Field(title='key to read whitelisted domains from redis server [set]', default='WLDB')),
+        'storage': (str, Field(title='backend to read whitelisted domains from [redis|file]', default='redis',
+                               regex='^(redis|file)$')),
+        'index_path': (Optional[str], Field(title='compiled index of whitelisted domains (see Server.py --compile-index) '
+                                                  '[file storage]', default=None)),
         'response_ip': (List[IPv4Address], Field(title='ips to response for non whitelist domains')),
         'ttl': (
             Optional[int],
@@ -146,22 +421,17 @@ class WhiteList(_Authoritative):
         )
     }
 
-    async def before_resolve(self, query, response, *args, **kwargs):
-        redis_key = self.config.redis_key_A
+    def __init__(self, *args, **kwargs):
+        super(WhiteList, self).__init__(*args, **kwargs)
         default_ip = [x.__str__() for x in self.config.response_ip]
         ttl = self.config.ttl or self.config.default_ttl
-        rrset = DNS.Utilities.create_rrset(dns.rdatatype.A, '_', addresses=default_ip, ttl=ttl)
-        for q_ in query.question:
-            if q_.rdtype == dns.rdatatype.A:
-                name = q_.name
-                result = await self.redis_iterative_lookup(redis_key, name, 'sismember')
-                if result:
-                    logger.info(f'{name.to_text()} is white listed. skipping ...')
-                    continue
-                rrset_ = copy.deepcopy(rrset)
-                rrset_.name = q_.name
-                self._manual_answer(query.question, q_, response.answer, rrset_)
-        return query, response
+        self.rrset = DNS.Utilities.create_rrset(dns.rdatatype.A, '_', addresses=default_ip, ttl=ttl)
+
+    def _answer(self, context, result):
+        if result:
+            logger.info(f'{context.qname} is white listed. skipping ...')
+            return
+        context.answer(self.rrset.copy())
 
     async def after_resolve(self, query, response, *args, **kwargs):
         return query, response
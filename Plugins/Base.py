@@ -1,19 +1,18 @@
+import asyncio
 from abc import abstractmethod
-from typing import List
+from typing import Dict, List
 
 import dns.message
 
 import DNS.Config
-
-
-class Dict2Obj(object):
-    def __init__(self, dictionary):
-        for key in dictionary:
-            setattr(self, key, dictionary[key])
+import DNS.Context
+import DNS.Memory
 
 
 class BasePlugin:
     CONFIG = {}
+    # plugins which implement on_query_batch set it, so concurrent queries are handed to them together
+    BATCH = False
     _config = None
 
     def __init__(self, plugins: List[object], *args, **kwargs):
@@ -35,6 +34,34 @@ class BasePlugin:
         """
         return query, response
 
+    @staticmethod
+    async def _call(func, *args):
+        result = func(*args)
+        return await result if asyncio.iscoroutine(result) else result
+
+    async def on_query(self, context: 'DNS.Context.QueryContext'):
+        """
+        called by server before resolve. plugins can override it to work on pre-decoded query context instead of
+        messages. by default before_resolve is called with query and (built) response of context
+        """
+        context.query, context.response = await self._call(self.before_resolve, context.query, context.response,
+                                                           context.address)
+
+    async def on_query_batch(self, contexts: List['DNS.Context.QueryContext']):
+        """
+        on_query of many concurrent queries at once (used if BATCH is set and plugin_batch_window > 0). lets plugins
+        share round trips to their backends between queries
+        """
+        for context in contexts:
+            await self.on_query(context)
+
+    async def on_response(self, context: 'DNS.Context.QueryContext'):
+        """
+        called by server after resolve. by default after_resolve is called with query and response of context
+        """
+        context.query, context.response = await self._call(self.after_resolve, context.query, context.response,
+                                                           context.address)
+
     # noinspection PyUnusedLocal
     @abstractmethod
     def after_resolve(self, query: dns.message.QueryMessage, response: dns.message.QueryMessage, address):
@@ -45,6 +72,18 @@ class BasePlugin:
         """
         return query, response
 
+    def memory_components(self) -> Dict[str, 'DNS.Memory.Component']:
+        """
+        memory consumers of plugin (e.g. in memory filters) to account against memory_budget, by name
+        """
+        return {}
+
+    def close(self):
+        """
+        called when server stops. release resources and cancel background tasks of plugin (can be a coroutine)
+        """
+        pass
+
     @property
     def settings(self):
         """
@@ -53,20 +92,13 @@ class BasePlugin:
         return DNS.Config.Settings
 
     @property
-    def config(self):
+    def config(self) -> 'DNS.Config.PluginConfig':
         """
-        access module level and class level config data
+        access module level and class level config data (immutable snapshot built when configuration is loaded)
         """
         if self._config:
             return self._config
-
         module_ = self.__class__.__module__.split('.')[1]
-        class_ = module_ + '.' + self.__class__.__name__
-        module_pref = 'Plugin__' + module_ + '__'
-        class_pref = 'Plugin__' + class_ + '__'
-        conf_module = {x.replace(module_pref, ''): y for x, y in self.settings if x.startswith(module_pref)}
-        conf_class = {x.replace(class_pref, ''): y for x, y in self.settings if x.startswith(class_pref)}
-        conf_ = {**conf_module, **conf_class}
-        conf = Dict2Obj(conf_)
+        conf = DNS.Config.Configuration.plugin_config(module_ + '.' + self.__class__.__name__)
         self._config = conf
         return conf
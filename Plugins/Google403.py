@@ -1,12 +1,16 @@
 import asyncio
+import os
+import socket
 from typing import Optional
 
 import aiohttp
+import aioredis.exceptions
 import dns.rdatatype
 from aiohttp.client_exceptions import ClientError, ServerTimeoutError
 from pydantic import Field
 from pydantic import RedisDsn
 
+import DNS.Config
 from DNS.Logging import logger
 from Plugins import Authoritative
 from Plugins.Authoritative import _Authoritative
@@ -15,7 +19,8 @@ from Plugins.Authoritative import _Authoritative
 
 CONFIG = {
     'redis_uri': (Optional[RedisDsn],
-                  Field(title='redis server uri. if None, will use Authoritative plugin redis_uri', default=None))
+                  Field(title='redis server uri. if None, redis client of Authoritative.BlackList plugin is used',
+                        default=None))
 }
 
 
@@ -29,7 +34,34 @@ class Inquirer(_Authoritative):
     CONFIG = {
         'redis_key_que': (
             str,
-            Field(title='key to read/write Inquiring que in redis server [set]', default='G403_que')
+            Field(title='key to read/write domains queued for inquiring in redis server [set]. a domain is added to '
+                        'redis_key_stream only if it is not in this set already', default='G403_que')
+        ),
+        'redis_key_stream': (
+            str,
+            Field(title='key to read/write Inquiring que in redis server [stream]', default='G403_stream')
+        ),
+        'stream_group': (
+            str,
+            Field(title='consumer group of probers reading redis_key_stream', default='G403_probers')
+        ),
+        'stream_maxlen': (
+            int,
+            Field(title='approximate max length of redis_key_stream. older entries are trimmed', default=100000)
+        ),
+        'claim_idle': (
+            float,
+            Field(title='seconds after which a domain which is not acknowledged by its prober (e.g. prober died) is '
+                        'claimed by another one', default=300.)
+        ),
+        'probe_in_process': (
+            bool,
+            Field(title='run a prober in each DNS server process. if false, domains are only queued and standalone '
+                        'probers (Server.py --google403-worker) probe them', default=True)
+        ),
+        'probe_concurrency': (
+            int,
+            Field(title='max number of domains probed at once by each prober', default=8)
         ),
         'redis_key_open': (
             str,
@@ -60,18 +92,33 @@ class Inquirer(_Authoritative):
                 "to SNI proxy ip"
             )
             raise e
-        if self.config.redis_uri is None:
-            self._config.redis_uri = resolver.config.redis_uri
+        if resolver.storage_type != 'redis':
+            raise ValueError('Plugin Google403.Inquirer adds blocked domains to Authoritative.BlackList redis set. '
+                             'BlackList storage should be redis')
+        if self.config.redis_uri is None and kwargs.get('redis') is None:
+            # client of BlackList is shared, so writes follow its topology (they are sent to primary)
+            kwargs['redis'] = resolver.redis
         super(Inquirer, self).__init__(plugins, *args, **kwargs)
         self.resolver = resolver
         self.resolver_key = resolver.config.redis_key_A
-        asyncio.get_event_loop().run_until_complete(self._init_db())
-        asyncio.get_event_loop().create_task(self._init_inquirer())
+        self.prober = Prober(self, kwargs.get('consumer'))
+        # plugins may be created inside running loop (reload), so initial db sync runs as a task too
+        loop = asyncio.get_event_loop()
+        self._tasks = [loop.create_task(self._init_db())]
+        if kwargs.get('probe', self.config.probe_in_process):
+            self._tasks.append(loop.create_task(self.prober.run()))
+
+    async def close(self):
+        for t_ in self._tasks:
+            t_.cancel()
+        self._tasks = []
+        await super(Inquirer, self).close()
 
     async def add_domains(self, *domains):
         domains = [x.replace('www.', '', 1) if x.startswith('www.') else x for x in domains]
         subdomains = ['*.' + x for x in domains]
         await self.resolver.redis.sadd(self.resolver_key, *[*domains, *subdomains])
+        self.resolver.add_to_filter(*domains, *subdomains)
 
     async def _init_db(self):
         members = await self.redis.smembers(self.config.redis_key_block)
@@ -80,18 +127,7 @@ class Inquirer(_Authoritative):
             logger.info(f'added {len(members)} domain to {self.resolver_key}')
         return
 
-    async def _init_inquirer(self):
-        # todo: run in parallel loop
-        # todo: add redis ttl for unknown hosts
-        while True:
-            query = await self.redis.spop(self.config.redis_key_que)
-            if query:
-                logger.info(f'got {query} to inquire')
-                asyncio.create_task(self.inquire(query))
-            else:
-                logger.trace(f'no query to inquire')
-                await asyncio.sleep(1)
-
+    # todo: add redis ttl for unknown hosts
     async def inquire(self, host):
         mode = await self.is_blocked(host)
         add2resolver = False
@@ -129,21 +165,161 @@ class Inquirer(_Authoritative):
                 logger.error(f'error getting {url} [{e}]')
         return 'u'
 
-    async def before_resolve(self, query, response, *args, **kwargs):
-        for q_ in query.question:
-            if q_.rdtype == dns.rdatatype.A:
-                name = q_.name.to_text(True)
-                for i_ in [self.config.redis_key_open, self.config.redis_key_block,
-                           self.config.redis_key_unknown]:
-                    state = await self.redis.sismember(i_, name)
-                    if state:
-                        logger.info(f'found record for {name} in {i_}')
-                        break
-                if state:
-                    continue
-                logger.info(f'no record for {name}. adding to {self.config.redis_key_que}')
-                await self.redis.sadd(self.config.redis_key_que, name)
-        return query, response
+    async def on_query(self, context):
+        if context.qtype != dns.rdatatype.A or not context.pending:
+            return
+        name = context.qname
+        keys = [self.config.redis_key_open, self.config.redis_key_block, self.config.redis_key_unknown]
+        # states are read in one round trip
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for i_ in keys:
+                pipe.sismember(i_, name)
+            states = await pipe.execute()
+        for i_, state in zip(keys, states):
+            if state:
+                logger.info(f'found record for {name} in {i_}')
+                return
+        # que set keeps a domain from being queued again while it is waiting or being probed
+        if await self.redis.sadd(self.config.redis_key_que, name):
+            logger.info(f'no record for {name}. adding to {self.config.redis_key_stream}')
+            await self.redis.xadd(self.config.redis_key_stream, {'host': name}, maxlen=self.config.stream_maxlen)
 
     async def after_resolve(self, query, response, *args, **kwargs):
         return query, response
+
+
+class Prober:
+    """
+    consumer of Inquirer probe stream. runs in DNS server processes (probe_in_process) or standalone (run_worker)
+    notes:
+        - domains are read from redis_key_stream through consumer group stream_group, so each one is probed by one
+          prober of any process or node
+        - an entry is acknowledged (and its domain removed from redis_key_que) after its result is stored. entries
+          pending on a consumer for more than claim_idle seconds are claimed and probed again. entries left pending on
+          this consumer (same consumer name) are probed first when it starts
+        - at most probe_concurrency domains are probed at once
+    """
+
+    def __init__(self, inquirer: Inquirer, consumer=None, block=1000):
+        self.inquirer = inquirer
+        self.config = inquirer.config
+        self.consumer = consumer or f'{socket.gethostname()}-{os.getpid()}'
+        # milliseconds to wait for new entries in each read
+        self.block = block
+        self.counters = {'probed': 0, 'claimed': 0}
+
+    @property
+    def redis(self):
+        return self.inquirer.redis
+
+    async def create_group(self):
+        stream, group = self.config.redis_key_stream, self.config.stream_group
+        exists = await self.redis.exists(stream)
+        try:
+            await self.redis.xgroup_create(stream, group, id='0', mkstream=True)
+        except aioredis.exceptions.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+            return
+        if exists:
+            return
+        # domains queued by versions which popped redis_key_que directly would never be added to stream again
+        members = await self.redis.smembers(self.config.redis_key_que)
+        for i_ in members:
+            await self.redis.xadd(stream, {'host': i_}, maxlen=self.config.stream_maxlen)
+        logger.info(f'created consumer group {group} of {stream}. queued {len(members)} domains of '
+                    f'{self.config.redis_key_que}')
+
+    async def read(self, count, last_id='>'):
+        """
+        :param last_id: '>' for new entries, '0' for entries pending on this consumer
+        """
+        result = await self.redis.xreadgroup(self.config.stream_group, self.consumer,
+                                             {self.config.redis_key_stream: last_id}, count=count,
+                                             block=self.block if last_id == '>' else None)
+        return result[0][1] if result else []
+
+    async def claim(self, count):
+        """
+        take over entries which are pending on other consumers for more than claim_idle seconds
+        """
+        stream, group = self.config.redis_key_stream, self.config.stream_group
+        idle = int(self.config.claim_idle * 1000)
+        pending = await self.redis.xpending_range(stream, group, '-', '+', count)
+        ids = [x['message_id'] for x in pending if x['time_since_delivered'] >= idle and x['consumer'] != self.consumer]
+        if not ids:
+            return []
+        entries = await self.redis.xclaim(stream, group, self.consumer, idle, ids)
+        self.counters['claimed'] += len(entries)
+        logger.info(f'{self.consumer} claimed {len(entries)} stuck entries of {stream}')
+        return entries
+
+    async def probe(self, entry_id, fields):
+        # fields of entries which were trimmed from stream are None
+        host = fields.get('host') if fields else None
+        try:
+            if host:
+                await self.inquirer.inquire(host)
+                await self.redis.srem(self.config.redis_key_que, host)
+            await self.redis.xack(self.config.redis_key_stream, self.config.stream_group, entry_id)
+        except (aioredis.exceptions.RedisError, OSError) as e:
+            # entry is left pending and claimed again after claim_idle
+            logger.error(f'failed to store inquiry result of {host} [{e}]')
+            return
+        self.counters['probed'] += 1
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        tasks = set()
+        last_id = '0'
+        next_claim = 0
+        try:
+            while True:
+                tasks = {x for x in tasks if not x.done()}
+                if len(tasks) >= self.config.probe_concurrency:
+                    _, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                count = self.config.probe_concurrency - len(tasks)
+                try:
+                    if last_id == '0':
+                        await self.create_group()
+                    entries = []
+                    # claimed entries become pending on this consumer, so claiming starts after its own are read
+                    if last_id == '>' and loop.time() >= next_claim:
+                        next_claim = loop.time() + self.config.claim_idle
+                        entries = await self.claim(count)
+                    if not entries:
+                        entries = await self.read(count, last_id)
+                        # entries left pending on this consumer are read first, until they are exhausted
+                        if last_id != '>':
+                            last_id = entries[-1][0] if entries else '>'
+                except (aioredis.exceptions.RedisError, OSError) as e:
+                    logger.error(f'failed to read {self.config.redis_key_stream} [{e}]')
+                    await asyncio.sleep(1)
+                    continue
+                for entry_id, fields in entries:
+                    logger.info(f'got {fields} to inquire')
+                    tasks.add(loop.create_task(self.probe(entry_id, fields)))
+        finally:
+            for t_ in tasks:
+                t_.cancel()
+
+
+async def run_worker(consumer=None):
+    """
+    standalone prober (Server.py --google403-worker). probes domains queued by DNS servers until cancelled.
+    configuration is read from same environment as DNS servers; Authoritative.BlackList and Google403.Inquirer
+    plugins should be active in it
+    """
+    plugins = DNS.Config.Settings.plugins
+    if 'Authoritative.BlackList' not in plugins or 'Google403.Inquirer' not in plugins:
+        raise ValueError('Google403 worker needs Authoritative.BlackList and Google403.Inquirer plugins in '
+                         'DNSPY__PLUGINS')
+    blacklist = Authoritative.BlackList([])
+    inquirer = Inquirer([blacklist], probe=False, consumer=consumer)
+    logger.info(f'Google403 prober {inquirer.prober.consumer} started')
+    try:
+        await inquirer.prober.run()
+    finally:
+        await inquirer.close()
+        await blacklist.close()
@@ -1,5 +1,13 @@
+import json
+import os
+import time
+from typing import Optional
+
+import dns.rcode
+import dns.rdatatype
 from pydantic import Field
 
+import DNS.Cache
 from DNS.Logging import logger
 from Plugins.Base import BasePlugin
 
@@ -8,15 +16,84 @@ CONFIG = {
 }
 
 
+class JsonWriter:
+    """
+    append json lines to a file
+    notes:
+        - records are buffered and written at most every flush_interval seconds (or when max_records are buffered)
+          with one write of whole lines to a file opened for append, so server processes can share a file
+        - file is reopened when it is moved away (log rotation)
+        - write errors are logged and records are dropped; queries are not affected
+    """
+
+    def __init__(self, path, flush_interval=1., max_records=1000, clock=time.monotonic):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.max_records = max_records
+        self.clock = clock
+        self._buffer = []
+        self._fd = None
+        self._inode = None
+        self._open()
+        self._next_flush = clock() + flush_interval
+
+    def _open(self):
+        if self._fd is not None:
+            os.close(self._fd)
+        self._fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+        self._inode = os.fstat(self._fd).st_ino
+
+    def write(self, record: dict):
+        self._buffer.append(json.dumps(record, separators=(',', ':')))
+        if len(self._buffer) >= self.max_records or self.clock() >= self._next_flush:
+            self.flush()
+
+    def flush(self):
+        self._next_flush = self.clock() + self.flush_interval
+        if not self._buffer:
+            return
+        data = ('\n'.join(self._buffer) + '\n').encode()
+        self._buffer = []
+        try:
+            try:
+                moved = os.stat(self.path).st_ino != self._inode
+            except FileNotFoundError:
+                moved = True
+            if moved:
+                self._open()
+            os.write(self._fd, data)
+        except OSError as e:
+            logger.error(f'failed to write query log {self.path} [{e}]')
+
+    def close(self):
+        self.flush()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
 class Log(BasePlugin):
     """
-    log query data
+    log query data as text lines or as json records for offline analysis (Analyze.py)
     """
     CONFIG = {
         'question': (bool, Field(title='log question query', default=False)),
         'answer': (bool, Field(title='log answer query', default=True)),
+        'format': (str, Field(title='text: log lines to logger. json: records to path (answer is ignored)',
+                              default='text', regex='^(text|json)$')),
+        'path': (Optional[str], Field(title='file json records are appended to [json format]', default=None)),
+        'flush_interval': (float, Field(title='seconds json records are buffered before written [json format]',
+                                        default=1., gt=0)),
     }
 
+    def __init__(self, *args, **kwargs):
+        super(Log, self).__init__(*args, **kwargs)
+        self.writer = None
+        if self.config.format == 'json':
+            if not self.config.path:
+                raise ValueError('path is required by QueryLog.Log with json format')
+            self.writer = JsonWriter(self.config.path, self.config.flush_interval)
+
     @staticmethod
     def _query_message(query, address):
         message = f'query from {address}: '
@@ -32,9 +109,28 @@ class Log(BasePlugin):
             message += f'{q.to_text()}\t'
         return message
 
+    @staticmethod
+    def record(context):
+        """
+        json record of an answered query: time, client, qname, qtype, rcode, cacheable ttl, number of answers and
+        whether query was answered by plugins (local) instead of upstream
+        """
+        response = context.response
+        return {
+            'ts': round(time.time(), 3), 'client': context.client, 'qname': context.qname,
+            'qtype': dns.rdatatype.to_text(context.qtype) if context.qtype is not None else None,
+            'rcode': dns.rcode.to_text(response.rcode()), 'ttl': DNS.Cache.AnswerCache.response_ttl(response),
+            'answers': len(response.answer), 'local': not context.pending,
+        }
+
     def _log(self, message):
         getattr(logger, self.config.log_level)(message.replace('\n', '\\n'))
 
+    async def on_response(self, context):
+        if self.writer is None:
+            return await super(Log, self).on_response(context)
+        self.writer.write(self.record(context))
+
     def before_resolve(self, query, response, address, *args, **kwargs):
         if self.config.question:
             message = self._query_message(query, address)
@@ -46,3 +142,7 @@ class Log(BasePlugin):
             message = self._answer_message(response, address)
             self._log(message)
         return query, response
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
@@ -2,13 +2,16 @@ import argparse
 import asyncio
 import atexit
 import copy
+import multiprocessing
 import os
+import signal
 
 import aiorun
-import dotenv
 
 import DNS.Config
 import DNS.Core
+import DNS.SharedCache
+import DNS.Storage
 from DNS.Logging import logger
 
 
@@ -18,9 +21,17 @@ def read_cli():
                         metavar='path')
     parser.add_argument('--list-env', action='store_true', help='show all available env. variables options')
     parser.add_argument('--list-plugin', action='store_true', help='show all available plugins')
+    parser.add_argument('--compile-index', nargs=2, default=None, type=str, metavar=('source', 'output'),
+                        help='compile a list of names (one "name [value]" per line) into an index file for file '
+                             'storage of Authoritative plugins')
+    parser.add_argument('--google403-worker', action='store_true',
+                        help='run a standalone Google403 prober instead of a DNS server')
+    parser.add_argument('--consumer', default=None, type=str, metavar='name',
+                        help='consumer name of Google403 prober in its redis consumer group (default: hostname-pid). '
+                             'a restarted prober with same name probes entries it left pending first')
     args = parser.parse_args()
     if args.env_file:
-        dotenv.load_dotenv(args.env_file)
+        DNS.Config.Configuration.load_env_file(args.env_file)
 
     return args
 
@@ -87,14 +98,34 @@ class HelpPrinter:
     def print_list_plugin(cls):
         print(cls.sep_1)
         print('available plugins:')
-        for i_, j_ in DNS.Config.Configuration.get_all_plugins().items():
+        for i_, j_ in DNS.Config.Configuration.discover_plugins().items():
             print(cls.sep_2)
             print(i_)
             print(cls.sep_4)
-            print(j_.__doc__)
+            print(j_)
             print()
 
 
+def serve(shared_cache=None, worker=None):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    server = DNS.Core.UDPDNSServer(shared_cache=shared_cache, worker=worker)
+
+    async def _shutdown(_):
+        await server.stop()
+
+    loop.create_task(server.start())
+    workers = DNS.Config.Settings.workers
+    aiorun.run(loop=loop, executor_workers=workers, shutdown_callback=_shutdown)
+
+
+def probe(consumer=None):
+    import Plugins.Google403
+
+    DNS.Config.Configuration.load()
+    aiorun.run(Plugins.Google403.run_worker(consumer), stop_on_unhandled_errors=True)
+
+
 def main():
     def _clean_exit():
         logger.warning('server shutdown')
@@ -102,16 +133,43 @@ def main():
     atexit.register(_clean_exit)
     DNS.Config.Configuration.load()
     print(f'configuration: {DNS.Config.Settings.json()}')
-    loop = asyncio.get_event_loop()
-    loop.create_task(DNS.Core.UDPDNSServer().start())
-    workers = DNS.Config.Settings.workers
-    aiorun.run(loop=loop, executor_workers=workers)
+    processes = DNS.Config.Settings.processes
+    if processes == 1:
+        serve()
+        return
+
+    shared_cache = None
+    if DNS.Config.Settings.shared_cache_slots:
+        shared_cache = DNS.SharedCache.SharedAnswerCache(
+            slots=DNS.Config.Settings.shared_cache_slots,
+            slot_size=DNS.Config.Settings.shared_cache_slot_size
+        )
+    ctx = multiprocessing.get_context('fork')
+    children = [ctx.Process(target=serve, args=(shared_cache, i_), name=f'dnspy-{i_}') for i_ in range(processes)]
+    for c_ in children:
+        c_.start()
+    signal.signal(signal.SIGTERM, lambda *_: [x.terminate() for x in children if x.is_alive()])
+    # each server process reloads its own configuration and plugins
+    signal.signal(signal.SIGHUP, lambda *_: [os.kill(x.pid, signal.SIGHUP) for x in children if x.is_alive()])
+    try:
+        for c_ in children:
+            c_.join()
+    except KeyboardInterrupt:
+        for c_ in children:
+            c_.join()
+    finally:
+        if shared_cache is not None:
+            shared_cache.close()
 
 
 if __name__ == '__main__':
     os.chdir(os.path.dirname(os.path.realpath(__file__)))
     args_ = read_cli()
-    if args_.list_env or args_.list_plugin:
+    if args_.compile_index:
+        DNS.Storage.compile_index(DNS.Storage.read_source(args_.compile_index[0]), args_.compile_index[1])
+    elif args_.google403_worker:
+        probe(args_.consumer)
+    elif args_.list_env or args_.list_plugin:
         if args_.list_env:
             HelpPrinter.print_list_env()
         if args_.list_plugin:
@@ -1,8 +1,13 @@
 import asyncio
+import shutil
+import subprocess
 
+import dns.message
 import pytest
 from pytest import MonkeyPatch
 
+from DNS.Stub import StubDNSServer
+
 
 @pytest.fixture(scope='class')
 def monkeyclass():
@@ -16,3 +21,45 @@ def event_loop():
     loop = asyncio.get_event_loop()
     yield loop
     loop.close()
+
+
+@pytest.fixture(scope='class')
+async def stub_upstream(request):
+    """
+    local upstream DNS server. zone and fault injection options are read from STUB_ZONE and STUB_OPTIONS of test class
+    """
+    zone = getattr(request.cls, 'STUB_ZONE', {})
+    options = getattr(request.cls, 'STUB_OPTIONS', {})
+    stub = StubDNSServer(zone, **options)
+    await stub.start()
+    yield stub
+    await stub.stop()
+
+
+@pytest.fixture()
+def stub_response_factory():
+    """
+    build a query and its stub upstream response for a host
+    """
+
+    def _factory(host, addresses=('192.0.2.1',), ttl=300):
+        stub = StubDNSServer({host: list(addresses)}, ttl=ttl)
+        query = dns.message.make_query(host, 'A')
+        return query, dns.message.from_wire(stub.answer(query.to_wire()))
+
+    return _factory
+
+
+@pytest.fixture(scope='session')
+def certificate(tmp_path_factory):
+    """
+    self signed certificate and key files for dns.test
+    """
+    if shutil.which('openssl') is None:
+        pytest.skip('openssl is not available to create a test certificate')
+    path = tmp_path_factory.mktemp('tls')
+    cert, key = str(path / 'cert.pem'), str(path / 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-keyout', key, '-out', cert,
+                    '-days', '1', '-subj', '/CN=dns.test', '-addext', 'subjectAltName=DNS:dns.test'],
+                   check=True, capture_output=True)
+    return cert, key
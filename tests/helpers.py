@@ -1,3 +1,94 @@
+import asyncio
+import time
+
+import aioredis.exceptions
+import fakeredis.aioredis
+
+
 def extract_address_from_a_response(a_response):
     return {x.address for x in a_response.rrset}
 
+
+
+class StreamFakeRedis(fakeredis.aioredis.FakeRedis):
+    """
+    fakeredis 1.x doesn't implement stream commands. stream commands used by Google403 are emulated in memory here
+    (replies are in aioredis parsed format). clock returns seconds and is used for idle time of pending entries
+    """
+
+    def __init__(self, *args, clock=time.monotonic, **kwargs):
+        super(StreamFakeRedis, self).__init__(*args, **kwargs)
+        self.clock = clock
+        self.streams = {}
+        # (stream, group) -> {'last': last delivered sequence, 'pending': {id: [consumer, delivered at, count]}}
+        self.groups = {}
+        self._seq = 0
+
+    @staticmethod
+    def _seq_of(entry_id):
+        return int(str(entry_id).split('-')[0])
+
+    async def exists(self, *names):
+        others = [x for x in names if x not in self.streams]
+        return len(names) - len(others) + (await super(StreamFakeRedis, self).exists(*others) if others else 0)
+
+    async def xadd(self, name, fields, id='*', maxlen=None, approximate=True):
+        self._seq += 1
+        entries = self.streams.setdefault(name, [])
+        entries.append((f'{self._seq}-0', dict(fields)))
+        if maxlen is not None:
+            del entries[:-maxlen]
+        return entries[-1][0] if entries else f'{self._seq}-0'
+
+    async def xgroup_create(self, name, groupname, id='$', mkstream=False):
+        if name not in self.streams:
+            if not mkstream:
+                raise aioredis.exceptions.ResponseError('ERR The XGROUP subcommand requires the key to exist')
+            self.streams[name] = []
+        if (name, groupname) in self.groups:
+            raise aioredis.exceptions.ResponseError('BUSYGROUP Consumer Group name already exists')
+        last = self._seq if id == '$' else self._seq_of(id)
+        self.groups[(name, groupname)] = {'last': last, 'pending': {}}
+        return True
+
+    async def xreadgroup(self, groupname, consumername, streams, count=None, block=None, noack=False):
+        result = []
+        for name, last_id in streams.items():
+            group = self.groups[(name, groupname)]
+            entries = dict(self.streams[name])
+            if last_id == '>':
+                read = [x for x in self.streams[name] if self._seq_of(x[0]) > group['last']][:count]
+                if read:
+                    group['last'] = self._seq_of(read[-1][0])
+                for id_, _ in read:
+                    group['pending'][id_] = [consumername, self.clock(), 1]
+            else:
+                ids = sorted((x for x, y in group['pending'].items()
+                              if y[0] == consumername and self._seq_of(x) > self._seq_of(last_id)), key=self._seq_of)
+                read = [(x, entries.get(x)) for x in ids[:count]]
+            if read or last_id != '>':
+                result.append([name, read])
+        if not result and block:
+            await asyncio.sleep(block / 1000)
+        return result
+
+    async def xack(self, name, groupname, *ids):
+        pending = self.groups[(name, groupname)]['pending']
+        return len([pending.pop(x) for x in ids if x in pending])
+
+    async def xpending_range(self, name, groupname, min, max, count, consumername=None):
+        now = self.clock()
+        pending = sorted(self.groups[(name, groupname)]['pending'].items(), key=lambda x: self._seq_of(x[0]))
+        return [{'message_id': x, 'consumer': y[0], 'time_since_delivered': int((now - y[1]) * 1000),
+                 'times_delivered': y[2]} for x, y in pending if consumername in (None, y[0])][:count]
+
+    async def xclaim(self, name, groupname, consumername, min_idle_time, message_ids, **kwargs):
+        now = self.clock()
+        pending = self.groups[(name, groupname)]['pending']
+        entries = dict(self.streams[name])
+        claimed = []
+        for id_ in message_ids:
+            if id_ in pending and (now - pending[id_][1]) * 1000 >= min_idle_time:
+                pending[id_] = [consumername, now, pending[id_][2] + 1]
+                claimed.append((id_, entries.get(id_)))
+        return claimed
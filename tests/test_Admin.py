@@ -0,0 +1,78 @@
+import aiohttp
+import dns.name
+import fakeredis.aioredis
+import pytest
+
+from DNS.Upstream import Health
+from tests.test_Basic import _TestBase
+
+
+@pytest.mark.parametrize('server_conf', [{'DNSPY__ADMIN_PORT': '0', 'DNSPY__PLUGINS': '["QueryLog.Log"]'}],
+                         indirect=['server_conf'])
+class TestAdmin(_TestBase):
+    @pytest.fixture(scope='class')
+    async def admin(self, server):
+        host, port = server.admin.address
+        async with aiohttp.ClientSession() as session:
+            async def _request(method, path, status=200):
+                async with session.request(method, f'http://{host}:{port}{path}') as resp:
+                    assert resp.status == status
+                    return await resp.json() if status == 200 else await resp.text()
+
+            yield _request
+
+    async def test_status(self, admin, resolve_local_a):
+        await resolve_local_a(self.EXAMPLE_HOST)
+        status = await admin('GET', '/status')
+        assert status['in_flight'] == 0 and status['plugins'] == ['QueryLog.Log']
+        assert status['cache']['size'] >= 1
+        assert status['upstream']['transport'] == 'udp' and status['upstream']['queries'] >= 1
+        assert status['upstream']['failures'] == 0 and status['upstream']['latency_ms'] > 0
+        memory = await admin('GET', '/memory')
+        assert memory['budget'] == 0 and memory['components']['cache'] > 0
+        assert status['memory'] > 0
+
+    async def test_plugins(self, admin, resolve_local_a):
+        await resolve_local_a(self.EXAMPLE_HOST)
+        hooks = (await admin('GET', '/plugins'))['QueryLog.Log']['hooks']
+        assert hooks['on_query']['calls'] >= 1 and hooks['on_response']['calls'] >= 1
+        assert hooks['on_query']['max_ms'] >= hooks['on_query']['avg_ms'] > 0
+
+    async def test_cache_flush(self, admin, server, resolve_local_a):
+        await resolve_local_a(self.EXAMPLE_HOST)
+        await resolve_local_a(self.EXAMPLE_HOST)
+        cache = await admin('GET', '/cache?top=1')
+        assert cache['hits'] >= 1 and 0 < cache['hit_ratio'] <= 1
+        assert cache['top'][0]['key'] == f'{self.EXAMPLE_HOST}. IN A' and cache['top'][0]['hits'] >= 1
+        assert await admin('POST', f'/cache/flush?name={self.EXAMPLE_HOST.upper()}') == {'cache': 1}
+        assert not server.cache.flush(dns.name.from_text(self.EXAMPLE_HOST))
+        assert 'invalid name' in await admin('POST', '/cache/flush?name=a..b', status=400)
+        assert 'integer' in await admin('GET', '/cache?top=x', status=400)
+
+    async def test_redis(self, admin, server, monkeypatch):
+        assert await admin('GET', '/redis') == {}
+        monkeypatch.setattr(server.plugins[0], 'redis', fakeredis.aioredis.FakeRedis(), raising=False)
+        state = (await admin('GET', '/redis'))['QueryLog.Log']
+        assert state['in_use'] == 0 and state['max'] > 0
+
+    async def test_actions(self, admin, tmp_path, monkeypatch):
+        assert await admin('POST', '/lists/reload') == {}
+        reloaded = await admin('POST', '/reload')
+        assert reloaded == {'reloaded': True, 'plugins': ['QueryLog.Log']}
+        monkeypatch.setenv('DNSPY__PROFILE_DIR', str(tmp_path))
+        await admin('POST', '/reload')
+        assert await admin('POST', '/profiler') == {'profiling': True}
+        assert await admin('POST', '/profiler') == {'profiling': False}
+        assert list(tmp_path.iterdir())
+
+
+class TestHealth:
+    def test_health(self):
+        health = Health()
+        health.success(0.01)
+        health.success(0.02)
+        health.failure(TimeoutError('timed out'))
+        state = health.state()
+        assert (state['queries'], state['failures']) == (3, 1)
+        assert 10 < state['latency_ms'] < 20
+        assert state['last_error'] == 'TimeoutError: timed out'
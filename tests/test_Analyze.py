@@ -0,0 +1,111 @@
+import argparse
+import gzip
+import json
+from collections import OrderedDict
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+import Analyze  # noqa: E402
+
+
+def _record(ts, qname, client='10.0.0.1', rcode='NOERROR', ttl=300, local=False):
+    return {'ts': ts, 'client': client, 'qname': qname, 'qtype': 'A', 'rcode': rcode, 'ttl': ttl, 'answers': 1,
+            'local': local}
+
+
+def _write(path, records, lines=()):
+    opener = gzip.open if path.endswith('.gz') else open
+    with opener(path, 'wt') as f_:
+        for r_ in records:
+            f_.write(json.dumps(r_) + '\n')
+        for line in lines:
+            f_.write(line + '\n')
+    return path
+
+
+class TestColumns:
+    def test_load(self, tmp_path):
+        first = _write(str(tmp_path / 'query.log.1.gz'), [_record(2., 'b.test'), _record(3., 'a.test')])
+        second = _write(str(tmp_path / 'query.log'), [_record(1., 'a.test', local=True)],
+                        lines=['not json', '{"ts": 4}', '[1]', ''])
+        columns = Analyze.load([first, second], chunk_size=2)
+        assert len(columns) == 3 and columns.invalid == 3
+        # ordered by time across files
+        assert [columns.values('qname')[x] for x in columns.qname] == ['a.test', 'b.test', 'a.test']
+        assert columns.local.tolist() == [True, False, False]
+
+    def test_frequencies(self, tmp_path):
+        records = [_record(i_, 'a.test', client=f'10.0.0.{i_ % 2}') for i_ in range(6)] + \
+            [_record(10 + i_, f'{i_}.b.test') for i_ in range(4)]
+        freq = Analyze.frequencies(Analyze.load([_write(str(tmp_path / 'query.log'), records)]), top=2)
+        assert (freq['queries'], freq['names'], freq['clients']) == (10, 5, 2)
+        assert freq['top_names'][0] == {'value': 'a.test', 'queries': 6, 'share': 0.6}
+        assert freq['top_clients'][0]['value'] == '10.0.0.1' and freq['top_clients'][0]['queries'] == 7
+        assert freq['top_names_share'][10] == 1.
+
+
+class TestCacheCurve:
+    def test_earlier_greater(self):
+        values = np.random.default_rng(0).integers(-1, 50, 1001)
+        expected = [int((values[:i_] > values[i_]).sum()) for i_ in range(len(values))]
+        assert Analyze.earlier_greater(values).tolist() == expected
+
+    def test_reuse_distances(self):
+        rng = np.random.default_rng(1)
+        keys = rng.zipf(1.5, 3000).astype(np.uint64) % 100
+        ts = np.cumsum(rng.random(3000))
+        ttls = rng.integers(0, 30, 3000)
+        distances = Analyze.reuse_distances(keys, ts, ttls)
+        fresh = Analyze.fresh_accesses(keys, ts, ttls)
+        for size in (1, 10, 50):
+            lru, hits = OrderedDict(), 0
+            for i_, key in enumerate(keys.tolist()):
+                if key in lru:
+                    lru.move_to_end(key)
+                    hits += fresh[i_]
+                lru[key] = True
+                if len(lru) > size:
+                    lru.popitem(last=False)
+            assert hits == ((distances >= 0) & (distances < size)).sum()
+
+    def test_curve(self, tmp_path):
+        # a b c a b c ... with 3 names: every reuse is 2 names away. d expires before its reuse
+        records = [_record(i_, 'abc'[i_ % 3] + '.test') for i_ in range(30)] + \
+            [_record(40, 'd.test', ttl=5), _record(50, 'd.test', ttl=5), _record(51, 'e.test', local=True)]
+        columns = Analyze.load([_write(str(tmp_path / 'query.log'), records)])
+        curve = Analyze.cache_curve(columns, sizes=[2, 3], target=0.8)
+        assert curve['queries'] == 32
+        assert [x['hit_ratio'] for x in curve['curve']] == [0., round(27 / 32, 4)]
+        assert curve['max_hit_ratio'] == round(27 / 32, 4) and curve['target_size'] == 3
+        assert Analyze.cache_curve(columns, target=0.9)['target_size'] is None
+        sampled = Analyze.cache_curve(columns, sample_rate=0.5)
+        assert sampled['simulated'] < sampled['queries']
+
+
+class TestCandidates:
+    def test_candidates(self, tmp_path):
+        records = [_record(i_, f'{i_}.ads.test', client=f'10.0.0.{i_ % 3}', rcode='NXDOMAIN' if i_ % 2 else 'NOERROR')
+                   for i_ in range(10)] + \
+            [_record(20 + i_, 'ads.test', client='10.0.0.1') for i_ in range(2)] + \
+            [_record(30 + i_, 'one.test') for i_ in range(20)] + \
+            [_record(60 + i_, 'x.listed.test', client=f'10.0.0.{i_}', local=True) for i_ in range(30)]
+        columns = Analyze.load([_write(str(tmp_path / 'query.log'), records)])
+        result = Analyze.candidates(columns, min_clients=2)
+        # one.test has a single client, listed.test is answered by plugins already
+        assert [x['domain'] for x in result] == ['ads.test']
+        assert result[0] == {'domain': 'ads.test', 'entries': ['ads.test', '*.ads.test'], 'queries': 12,
+                             'clients': 3, 'names': 11, 'nxdomain_ratio': round(5 / 12, 4)}
+        assert Analyze.candidates(columns, min_clients=1, top=1)[0]['domain'] == 'one.test'
+
+
+def test_main(tmp_path, capsys):
+    path = _write(str(tmp_path / 'query.log'), [_record(i_, f'{i_ % 5}.a.test') for i_ in range(50)])
+    args = argparse.Namespace(paths=[path], chunk_size=10, top=5, cache_sizes=[1, 5], target=0.9, sample_rate=1.,
+                              suffix_labels=2, min_clients=1, output=str(tmp_path / 'result.json'))
+    result = Analyze.main(args)
+    assert result['records'] == 50 and result['cache']['target_size'] == 5
+    assert 'list candidates' in capsys.readouterr().out
+    with open(args.output) as f_:
+        assert json.load(f_)['candidates'][0]['entries'] == ['*.a.test']
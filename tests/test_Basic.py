@@ -6,6 +6,7 @@ import pytest
 
 import DNS.Config
 import DNS.Core
+import DNS.Logging
 from tests.helpers import extract_address_from_a_response as eafar
 
 
@@ -14,12 +15,11 @@ class _TestBase:
     CONFIG_BASE = {
         "DNSPY__LOCAL_IP": "127.0.0.1",
         "DNSPY__LOCAL_PORT": 5053,
-        "DNSPY__UPSTREAM_IP": '8.8.8.8',
-        "DNSPY__UPSTREAM_PORT": 53,
         "DNSPY__PLUGINS_POST": ['QueryLog.log'],
         "LOGURU_LEVEL": 'DEBUG'
     }
     EXAMPLE_HOST = 'example.com'
+    STUB_ZONE = {EXAMPLE_HOST: ['93.184.216.34']}
 
     @staticmethod
     def _resolve_factory(where, conf):
@@ -45,7 +45,7 @@ class _TestBase:
         assert a == b
 
     @pytest.fixture(scope='class')
-    def server_conf(self, request, monkeyclass):
+    def server_conf(self, request, monkeyclass, stub_upstream):
         monkeyclass.chdir('../')
         if hasattr(request, 'param'):
             conf = request.param
@@ -54,6 +54,7 @@ class _TestBase:
         cfg = {}
         cfg.update(self.CONFIG_BASE)
         cfg.update(conf)
+        cfg['DNSPY__UPSTREAM_IP'], cfg['DNSPY__UPSTREAM_PORT'] = stub_upstream.address
         for i, j in cfg.items():
             if type(j) is str:
                 j_ = j
@@ -64,7 +65,6 @@ class _TestBase:
         config = DNS.Config.Settings
         print(config)
         yield config
-        os.remove(DNS.Config.Configuration.RUNTIME_FILE)
 
     @pytest.fixture(scope='class')
     async def server(self, server_conf):
@@ -93,3 +93,27 @@ class _TestBase:
 class TestBasic(_TestBase):
     async def test_basic(self, local_remote_equality_assert):
         await local_remote_equality_assert(self.EXAMPLE_HOST)
+
+
+@pytest.mark.parametrize('server_conf', [{'DNSPY__TRACE': 'true', 'DNSPY__TRACE_SLOW_THRESHOLD': '0'}],
+                         indirect=['server_conf'])
+class TestTracing(_TestBase):
+    async def test_slow_query_log(self, local_remote_equality_assert, server):
+        messages = []
+        handler = DNS.Logging.logger.add(messages.append, level='WARNING', format='{message}')
+        try:
+            await local_remote_equality_assert(self.EXAMPLE_HOST)
+        finally:
+            DNS.Logging.logger.remove(handler)
+        slow = [x for x in messages if x.startswith('slow query')]
+        assert len(slow) == 1
+        for stage in ['parse', 'upstream', 'send']:
+            assert f'{stage} @' in slow[0]
+
+    async def test_profiler_toggle(self, server, tmp_path):
+        server.profiler.output_dir = str(tmp_path)
+        assert server.profiler.toggle() is None
+        assert server.profiler.active
+        path = server.profiler.toggle()
+        assert not server.profiler.active
+        assert os.path.isfile(path)
@@ -0,0 +1,47 @@
+import asyncio
+
+import pytest
+
+from DNS.Batch import MicroBatcher
+
+
+@pytest.mark.asyncio
+class TestMicroBatcher:
+    @staticmethod
+    def _recording_handler(batches):
+        async def _handler(items):
+            batches.append(list(items))
+            return [x * 2 for x in items]
+
+        return _handler
+
+    async def test_window(self):
+        batches = []
+        batcher = MicroBatcher(self._recording_handler(batches), window=0.01, max_size=100)
+        results = await asyncio.gather(*[batcher.submit(x) for x in range(10)])
+        assert results == [x * 2 for x in range(10)]
+        assert batches == [list(range(10))]
+        assert (batcher.batches, batcher.items) == (1, 10)
+
+    async def test_max_size(self):
+        batches = []
+        batcher = MicroBatcher(self._recording_handler(batches), window=10, max_size=4)
+        results = await asyncio.wait_for(asyncio.gather(*[batcher.submit(x) for x in range(8)]), 1)
+        assert results == [x * 2 for x in range(8)]
+        assert batches == [[0, 1, 2, 3], [4, 5, 6, 7]]
+
+    async def test_error(self):
+        async def _handler(_):
+            raise ValueError('backend failed')
+
+        batcher = MicroBatcher(_handler, window=0.01)
+        results = await asyncio.gather(batcher.submit(1), batcher.submit(2), return_exceptions=True)
+        assert all(isinstance(x, ValueError) for x in results)
+
+    async def test_close(self):
+        batcher = MicroBatcher(self._recording_handler([]), window=10)
+        task = asyncio.get_running_loop().create_task(batcher.submit(1))
+        await asyncio.sleep(0)
+        batcher.close()
+        with pytest.raises(asyncio.CancelledError):
+            await task
@@ -0,0 +1,31 @@
+import argparse
+
+import pytest
+
+import Benchmark
+
+
+class TestBenchmark:
+    ARGS = argparse.Namespace(qps=200, duration=0.5, timeout=1., redis_uri=None, seed=0)
+
+    @pytest.mark.parametrize('config_name', ['none', 'blacklist'])
+    def test_scenario(self, config_name, monkeypatch):
+        monkeypatch.chdir('../')
+        result = Benchmark.run_scenario(config_name, 'blocklist', self.ARGS)
+        assert result['answered'] > 0
+        assert result['lost'] == 0
+        assert result['p50_ms'] <= result['p99_ms'] <= result['p999_ms']
+        assert result['cpu_us_per_query'] > 0
+
+    def test_server_failure(self, monkeypatch):
+        monkeypatch.chdir('../')
+        monkeypatch.setattr(Benchmark, 'scenario_env', lambda *_: {'DNSPY__PROCESSES': '0'})
+        with pytest.raises(RuntimeError, match='exited with code 1'):
+            Benchmark.run_scenario('none', 'blocklist', self.ARGS)
+
+    def test_query_mix(self):
+        generator = Benchmark.QueryGenerator(Benchmark.QUERY_MIXES['nxdomain'], seed=1)
+        names = [next(generator) for _ in range(1000)]
+        missing = [x for x in names if x.endswith(Benchmark.MISSING_ZONE)]
+        assert 700 < len(missing) < 900
+        assert len(set(missing)) == len(missing)
@@ -0,0 +1,16 @@
+from DNS.Bloom import BloomFilter
+
+
+class TestBloomFilter:
+    def test_membership(self):
+        filter_ = BloomFilter(10000, error_rate=0.01)
+        names = [f'host{i}.example.com' for i in range(10000)]
+        filter_.update(names)
+        assert all(x in filter_ for x in names)
+        false_positives = sum(f'other{i}.example.com' in filter_ for i in range(10000))
+        assert false_positives < 200
+
+    def test_size(self):
+        filter_ = BloomFilter(5_000_000, error_rate=0.01)
+        assert filter_.nbytes < 7 * 2 ** 20
+        assert filter_.hashes == 7
@@ -0,0 +1,165 @@
+import asyncio
+
+import pytest
+
+import DNS.Config
+import DNS.Core
+from DNS.Cache import AnswerCache
+from tests.helpers import extract_address_from_a_response as eafar
+from tests.test_Basic import _TestBase
+
+
+class _FakeClock:
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+class TestAnswerCache:
+    def test_lru(self, stub_response_factory):
+        cache = AnswerCache(size=2, clock=_FakeClock())
+        keys = []
+        for host in ['a.test', 'b.test', 'c.test']:
+            query, resp = stub_response_factory(host)
+            keys.append(cache.key(query))
+            cache.put(keys[-1], resp)
+        assert len(cache) == 2
+        assert cache.get(keys[0]) is None
+        assert cache.get(keys[2]) is not None
+
+    def test_ttl_and_stale(self, stub_response_factory):
+        clock = _FakeClock()
+        cache = AnswerCache(stale_window=10, stale_ttl=5, clock=clock)
+        query, resp = stub_response_factory('a.test', ttl=60)
+        key = cache.key(query)
+        cache.put(key, resp)
+        clock.now = 45
+        entry = cache.get(key)
+        assert cache.make_response(query, entry).answer[0].ttl == 15
+        clock.now = 65
+        assert cache.get(key) is None
+        entry = cache.get_stale(key)
+        assert cache.make_response(query, entry, stale=True).answer[0].ttl == 5
+        clock.now = 71
+        assert cache.get_stale(key) is None
+
+    def test_prefetch(self, stub_response_factory):
+        clock = _FakeClock()
+        cache = AnswerCache(prefetch_hits=2, prefetch_ratio=0.1, clock=clock)
+        query, resp = stub_response_factory('a.test', ttl=100)
+        key = cache.key(query)
+        cache.put(key, resp)
+        clock.now = 95
+        assert not cache.should_prefetch(cache.get(key))
+        assert cache.should_prefetch(cache.get(key))
+        clock.now = 80
+        assert not cache.should_prefetch(cache.get(key))
+
+    def test_prefetch_refresh(self, stub_response_factory):
+        clock = _FakeClock()
+        cache = AnswerCache(prefetch_hits=2, prefetch_ratio=0.1, clock=clock)
+        query, resp = stub_response_factory('a.test', ttl=100)
+        key = cache.key(query)
+        cache.put(key, resp)
+        cache.get(key)
+        cache.get(key)
+        for refresh in range(1, 3):
+            clock.now = refresh * 100 - 5
+            entry = cache.peek(key)
+            assert cache.should_prefetch(entry)
+            entry.prefetching = True
+            assert not cache.should_prefetch(entry)
+            cache.put(key, resp)
+            assert cache.peek(key).hits == 2
+
+    def test_nbytes_and_shrink(self, stub_response_factory):
+        cache = AnswerCache(size=3, clock=_FakeClock())
+        keys = []
+        for host in ['a.test', 'b.test', 'c.test', 'd.test']:
+            query, resp = stub_response_factory(host)
+            keys.append(cache.key(query))
+            cache.put(keys[-1], resp)
+        # one entry was evicted by size, one replaced
+        cache.put(keys[3], stub_response_factory('d.test')[1])
+        entry_size = cache.peek(keys[3]).nbytes
+        assert entry_size > 0 and cache.nbytes == 3 * entry_size
+        # least recently used goes first
+        cache.get(keys[1])
+        assert cache.shrink(entry_size + 1) == 2 * entry_size
+        assert cache.peek(keys[1]) is not None and len(cache) == 1
+        cache.remove(keys[1])
+        assert cache.nbytes == 0 and cache.shrink(1) == 0
+
+    def test_snapshot(self, stub_response_factory, tmp_path):
+        path = str(tmp_path / 'cache.snapshot')
+        clock = _FakeClock()
+        cache = AnswerCache(stale_window=10, clock=clock)
+        for host, ttl in [('a.test', 100), ('b.test', 5), ('c.test', 1)]:
+            query, resp = stub_response_factory(host, ttl=ttl)
+            cache.put(cache.key(query), resp)
+        cache.get(cache.key(stub_response_factory('a.test')[0]))
+        clock.now = 2
+        cache.dump(path)
+
+        cache_ = AnswerCache(stale_window=10, clock=_FakeClock())
+        assert cache_.load(path) == 3
+        query = stub_response_factory('a.test')[0]
+        entry = cache_.get(cache_.key(query))
+        assert entry.hits == 2
+        assert cache_.make_response(query, entry).answer[0].ttl in (97, 98)
+        assert cache_.get(cache_.key(stub_response_factory('c.test')[0])) is None
+        assert cache_.get_stale(cache_.key(stub_response_factory('c.test')[0])) is not None
+
+    def test_snapshot_path_per_process(self, monkeypatch):
+        monkeypatch.chdir('../')
+        monkeypatch.setenv('DNSPY__CACHE_SNAPSHOT_PATH', 'cache.snapshot')
+        DNS.Config.Configuration.load()
+        assert DNS.Core.UDPDNSServer().cache_snapshot_path == 'cache.snapshot'
+        assert DNS.Core.UDPDNSServer(worker=1).cache_snapshot_path == 'cache.snapshot.1'
+
+
+@pytest.mark.parametrize('server_conf', [{'DNSPY__UPSTREAM_TIMEOUT': '0.2', 'DNSPY__CACHE_PREFETCH_HITS': '1',
+                                          'DNSPY__CACHE_PREFETCH_RATIO': '0.9'}], indirect=['server_conf'])
+class TestServerCache(_TestBase):
+    STUB_ZONE = {'a.test': ['192.0.2.1'], 'b.test': ['192.0.2.2'], 'c.test': ['192.0.2.3']}
+    STUB_OPTIONS = {'ttl': 1}
+
+    async def test_hit(self, resolve_local_a, stub_upstream):
+        received = stub_upstream.received
+        await resolve_local_a('a.test')
+        await resolve_local_a('a.test')
+        assert stub_upstream.received == received + 1
+
+    async def test_prefetch(self, resolve_local_a, stub_upstream):
+        await resolve_local_a('b.test')
+        received = stub_upstream.received
+        await asyncio.sleep(0.2)
+        await resolve_local_a('b.test')
+        await asyncio.sleep(0.1)
+        assert stub_upstream.received == received + 1
+
+    async def test_prefetch_servfail(self, server, stub_upstream, stub_response_factory):
+        query, resp = stub_response_factory('d.test', ttl=1)
+        key = server.cache.key(query)
+        server.cache.put(key, resp)
+        entry = server.cache.peek(key)
+        entry.prefetching = True
+        stub_upstream.servfail = 1.
+        try:
+            await server._prefetch(key, query)
+        finally:
+            stub_upstream.servfail = 0.
+        assert server.cache.peek(key) is entry
+        assert not entry.prefetching
+
+    async def test_serve_stale(self, resolve_local_a, stub_upstream):
+        await resolve_local_a('c.test')
+        await asyncio.sleep(1.1)
+        stub_upstream.loss = 1.
+        try:
+            resp = await resolve_local_a('c.test')
+        finally:
+            stub_upstream.loss = 0.
+        assert eafar(resp) == {'192.0.2.3'}
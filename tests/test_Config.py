@@ -0,0 +1,48 @@
+import subprocess
+import sys
+
+import pytest
+
+import DNS.Config
+
+
+class TestPluginDiscovery:
+    def test_discover_plugins(self, monkeypatch):
+        monkeypatch.chdir('../')
+        plugins = DNS.Config.Configuration.discover_plugins()
+        assert set(plugins.keys()) == {
+            'Authoritative.LocalDB', 'Authoritative.BlackList', 'Authoritative.WhiteList', 'Example.ExamplePlugin',
+            'Google403.Inquirer', 'QueryLog.Log'
+        }
+        assert plugins['QueryLog.Log'] == DNS.Config.Configuration.get_plugin_class('QueryLog.Log').__doc__.strip()
+
+    def test_load_imports_active_plugins_only(self, monkeypatch):
+        monkeypatch.chdir('../')
+        monkeypatch.setenv('DNSPY__PLUGINS', '["QueryLog.Log"]')
+        code = (
+            'import sys, DNS.Config; DNS.Config.Configuration.load(); '
+            'print(sorted(x for x in sys.modules if x.startswith("Plugins.")))'
+        )
+        output = subprocess.check_output([sys.executable, '-c', code], text=True)
+        assert output.strip().splitlines()[-1] == "['Plugins.Base', 'Plugins.QueryLog']"
+
+
+class TestSettingsSnapshot:
+    @pytest.fixture()
+    def settings(self, monkeypatch):
+        monkeypatch.chdir('../')
+        monkeypatch.setenv('DNSPY__PLUGINS', '["Example.ExamplePlugin"]')
+        monkeypatch.setenv('DNSPY__PLUGIN__EXAMPLE.EXAMPLEPLUGIN__MESSAGE_BEFORE', 'hi')
+        DNS.Config.Configuration.load()
+        return DNS.Config.Settings
+
+    def test_immutable(self, settings):
+        with pytest.raises(TypeError):
+            settings.local_port = 1
+        conf = DNS.Config.Configuration.plugin_config('Example.ExamplePlugin')
+        assert conf.message_before == 'hi'
+        assert conf.message_before_module_level == 'hello world'
+        with pytest.raises(TypeError):
+            conf.message_before = 'bye'
+        assert conf.replace(message_before='bye').message_before == 'bye'
+        assert conf.message_before == 'hi'
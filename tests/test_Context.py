@@ -0,0 +1,39 @@
+import dns.message
+import dns.name
+import dns.rrset
+import pytest
+
+import DNS.Utilities
+from DNS.Context import QueryContext, suffix_keys
+
+
+class TestQueryContext:
+    @pytest.mark.parametrize('name', ['a.example.com', 'example.com', 'com', '.'])
+    def test_suffix_keys(self, name):
+        assert suffix_keys(name) == list(DNS.Utilities.iterative_candidates(dns.name.from_text(name)))
+
+    def test_decoded(self):
+        context = QueryContext(dns.message.make_query('WWW.Example.COM', 'AAAA'), ('192.0.2.1', 5353))
+        assert (context.qname, context.qtype, context.client) == ('www.example.com', 28, '192.0.2.1')
+        assert context.labels == ('www', 'example', 'com')
+        assert context.suffixes is context.suffixes
+        assert context.suffixes[:2] == ['www.example.com', '*.example.com']
+
+    def test_lazy_response(self):
+        query = dns.message.make_query('example.com', 'A')
+        original = dns.message.from_wire(query.to_wire())
+        context = QueryContext(query, ('192.0.2.1', 5353))
+        assert context._response is None
+        assert context.pending
+        context.answer(dns.rrset.from_text('_', 60, 'IN', 'A', '10.0.0.1'))
+        assert not context.pending and not query.question
+        resp = context.response
+        assert original.is_response(resp)
+        assert resp.answer[0].to_text() == 'example.com. 60 IN A 10.0.0.1'
+
+    def test_no_question(self):
+        query = dns.message.make_query('example.com', 'A')
+        query.question = []
+        context = QueryContext(query, None)
+        assert (context.qname, context.qtype, context.client) == ('', None, None)
+        assert not context.pending
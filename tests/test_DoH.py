@@ -0,0 +1,137 @@
+import asyncio
+import base64
+import ssl
+
+import dns.message
+import h2.config
+import h2.connection
+import h2.events
+import pytest
+
+from DNS.DoH import CONTENT_TYPE, DoHServer
+from tests.test_Basic import _TestBase
+
+
+class _Client:
+    """
+    minimal http/2 client sending requests of a test concurrently on one connection
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.h2 = h2.connection.H2Connection(config=h2.config.H2Configuration(client_side=True,
+                                                                             header_encoding='utf-8'))
+        self.h2.initiate_connection()
+        self.writer.write(self.h2.data_to_send())
+
+    @classmethod
+    async def connect(cls, host, port, ssl_context=None):
+        reader, writer = await asyncio.open_connection(host, port, ssl=ssl_context,
+                                                       server_hostname='dns.test' if ssl_context else None)
+        return cls(reader, writer)
+
+    def request(self, method, path, body=b'', headers=()):
+        stream_id = self.h2.get_next_available_stream_id()
+        headers = [(':method', method), (':path', path), (':scheme', 'https'), (':authority', 'dns.test'),
+                   *headers]
+        self.h2.send_headers(stream_id, headers, end_stream=not body)
+        if body:
+            self.h2.send_data(stream_id, body, end_stream=True)
+        self.writer.write(self.h2.data_to_send())
+        return stream_id
+
+    async def responses(self, stream_ids):
+        """
+        :return: {stream id: (headers, body)}
+        """
+        results = {x: [{}, b''] for x in stream_ids}
+        pending = set(stream_ids)
+        while pending:
+            data = await asyncio.wait_for(self.reader.read(65535), 5)
+            assert data, 'connection closed by server'
+            for event in self.h2.receive_data(data):
+                if isinstance(event, h2.events.ResponseReceived):
+                    results[event.stream_id][0] = dict(event.headers)
+                elif isinstance(event, h2.events.DataReceived):
+                    results[event.stream_id][1] += event.data
+                    self.h2.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.StreamEnded):
+                    pending.discard(event.stream_id)
+            self.writer.write(self.h2.data_to_send())
+        return {k_: tuple(v_) for k_, v_ in results.items()}
+
+    def close(self):
+        self.writer.close()
+
+
+def _get_path(query: dns.message.Message, path='/dns-query'):
+    return f'{path}?dns={base64.urlsafe_b64encode(query.to_wire()).decode().rstrip("=")}'
+
+
+@pytest.mark.parametrize('server_conf', [{'DNSPY__DOH_PORT': '5443'}], indirect=['server_conf'])
+class TestDoH(_TestBase):
+    STUB_ZONE = {f'host{i}.test': [f'192.0.2.{i}'] for i in range(20)}
+
+    @pytest.fixture()
+    async def client(self, server, server_conf):
+        client = await _Client.connect(server_conf.local_ip.__str__(), server_conf.doh_port)
+        yield client
+        client.close()
+
+    async def test_get(self, client):
+        query = dns.message.make_query('host1.test', 'A')
+        stream_id = client.request('GET', _get_path(query))
+        headers, body = (await client.responses([stream_id]))[stream_id]
+        assert headers[':status'] == '200'
+        assert headers['content-type'] == CONTENT_TYPE
+        resp = dns.message.from_wire(body)
+        assert query.is_response(resp)
+        assert resp.answer[0][0].address == '192.0.2.1'
+        assert 0 < int(headers['cache-control'].split('=')[1]) <= resp.answer[0].ttl
+
+    async def test_post(self, client):
+        query = dns.message.make_query('host2.test', 'A')
+        stream_id = client.request('POST', '/dns-query', query.to_wire(), [('content-type', CONTENT_TYPE)])
+        headers, body = (await client.responses([stream_id]))[stream_id]
+        assert headers[':status'] == '200'
+        assert dns.message.from_wire(body).answer[0][0].address == '192.0.2.2'
+
+    async def test_multiplexed(self, client, stub_upstream):
+        queries = {f'host{i}.test': dns.message.make_query(f'host{i}.test', 'A') for i in range(20)}
+        streams = {client.request('GET', _get_path(q_)): host for host, q_ in queries.items()}
+        responses = await client.responses(list(streams))
+        for stream_id, (headers, body) in responses.items():
+            host = streams[stream_id]
+            resp = dns.message.from_wire(body)
+            assert queries[host].is_response(resp)
+            assert resp.answer[0][0].address == self.STUB_ZONE[host][0]
+
+    @pytest.mark.parametrize('method, path, body, headers, status', [
+        ('GET', '/other', b'', (), '404'),
+        ('GET', '/dns-query?dns=%%%', b'', (), '400'),
+        ('GET', '/dns-query', b'', (), '400'),
+        ('POST', '/dns-query', b'\x00', [('content-type', 'text/plain')], '415'),
+        ('POST', '/dns-query', b'\x00\x01', [('content-type', CONTENT_TYPE)], '400'),
+        ('PUT', '/dns-query', b'\x00', [('content-type', CONTENT_TYPE)], '405'),
+    ])
+    async def test_errors(self, client, method, path, body, headers, status):
+        stream_id = client.request(method, path, body, headers)
+        response_headers, _ = (await client.responses([stream_id]))[stream_id]
+        assert response_headers[':status'] == status
+
+    async def test_tls(self, server, certificate):
+        doh = DoHServer(server, local_port=0, cert_file=certificate[0], key_file=certificate[1])
+        await doh.start()
+        context = ssl.create_default_context(cafile=certificate[0])
+        context.set_alpn_protocols(['h2'])
+        client = await _Client.connect(*doh.address, ssl_context=context)
+        try:
+            assert client.writer.get_extra_info('ssl_object').selected_alpn_protocol() == 'h2'
+            query = dns.message.make_query('host3.test', 'A')
+            stream_id = client.request('GET', _get_path(query))
+            headers, body = (await client.responses([stream_id]))[stream_id]
+            assert dns.message.from_wire(body).answer[0][0].address == '192.0.2.3'
+        finally:
+            client.close()
+            await doh.stop()
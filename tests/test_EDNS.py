@@ -0,0 +1,148 @@
+import dns.asyncquery
+import dns.edns
+import dns.message
+import dns.rcode
+import dns.rrset
+import pytest
+
+import DNS.EDNS
+from DNS.Cache import AnswerCache
+from tests.test_Basic import _TestBase
+
+
+def _query(host='a.test', subnet=None, edns=True):
+    options = [dns.edns.ECSOption.from_text(subnet)] if subnet else None
+    return dns.message.make_query(host, 'A', use_edns=0 if edns else False, options=options)
+
+
+def _scoped_response(stub_response_factory, query, scope, address='192.0.2.1'):
+    _, resp = stub_response_factory(query.question[0].name.to_text(True), addresses=(address,))
+    ecs = DNS.EDNS.client_subnet(query)
+    resp.use_edns(0, 0, options=[dns.edns.ECSOption(ecs.address, ecs.srclen, scope)])
+    return resp
+
+
+class TestPrepareQuery:
+    def test_strip(self):
+        query = _query(subnet='198.51.100.0/24')
+        client_ecs = DNS.EDNS.prepare_query(query, '127.0.0.1', DNS.EDNS.STRIP)
+        assert client_ecs.srclen == 24
+        assert DNS.EDNS.client_subnet(query) is None
+
+    def test_forward_shortens_prefix(self):
+        query = _query(subnet='198.51.100.7/32')
+        DNS.EDNS.prepare_query(query, '127.0.0.1', DNS.EDNS.FORWARD, ipv4_prefix=24)
+        assert DNS.EDNS.client_subnet(query).to_text() == 'ECS 198.51.100.0/24 scope/0'
+
+    def test_forward_without_ecs(self):
+        query = _query()
+        assert DNS.EDNS.prepare_query(query, '198.51.100.7', DNS.EDNS.FORWARD) is None
+        assert DNS.EDNS.client_subnet(query) is None
+
+    @pytest.mark.parametrize('host, edns, expected', [
+        ('198.51.100.7', True, 'ECS 198.51.100.0/24 scope/0'),
+        ('198.51.100.7', False, 'ECS 198.51.100.0/24 scope/0'),
+        ('2001:db8:1:2ff::1', True, 'ECS 2001:db8:1:200::/56 scope/0'),
+        ('::ffff:198.51.100.7', True, 'ECS 198.51.100.0/24 scope/0'),
+    ])
+    def test_synthesize(self, host, edns, expected):
+        query = _query(edns=edns)
+        assert DNS.EDNS.prepare_query(query, host, DNS.EDNS.SYNTHESIZE) is None
+        assert DNS.EDNS.client_subnet(query).to_text() == expected
+
+    def test_synthesize_keeps_opt_out(self):
+        query = _query(subnet='0.0.0.0/0')
+        DNS.EDNS.prepare_query(query, '198.51.100.7', DNS.EDNS.SYNTHESIZE)
+        assert DNS.EDNS.client_subnet(query).srclen == 0
+
+
+class TestMergeResponse:
+    def test_rcode_and_sections(self, stub_response_factory):
+        query = _query('missing.test')
+        upstream = dns.message.make_response(query)
+        upstream.set_rcode(dns.rcode.NXDOMAIN)
+        upstream.authority.append(dns.rrset.from_text('test.', 60, 'IN', 'SOA',
+                                                      'ns.test. admin.test. 1 3600 600 86400 60'))
+        resp = DNS.EDNS.merge_response(dns.message.make_response(query), upstream)
+        assert resp.rcode() == dns.rcode.NXDOMAIN
+        assert resp.authority == upstream.authority
+
+    def test_client_subnet_echo(self, stub_response_factory):
+        query = _query(subnet='198.51.100.7/32')
+        client_ecs = DNS.EDNS.prepare_query(query, '127.0.0.1', DNS.EDNS.FORWARD)
+        upstream = _scoped_response(stub_response_factory, query, 16)
+        resp = DNS.EDNS.merge_response(dns.message.make_response(_query(subnet='198.51.100.7/32')), upstream,
+                                       client_ecs)
+        assert DNS.EDNS.client_subnet(resp).to_text() == 'ECS 198.51.100.7/32 scope/16'
+
+    def test_no_echo_without_client_subnet(self, stub_response_factory):
+        query = _query()
+        DNS.EDNS.prepare_query(query, '198.51.100.7', DNS.EDNS.SYNTHESIZE)
+        upstream = _scoped_response(stub_response_factory, query, 24)
+        resp = DNS.EDNS.merge_response(dns.message.make_response(_query()), upstream)
+        assert DNS.EDNS.client_subnet(resp) is None
+
+
+class TestScopedCache:
+    def test_partitioned_by_scope(self, stub_response_factory):
+        cache = AnswerCache()
+        query_a = _query(subnet='198.51.100.0/24')
+        cache.put(cache.key(query_a, _scoped_response(stub_response_factory, query_a, 16)),
+                  _scoped_response(stub_response_factory, query_a, 16))
+        query_b = _query(subnet='198.51.7.0/24')
+        query_c = _query(subnet='203.0.113.0/24')
+        assert cache.get(cache.key(query_b)) is not None
+        assert cache.get(cache.key(query_c)) is None
+        assert cache.get(cache.key(_query())) is None
+
+    def test_global_answer(self, stub_response_factory):
+        cache = AnswerCache()
+        query = _query(subnet='198.51.100.0/24')
+        resp = _scoped_response(stub_response_factory, query, 0)
+        cache.put(cache.key(query, resp), resp)
+        assert cache.get(cache.key(_query(subnet='203.0.113.0/24'))) is not None
+        assert cache.get(cache.key(_query())) is not None
+
+    def test_scopes_are_forgotten(self, stub_response_factory):
+        cache = AnswerCache(size=1)
+        query = _query(subnet='198.51.100.0/24')
+        resp = _scoped_response(stub_response_factory, query, 24)
+        key = cache.key(query, resp)
+        cache.put(key, resp)
+        assert cache._scopes
+        cache.remove(key)
+        assert not cache._scopes
+        cache.put(key, resp)
+        query_, resp_ = stub_response_factory('b.test')
+        cache.put(cache.key(query_, resp_), resp_)
+        assert not cache._scopes
+
+
+@pytest.mark.parametrize('server_conf', [{'DNSPY__ECS_MODE': 'synthesize'}], indirect=['server_conf'])
+class TestServerECS(_TestBase):
+    STUB_ZONE = {'cdn.test': ['192.0.2.1']}
+    STUB_OPTIONS = {'ecs_scope': 16}
+
+    async def _resolve(self, server_conf, query):
+        return await dns.asyncquery.udp(query, server_conf.local_ip.__str__(), port=server_conf.local_port,
+                                        timeout=2)
+
+    async def test_cache_per_scope(self, server, server_conf, stub_upstream):
+        received = stub_upstream.received
+        resp = await self._resolve(server_conf, _query('cdn.test', subnet='198.51.100.0/24'))
+        assert DNS.EDNS.client_subnet(resp).to_text() == 'ECS 198.51.100.0/24 scope/16'
+        assert resp.answer[0][0].address == '192.0.2.1'
+        await self._resolve(server_conf, _query('cdn.test', subnet='198.51.7.0/24'))
+        assert stub_upstream.received == received + 1
+        await self._resolve(server_conf, _query('cdn.test', subnet='203.0.113.0/24'))
+        assert stub_upstream.received == received + 2
+        assert stub_upstream.subnets[-1] == '203.0.113.0/24'
+
+    async def test_synthesized(self, server, server_conf, stub_upstream):
+        resp = await self._resolve(server_conf, _query('cdn.test', edns=False))
+        assert resp.edns < 0
+        assert stub_upstream.subnets[-1] == '127.0.0.0/24'
+
+    async def test_nxdomain(self, server, server_conf):
+        resp = await self._resolve(server_conf, _query('missing.test'))
+        assert resp.rcode() == dns.rcode.NXDOMAIN
@@ -0,0 +1,110 @@
+import asyncio
+
+import dns.asyncquery
+import dns.message
+import dns.rcode
+import pytest
+
+from DNS.Guard import CLOSED, PluginFailure, PluginGuard
+from tests.test_Basic import _TestBase
+
+
+class _FakeClock:
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+async def _slow():
+    await asyncio.sleep(1)
+
+
+async def _fast():
+    return 'done'
+
+
+async def _broken():
+    raise ValueError('backend is down')
+
+
+@pytest.mark.asyncio
+class TestPluginGuard:
+    async def test_within_budget(self):
+        guard = PluginGuard('Test.Plugin', budget=0.5)
+        assert await guard.run(_fast) == 'done'
+        assert guard.counters['calls'] == 1 and guard.counters['overruns'] == 0
+
+    async def test_fail_open(self):
+        guard = PluginGuard('Test.Plugin', budget=0.01)
+        assert await guard.run(_slow) is None
+        assert await guard.run(_broken) is None
+        assert (guard.counters['overruns'], guard.counters['errors']) == (1, 1)
+
+    async def test_fail_closed(self):
+        guard = PluginGuard('Test.Plugin', budget=0.01, fail=CLOSED)
+        with pytest.raises(PluginFailure):
+            await guard.run(_slow)
+
+    async def test_breaker(self):
+        clock = _FakeClock()
+        guard = PluginGuard('Test.Plugin', budget=0.01, breaker_threshold=2, breaker_cooldown=5, clock=clock)
+        await guard.run(_broken)
+        assert not guard.tripped
+        await guard.run(_slow)
+        assert guard.tripped and guard.counters['trips'] == 1
+        # plugin is not called while tripped
+        assert await guard.run(_fast) is None
+        assert guard.counters['skipped'] == 1
+        clock.now = 6
+        # a failed probe trips breaker again
+        await guard.run(_broken)
+        assert guard.tripped and await guard.run(_fast) is None
+        clock.now = 12
+        assert await guard.run(_fast) == 'done'
+        assert not guard.tripped and guard.failures == 0
+
+    async def test_breaker_closed_mode(self):
+        guard = PluginGuard('Test.Plugin', fail=CLOSED, breaker_threshold=1, breaker_cooldown=5)
+        with pytest.raises(PluginFailure):
+            await guard.run(_broken)
+        with pytest.raises(PluginFailure, match='tripped'):
+            await guard.run(_fast)
+
+
+class _GuardedServerBase(_TestBase):
+    @pytest.fixture()
+    def slow_plugin(self, server, monkeypatch):
+        plugin = server.plugins[0]
+
+        async def _on_query(_):
+            await asyncio.sleep(1)
+
+        monkeypatch.setattr(plugin, 'on_query', _on_query)
+        return server.chain.guards[id(plugin)]
+
+    async def _resolve(self, server_conf, host):
+        return await dns.asyncquery.udp(dns.message.make_query(host, 'A'), server_conf.local_ip.__str__(),
+                                        port=server_conf.local_port, timeout=2)
+
+
+@pytest.mark.parametrize('server_conf', [{'DNSPY__PLUGINS': '["QueryLog.Log"]', 'DNSPY__PLUGIN_BUDGET': '0.05'}],
+                         indirect=['server_conf'])
+class TestServerFailOpen(_GuardedServerBase):
+    async def test_skipped(self, server, server_conf, slow_plugin):
+        resp = await self._resolve(server_conf, self.EXAMPLE_HOST)
+        assert resp.answer[0][0].address == self.STUB_ZONE[self.EXAMPLE_HOST][0]
+        assert slow_plugin.counters['overruns'] == 1
+        assert server.chain.stats()['QueryLog.Log']['overruns'] == 1
+
+
+@pytest.mark.parametrize('server_conf', [{'DNSPY__PLUGINS': '["QueryLog.Log"]', 'DNSPY__PLUGIN_BUDGET': '0.05',
+                                          'DNSPY__PLUGIN__QUERYLOG.LOG__HOOK_FAIL': 'closed'}],
+                         indirect=['server_conf'])
+class TestServerFailClosed(_GuardedServerBase):
+    async def test_servfail(self, server, server_conf, slow_plugin):
+        resp = await self._resolve(server_conf, self.EXAMPLE_HOST)
+        assert resp.rcode() == dns.rcode.SERVFAIL
+        assert not resp.answer
+        assert slow_plugin.fail == CLOSED
@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+
+import DNS.Bloom
+import DNS.Config
+import DNS.Storage
+from DNS.Memory import PRIORITY_CACHE, PRIORITY_INDEX, PRIORITY_RATE_LIMIT, Component, MemoryAccountant
+from tests.test_Basic import _TestBase
+
+
+class _Consumer:
+    def __init__(self, nbytes, shrinkable=True):
+        self.nbytes = nbytes
+        self.shrunk = []
+        self.shrinkable = shrinkable
+
+    def shrink(self, nbytes):
+        freed = min(nbytes, self.nbytes)
+        self.nbytes -= freed
+        self.shrunk.append(freed)
+        return freed
+
+    def component(self, priority):
+        return Component(lambda: self.nbytes, self.shrink if self.shrinkable else None, priority)
+
+
+class TestMemoryAccountant:
+    def test_usage(self):
+        memory = MemoryAccountant()
+        memory.register('cache', _Consumer(100).component(PRIORITY_CACHE))
+        memory.register('plugin:A.B:filter', _Consumer(50).component(PRIORITY_INDEX))
+        memory.register('plugin:A.B:index', _Consumer(25).component(PRIORITY_INDEX))
+        # accounting only
+        assert memory.check() == 0
+        assert memory.state()['total'] == 175 and memory.state()['components']['cache'] == 100
+        memory.unregister('plugin:')
+        assert list(memory.usage()) == ['cache']
+
+    def test_shrink_by_priority(self):
+        memory = MemoryAccountant(budget=1000, low_water=0.9)
+        cache, limiter, index = _Consumer(600), _Consumer(300), _Consumer(200)
+        memory.register('filter', index.component(PRIORITY_INDEX))
+        memory.register('rate_limit', limiter.component(PRIORITY_RATE_LIMIT))
+        memory.register('cache', cache.component(PRIORITY_CACHE))
+        # 1100 bytes are down to 900
+        assert memory.check() == 200
+        assert (cache.shrunk, limiter.shrunk, index.shrunk) == ([200], [], [])
+        assert memory.check() == 0
+        cache.nbytes, limiter.nbytes = 0, 900
+        assert memory.check() == 200 and limiter.shrunk == [200] and not index.shrunk
+        assert memory.counters == {'checks': 3, 'over_budget': 2, 'freed': 400}
+
+    def test_unshrinkable(self):
+        memory = MemoryAccountant(budget=100)
+        cache, shared = _Consumer(50), _Consumer(200, shrinkable=False)
+        memory.register('cache', cache.component(PRIORITY_CACHE))
+        memory.register('shared_cache', shared.component(PRIORITY_CACHE))
+        assert memory.check() == 50 and cache.nbytes == 0 and shared.nbytes == 200
+        assert memory._short
+
+    @pytest.mark.asyncio
+    async def test_loop(self):
+        memory = MemoryAccountant(budget=10, check_interval=0.01)
+        cache = _Consumer(100)
+        memory.register('cache', cache.component(PRIORITY_CACHE))
+        memory.start()
+        await asyncio.sleep(0.05)
+        memory.stop()
+        assert cache.nbytes == 9 and memory._task is None
+        # disabled budget doesn't start the loop
+        memory = MemoryAccountant()
+        memory.start()
+        assert memory._task is None
+
+
+@pytest.mark.asyncio
+class TestAuthoritativeComponents:
+    async def test_filter(self, monkeypatch):
+        monkeypatch.chdir('../')
+        monkeypatch.setenv('DNSPY__PLUGINS', '["Authoritative.BlackList"]')
+        monkeypatch.setenv('DNSPY__PLUGIN__AUTHORITATIVE.BLACKLIST__RESPONSE_IP', '["10.0.0.1"]')
+        DNS.Config.Configuration.load()
+        from Plugins.Authoritative import BlackList
+
+        blacklist = BlackList([], redis=object())
+        assert blacklist.memory_components() == {}
+        blacklist._filter_task = object()
+        filter_ = DNS.Bloom.BloomFilter(10000)
+        blacklist.filter = filter_
+        component = blacklist.memory_components()['filter']
+        assert component.usage() == filter_.nbytes and component.priority == PRIORITY_INDEX
+        assert component.shrink(1) == filter_.nbytes
+        assert blacklist.filter is None and component.usage() == 0 and component.shrink(1) == 0
+
+    async def test_index(self, tmp_path, monkeypatch):
+        path = str(tmp_path / 'black.idx')
+        DNS.Storage.compile_index([('blocked.test', '')], path)
+        monkeypatch.chdir('../')
+        monkeypatch.setenv('DNSPY__PLUGINS', '["Authoritative.BlackList"]')
+        monkeypatch.setenv('DNSPY__PLUGIN__AUTHORITATIVE.BLACKLIST__STORAGE', 'file')
+        monkeypatch.setenv('DNSPY__PLUGIN__AUTHORITATIVE.BLACKLIST__INDEX_PATH', path)
+        monkeypatch.setenv('DNSPY__PLUGIN__AUTHORITATIVE.BLACKLIST__RESPONSE_IP', '["10.0.0.1"]')
+        DNS.Config.Configuration.load()
+        from Plugins.Authoritative import BlackList
+
+        blacklist = BlackList([])
+        component = blacklist.memory_components()['index']
+        assert component.usage() == blacklist.storage.index.nbytes > 0 and component.shrink is None
+        await blacklist.close()
+
+
+@pytest.mark.parametrize('server_conf', [{'DNSPY__MEMORY_BUDGET': '1', 'DNSPY__MEMORY_CHECK_INTERVAL': '100',
+                                          'DNSPY__RATE_LIMIT': '1000', 'DNSPY__SHARED_CACHE_SLOTS': '0'}],
+                         indirect=['server_conf'])
+class TestServerMemory(_TestBase):
+    async def test_budget(self, server, resolve_local_a):
+        await resolve_local_a(self.EXAMPLE_HOST)
+        usage = server.memory.usage()
+        assert usage['cache'] > 0 and usage['rate_limit'] > 0
+        # cache is shrunk first, rate limit table after it
+        assert server.memory.check() == sum(usage.values())
+        assert len(server.cache) == 0 and len(server.rate_limiter) == 0
+        assert server.memory._task is not None
@@ -1,9 +1,16 @@
 # noinspection PyPackageRequirements
 
+import asyncio
+
+import dns.message
 import fakeredis.aioredis
 import pytest
 
-from tests.helpers import extract_address_from_a_response as eafar
+import DNS.Config
+import DNS.Context
+import DNS.Storage
+
+from tests.helpers import StreamFakeRedis, extract_address_from_a_response as eafar
 from tests.test_Basic import _TestBase
 
 
@@ -15,6 +22,12 @@ class _AuthoritativeTestBase(_TestBase):
         'wildcard': '*.test.com',
         'ip': {"1.2.3.4", "5.6.7.8"},
     }
+    STUB_ZONE = {
+        _TestBase.EXAMPLE_HOST: ['93.184.216.34'],
+        FAKE_REC['domain']: ['192.0.2.1'],
+        FAKE_REC['subdomain_1']: ['192.0.2.2'],
+        FAKE_REC['subdomain_2']: ['192.0.2.3'],
+    }
 
     def redis_key(self, server_conf):
         return getattr(server_conf, self._redis_key)
@@ -206,6 +219,27 @@ server_config_whitelist = {
     'DNSPY__PLUGIN__AUTHORITATIVE.WHITELIST__RESPONSE_IP': list(_AuthoritativeTestBase.FAKE_REC['ip'])
 }
 
+server_config_localdb_file = {
+    'DNSPY__PLUGINS': '["Authoritative.LocalDB"]',
+    'DNSPY__PLUGIN__AUTHORITATIVE.LOCALDB__STORAGE': 'file',
+}
+server_config_blacklist_file = {
+    **server_config_blacklist,
+    'DNSPY__PLUGIN__AUTHORITATIVE.BLACKLIST__STORAGE': 'file',
+}
+
+server_config_bloom = {
+    'DNSPY__PLUGIN__AUTHORITATIVE__BLOOM_FILTER': 'true',
+    'DNSPY__PLUGIN__AUTHORITATIVE__BLOOM_CHECK_INTERVAL': '0.05',
+}
+server_config_blacklist_bloom = {**server_config_blacklist, **server_config_bloom}
+server_config_whitelist_bloom = {**server_config_whitelist, **server_config_bloom}
+
+server_config_batch = {
+    'DNSPY__PLUGIN_BATCH_WINDOW': '0.01',
+    'DNSPY__PLUGIN_BATCH_SIZE': '8',
+}
+
 
 @pytest.mark.parametrize('server_conf', [server_config_localdb], indirect=['server_conf'])
 class TestLocalDB(_TestLocalDB):
@@ -220,3 +254,314 @@ class TestBlackList(_TestBlackList):
 @pytest.mark.parametrize('server_conf', [server_config_whitelist], indirect=['server_conf'])
 class TestWhiteList(_TestWhiteList):
     pass
+
+
+class _BloomFilterTestBase(_AuthoritativeTestBase):
+    @pytest.fixture(scope='class')
+    async def redis(self, server):
+        redis = fakeredis.aioredis.FakeRedis(decode_responses=True)
+        server.plugins[0].redis = redis
+        await server.plugins[0].rebuild_filter()
+        yield redis
+
+    @pytest.fixture(scope='function')
+    async def redis_sadd(self, redis, server):
+        created_records = []
+
+        async def _sadd(key, value):
+            await redis.sadd(key, value)
+            server.plugins[0].add_to_filter(value)
+            created_records.append(dict(key=key, val=value))
+
+        yield _sadd
+        for record in created_records:
+            await redis.srem(record['key'], record['val'])
+
+    async def test_skip_redis(self, redis, server, resolve_local_a, monkeypatch):
+        calls = []
+        sismember = redis.sismember
+
+        async def _sismember(*args):
+            calls.append(args)
+            return await sismember(*args)
+
+        monkeypatch.setattr(redis, 'sismember', _sismember)
+        await server.plugins[0].rebuild_filter()
+        await resolve_local_a(self.EXAMPLE_HOST)
+        assert not calls
+
+    async def test_external_change(self, redis, server, server_conf, resolve_local_a):
+        key = self.redis_key(server_conf)
+        await asyncio.sleep(0.1)
+        assert server.plugins[0].filter is not None
+        await redis.sadd(key, self.FAKE_REC['domain'])
+        try:
+            await asyncio.sleep(0.2)
+            local = await resolve_local_a(self.FAKE_REC['domain'])
+            assert (eafar(local) == self.FAKE_REC['ip']) == (self._redis_key == _TestBlackList._redis_key)
+            assert self.FAKE_REC['domain'] in server.plugins[0].filter
+        finally:
+            await redis.srem(key, self.FAKE_REC['domain'])
+
+    async def test_filter_size(self, redis, server, server_conf):
+        key = self.redis_key(server_conf)
+        names = [f'host{i}.size.test' for i in range(4000)]
+        await redis.sadd(key, *names)
+        try:
+            await server.plugins[0].rebuild_filter()
+            filter_ = server.plugins[0].filter
+            assert filter_.count == 4000
+            # about 1.2 bytes per name with 1% error rate and 25% headroom
+            assert filter_.nbytes < 4000 * 1.25 * 1.2
+            assert all(x in filter_ for x in names)
+        finally:
+            await redis.srem(key, *names)
+
+
+@pytest.mark.parametrize('server_conf', [server_config_blacklist_bloom], indirect=['server_conf'])
+class TestBlackListBloomFilter(_BloomFilterTestBase, _TestBlackList):
+    pass
+
+
+@pytest.mark.parametrize('server_conf', [server_config_whitelist_bloom], indirect=['server_conf'])
+class TestWhiteListBloomFilter(_BloomFilterTestBase, _TestWhiteList):
+    pass
+
+
+@pytest.mark.parametrize('server_conf', [{**server_config_localdb, **server_config_batch}], indirect=['server_conf'])
+class TestLocalDBBatch(_TestLocalDB):
+    pass
+
+
+@pytest.mark.parametrize('server_conf', [{**server_config_blacklist, **server_config_batch}],
+                         indirect=['server_conf'])
+class TestBlackListBatch(_TestBlackList):
+    async def test_coalesced(self, server, server_conf, redis_sadd, resolve_local_a, monkeypatch):
+        key = self.redis_key(server_conf)
+        await redis_sadd(key, self.FAKE_REC['wildcard'])
+        storage = server.plugins[0].storage
+        calls = []
+
+        async def _sismember_many(key_, members):
+            calls.append(members)
+            return await DNS.Storage.RedisStorage.sismember_many(storage, key_, members)
+
+        monkeypatch.setattr(storage, 'sismember_many', _sismember_many)
+        hosts = [self.FAKE_REC['subdomain_1'], self.EXAMPLE_HOST] * 8
+        responses = await asyncio.gather(*[resolve_local_a(x) for x in hosts])
+        for host, resp in zip(hosts, responses):
+            assert (eafar(resp) == self.FAKE_REC['ip']) == (host != self.EXAMPLE_HOST)
+        assert len(calls) == 2
+        # candidates shared by queries (e.g. "*.com") are looked up once per batch
+        assert all(len(x) == len(set(x)) for x in calls)
+
+
+@pytest.mark.parametrize('server_conf', [{**server_config_whitelist, **server_config_batch}],
+                         indirect=['server_conf'])
+class TestWhiteListBatch(_TestWhiteList):
+    pass
+
+
+class _FileStorageTestBase(_AuthoritativeTestBase):
+    """
+    records are compiled into index file instead of being written to redis
+    """
+
+    @pytest.fixture(scope='class', autouse=True)
+    def index_path(self, tmp_path_factory, monkeyclass):
+        path = str(tmp_path_factory.mktemp('index') / 'list.idx')
+        DNS.Storage.compile_index([], path)
+        plugin = self._redis_key.split('__')[1].upper()
+        monkeyclass.setenv(f'DNSPY__PLUGIN__{plugin}__INDEX_PATH', path)
+        return path
+
+    @pytest.fixture(scope='function')
+    def entries(self, server, index_path):
+        entries = {}
+
+        def _compile():
+            DNS.Storage.compile_index(entries.items(), index_path)
+            server.plugins[0].storage.reload()
+
+        yield entries, _compile
+        entries.clear()
+        _compile()
+
+    @pytest.fixture(scope='function')
+    def redis_hset(self, entries):
+        entries_, compile_ = entries
+
+        async def _hset(_, key, value):
+            entries_[key] = value
+            compile_()
+
+        return _hset
+
+    @pytest.fixture(scope='function')
+    def redis_sadd(self, entries):
+        entries_, compile_ = entries
+
+        async def _sadd(_, value):
+            entries_[value] = ''
+            compile_()
+
+        return _sadd
+
+
+@pytest.mark.parametrize('server_conf', [server_config_localdb_file], indirect=['server_conf'])
+class TestLocalDBFileStorage(_FileStorageTestBase, _TestLocalDB):
+    def test_no_redis(self, server):
+        assert server.plugins[0].redis is None
+        assert isinstance(server.plugins[0].storage, DNS.Storage.FileStorage)
+
+    async def test_reload_lists(self, server, index_path):
+        DNS.Storage.compile_index([('a.test', '10.0.0.1'), ('b.test', '10.0.0.2')], index_path)
+        result = await server.plugins[0].reload_lists()
+        assert result == {'index': index_path, 'reloaded': True, 'names': 2}
+        assert await server.plugins[0].storage.hget(None, 'b.test') == '10.0.0.2'
+        DNS.Storage.compile_index([], index_path)
+        server.plugins[0].storage.reload()
+
+
+@pytest.mark.parametrize('server_conf', [server_config_blacklist_file], indirect=['server_conf'])
+class TestBlackListFileStorage(_FileStorageTestBase, _TestBlackList):
+    pass
+
+
+server_config_inquirer = {
+    **server_config_blacklist, 'DNSPY__PLUGINS': '["Authoritative.BlackList", "Google403.Inquirer"]',
+    'DNSPY__PLUGIN__AUTHORITATIVE.BLACKLIST__RESPONSE_IP': '["10.0.0.1"]',
+    'DNSPY__PLUGIN__GOOGLE403.INQUIRER__PROBE_IN_PROCESS': 'false',
+}
+
+
+def _inquirer_query(host):
+    return DNS.Context.QueryContext(dns.message.make_query(host, 'A'), ('127.0.0.1', 0))
+
+
+@pytest.mark.asyncio
+class TestInquirerConfig:
+    async def test_init(self, monkeypatch):
+        monkeypatch.chdir('../')
+        for k_, v_ in server_config_inquirer.items():
+            monkeypatch.setenv(k_, v_)
+        DNS.Config.Configuration.load()
+        from Plugins.Authoritative import BlackList
+        from Plugins.Google403 import Inquirer
+
+        redis = StreamFakeRedis(decode_responses=True)
+        await redis.sadd('G403_block', 'blocked.test')
+        blacklist = BlackList([], redis=redis)
+        inquirer = Inquirer([blacklist], redis=redis)
+        assert inquirer.storage_type == 'redis'
+        assert isinstance(inquirer.storage, DNS.Storage.RedisStorage)
+        await asyncio.sleep(0.05)
+        assert await redis.sismember('BLDB', '*.blocked.test')
+        for host in ['Known.test', 'New.test', 'new.test']:
+            await inquirer.on_query(_inquirer_query(host))
+        await redis.sadd('G403_open', 'known.test')
+        assert await redis.smembers('G403_que') >= {'known.test', 'new.test'}
+        # a queued domain is added to stream once
+        assert [x[1]['host'] for x in redis.streams['G403_stream']] == ['known.test', 'new.test']
+        await redis.srem('G403_que', 'known.test', 'new.test')
+        await inquirer.on_query(_inquirer_query('known.test'))
+        assert not await redis.sismember('G403_que', 'known.test')
+        await inquirer.close()
+        await blacklist.close()
+        await redis.close()
+
+
+@pytest.mark.asyncio
+class TestProber:
+    @pytest.fixture()
+    async def setup(self, monkeypatch):
+        monkeypatch.chdir('../')
+        for k_, v_ in server_config_inquirer.items():
+            monkeypatch.setenv(k_, v_)
+        DNS.Config.Configuration.load()
+        from Plugins.Authoritative import BlackList
+        from Plugins.Google403 import Inquirer
+
+        async def _is_blocked(host):
+            return 'b' if host.startswith('blocked') else 'o'
+
+        monkeypatch.setattr(Inquirer, 'is_blocked', staticmethod(_is_blocked))
+        clock = [0.]
+        redis = StreamFakeRedis(decode_responses=True, clock=lambda: clock[0])
+        blacklist = BlackList([], redis=redis)
+        plugins = []
+
+        def _inquirer(consumer):
+            plugins.append(Inquirer([blacklist], redis=redis, consumer=consumer))
+            plugins[-1].prober.block = 10
+            return plugins[-1]
+
+        yield redis, _inquirer, clock
+        for p_ in plugins:
+            await p_.close()
+        await blacklist.close()
+        await redis.close()
+
+    @staticmethod
+    async def _run(probers, condition):
+        tasks = [asyncio.get_event_loop().create_task(x.run()) for x in probers]
+        try:
+            for _ in range(100):
+                if condition():
+                    return
+                await asyncio.sleep(0.01)
+            raise AssertionError('probers did not finish')
+        finally:
+            for t_ in tasks:
+                t_.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def test_probe(self, setup):
+        redis, _inquirer, _ = setup
+        inquirers = [_inquirer('a'), _inquirer('b')]
+        hosts = ['blocked.test', 'open.test', 'blocked2.test', 'open2.test']
+        for host in hosts:
+            await inquirers[0].on_query(_inquirer_query(host))
+        probers = [x.prober for x in inquirers]
+        await self._run(probers, lambda: sum(x.counters['probed'] for x in probers) == len(hosts))
+        # each domain is probed by one of the probers of group
+        assert sum(x.counters['probed'] for x in probers) == len(hosts)
+        assert await redis.smembers('G403_block') == {'blocked.test', 'blocked2.test'}
+        assert await redis.smembers('G403_open') == {'open.test', 'open2.test'}
+        assert await redis.sismember('BLDB', '*.blocked2.test')
+        assert not await redis.smembers('G403_que')
+        assert not await redis.xpending_range('G403_stream', 'G403_probers', '-', '+', 10)
+
+    async def test_claim(self, setup):
+        redis, _inquirer, clock = setup
+        dead, alive = _inquirer('dead'), _inquirer('alive')
+        await dead.on_query(_inquirer_query('blocked.test'))
+        await dead.prober.create_group()
+        # read but never acknowledged
+        assert len(await dead.prober.read(10)) == 1
+        assert await alive.prober.claim(10) == []
+        clock[0] += dead.config.claim_idle
+        await self._run([alive.prober], lambda: alive.prober.counters['probed'] == 1)
+        assert alive.prober.counters['claimed'] == 1
+        assert await redis.sismember('G403_block', 'blocked.test')
+        assert not await redis.xpending_range('G403_stream', 'G403_probers', '-', '+', 10)
+
+    async def test_restart(self, setup):
+        redis, _inquirer, _ = setup
+        first = _inquirer('a')
+        for host in ['blocked.test', 'open.test']:
+            await first.on_query(_inquirer_query(host))
+        await first.prober.create_group()
+        assert len(await first.prober.read(10)) == 2
+        # a prober restarted with same consumer name probes its pending entries
+        second = _inquirer('a')
+        await self._run([second.prober], lambda: second.prober.counters['probed'] == 2)
+        assert second.prober.counters['claimed'] == 0
+        assert await redis.smembers('G403_open') == {'open.test'}
+
+    async def test_legacy_que(self, setup):
+        redis, _inquirer, _ = setup
+        await redis.sadd('G403_que', 'open.test')
+        inquirer = _inquirer('a')
+        await self._run([inquirer.prober], lambda: inquirer.prober.counters['probed'] == 1)
+        assert await redis.smembers('G403_open') == {'open.test'}
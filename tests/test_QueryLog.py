@@ -0,0 +1,59 @@
+import json
+import os
+
+import pytest
+
+from Plugins.QueryLog import JsonWriter
+from tests.test_Basic import _TestBase
+
+
+class _FakeClock:
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+class TestJsonWriter:
+    def test_buffer(self, tmp_path):
+        path = str(tmp_path / 'query.log')
+        clock = _FakeClock()
+        writer = JsonWriter(path, flush_interval=1, max_records=3, clock=clock)
+        writer.write({'qname': 'a.test'})
+        writer.write({'qname': 'b.test'})
+        assert os.path.getsize(path) == 0
+        clock.now = 1
+        writer.write({'qname': 'c.test'})
+        with open(path) as f_:
+            assert [json.loads(x)['qname'] for x in f_] == ['a.test', 'b.test', 'c.test']
+        writer.close()
+
+    def test_rotation(self, tmp_path):
+        path = str(tmp_path / 'query.log')
+        writer = JsonWriter(path, max_records=1)
+        writer.write({'qname': 'a.test'})
+        os.rename(path, f'{path}.1')
+        writer.write({'qname': 'b.test'})
+        writer.close()
+        with open(path) as f_, open(f'{path}.1') as f1_:
+            assert (len(f1_.readlines()), len(f_.readlines())) == (1, 1)
+
+
+@pytest.mark.parametrize('server_conf', [{'DNSPY__PLUGINS': '["QueryLog.Log"]',
+                                          'DNSPY__PLUGIN__QUERYLOG.LOG__FORMAT': 'json'}], indirect=['server_conf'])
+class TestServerJsonLog(_TestBase):
+    @pytest.fixture(scope='class', autouse=True)
+    def log_path(self, tmp_path_factory, monkeyclass):
+        path = str(tmp_path_factory.mktemp('querylog') / 'query.log')
+        monkeyclass.setenv('DNSPY__PLUGIN__QUERYLOG.LOG__PATH', path)
+        return path
+
+    async def test_record(self, server, resolve_local_a, log_path):
+        await resolve_local_a(self.EXAMPLE_HOST)
+        server.plugins[0].writer.flush()
+        with open(log_path) as f_:
+            record = json.loads(f_.readlines()[-1])
+        assert record['qname'] == self.EXAMPLE_HOST and record['qtype'] == 'A' and record['rcode'] == 'NOERROR'
+        assert record['client'] == '127.0.0.1' and record['ttl'] > 0 and record['answers'] == 1
+        assert record['local'] is False
@@ -0,0 +1,83 @@
+import dns.asyncquery
+import dns.flags
+import dns.message
+import dns.rcode
+import pytest
+
+from DNS.RateLimit import ALLOW, BUCKET_BYTES, DROP, REFUSE, SLIP, RateLimiter, client_key, error_response
+from tests.test_Basic import _TestBase
+
+
+class _FakeClock:
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self):
+        return self.now
+
+
+class TestRateLimiter:
+    def test_client_key(self):
+        assert client_key('192.0.2.1') == client_key('192.0.2.200')
+        assert client_key('192.0.2.1') != client_key('192.0.3.1')
+        assert client_key('192.0.2.1', ipv4_prefix=32) != client_key('192.0.2.2', ipv4_prefix=32)
+        assert client_key('2001:db8:0:1::1') == client_key('2001:db8:0:2::1')
+        assert client_key('2001:db8:0:100::1') != client_key('2001:db8::1')
+
+    def test_bucket(self):
+        clock = _FakeClock()
+        limiter = RateLimiter(rate=10, burst=5, action=REFUSE, clock=clock)
+        assert [limiter.check('192.0.2.1') for _ in range(6)] == [ALLOW] * 5 + [REFUSE]
+        assert limiter.check('198.51.100.1') == ALLOW
+        clock.now = 0.25
+        assert [limiter.check('192.0.2.1') for _ in range(3)] == [ALLOW, ALLOW, REFUSE]
+        assert limiter.counters == {ALLOW: 8, DROP: 0, SLIP: 0, REFUSE: 2}
+
+    def test_slip(self):
+        limiter = RateLimiter(rate=1, burst=1, slip=3, clock=_FakeClock())
+        assert [limiter.check('192.0.2.1') for _ in range(7)] == [ALLOW, DROP, DROP, SLIP, DROP, DROP, SLIP]
+
+    def test_table_size(self):
+        limiter = RateLimiter(rate=1, table_size=10, ipv4_prefix=32, clock=_FakeClock())
+        for i_ in range(100):
+            limiter.check(f'192.0.2.{i_}')
+        assert len(limiter) == 10
+
+    def test_shrink(self):
+        limiter = RateLimiter(rate=1, ipv4_prefix=32, clock=_FakeClock())
+        for i_ in range(10):
+            limiter.check(f'192.0.2.{i_}')
+        assert limiter.nbytes == 10 * BUCKET_BYTES
+        assert limiter.shrink(BUCKET_BYTES + 1) == 2 * BUCKET_BYTES
+        assert len(limiter) == 8
+        # oldest buckets are dropped, so their clients start over
+        assert limiter.check('192.0.2.0') == ALLOW and limiter.check('192.0.2.2') == DROP
+        assert limiter.shrink(100 * BUCKET_BYTES) == 9 * BUCKET_BYTES and limiter.nbytes == 0
+
+    def test_error_response(self):
+        query = dns.message.make_query('example.com', 'A')
+        resp = dns.message.from_wire(error_response(query.to_wire(), truncated=True))
+        assert resp.id == query.id and resp.flags & dns.flags.TC and resp.flags & dns.flags.QR
+        assert resp.flags & dns.flags.RD
+        assert resp.question == query.question
+        resp = dns.message.from_wire(error_response(query.to_wire()))
+        assert resp.rcode() == dns.rcode.REFUSED
+        assert error_response(query.to_wire()[:20]) is None
+        assert error_response(b'\x00' * 5) is None
+        assert error_response(resp.to_wire()) is None
+
+
+@pytest.mark.parametrize('server_conf', [{'DNSPY__RATE_LIMIT': '1', 'DNSPY__RATE_LIMIT_BURST': '3',
+                                          'DNSPY__RATE_LIMIT_ACTION': 'refuse'}], indirect=['server_conf'])
+class TestServerRateLimit(_TestBase):
+    async def test_refuse(self, server, server_conf, stub_upstream):
+        received = stub_upstream.received
+        rcodes = []
+        for _ in range(5):
+            query = dns.message.make_query(self.EXAMPLE_HOST, 'A')
+            resp = await dns.asyncquery.udp(query, str(server_conf.local_ip), port=server_conf.local_port, timeout=1)
+            rcodes.append(resp.rcode())
+        assert rcodes[:3] == [dns.rcode.NOERROR] * 3
+        assert rcodes[3:] == [dns.rcode.REFUSED] * 2
+        assert stub_upstream.received == received + 1
+        assert server.rate_limiter.counters[REFUSE] == 2
@@ -0,0 +1,198 @@
+import asyncio
+
+import aioredis.exceptions
+import dns.message
+import fakeredis
+import fakeredis.aioredis
+import pytest
+
+import DNS.Config
+import DNS.Context
+import DNS.RedisTopology
+from DNS.RedisTopology import CLUSTER, REPLICA, SENTINEL, RedisTopology, RoutedRedis, key_slot, node_uri
+
+
+class _FakeNode(fakeredis.aioredis.FakeRedis):
+    """
+    a redis node with its own data. INFO replication, CLUSTER SLOTS and availability are set by tests
+    """
+
+    def __init__(self, uri, readonly=False, **kwargs):
+        super(_FakeNode, self).__init__(server=fakeredis.FakeServer(), decode_responses=True, **kwargs)
+        self.uri = uri
+        self.readonly = readonly
+        self.replication = {}
+        self.slots = []
+        self.down = False
+
+    async def info(self, section=None):
+        return self.replication
+
+    async def cluster(self, cluster_arg, *args):
+        return self.slots
+
+    async def ping(self, **kwargs):
+        if self.down:
+            raise aioredis.exceptions.ConnectionError('node is down')
+        return await super(_FakeNode, self).ping(**kwargs)
+
+
+class _Nodes(dict):
+    """
+    client factory of topology. keeps created nodes by "host:port"
+    """
+
+    def __call__(self, uri, readonly=False):
+        address = uri.rpartition('@')[2].split('//')[-1].split('/')[0]
+        node = self[address] = _FakeNode(uri, readonly)
+        return node
+
+
+class TestKeySlot:
+    def test_known_slots(self):
+        assert key_slot('123456789') == 0x31c3
+        assert key_slot('foo') == 12182
+        assert key_slot(b'bar') == 5061
+
+    def test_hash_tag(self):
+        assert key_slot('{user1000}.following') == key_slot('{user1000}.followers') == key_slot('user1000')
+        # empty tag is not a tag
+        assert key_slot('foo{}{bar}') != key_slot('bar')
+
+    def test_node_uri(self):
+        assert node_uri('redis://:pass@primary:6379/2?socket_timeout=1', ('10.0.0.2', 6380)) == \
+               'redis://:pass@10.0.0.2:6380/2?socket_timeout=1'
+        assert node_uri('redis://primary/0', ('::1', 6379)) == 'redis://[::1]:6379/0'
+
+
+@pytest.mark.asyncio
+class TestRedisTopology:
+    async def test_replica(self):
+        nodes = _Nodes()
+        topology = RedisTopology('redis://primary:6379/0', REPLICA, replicas=['replica-1:6379'], read_from='replica',
+                                 client_factory=nodes)
+        # before first refresh everything goes to primary
+        assert topology.reader('key') is nodes['primary:6379']
+        nodes['primary:6379'].replication = {'role': 'master', 'slave0': {'ip': 'replica-2', 'port': 6379,
+                                                                           'state': 'online'}}
+        await topology.refresh()
+        assert set(nodes) == {'primary:6379', 'replica-1:6379', 'replica-2:6379'}
+        topology.nodes[('replica-1', 6379)].latency = 0.01
+        topology.nodes[('replica-2', 6379)].latency = 0.001
+        assert topology.reader('key') is nodes['replica-2:6379']
+        assert topology.primary('key') is nodes['primary:6379']
+        topology.read_from = 'nearest'
+        topology.nodes[('primary', 6379)].latency = 0.0001
+        assert topology.reader('key') is nodes['primary:6379']
+        await topology.close()
+
+    async def test_unresponsive_replica(self):
+        nodes = _Nodes()
+        topology = RedisTopology('redis://primary:6379', REPLICA, replicas=['replica:6379'], read_from='replica',
+                                 client_factory=nodes)
+        await topology.refresh()
+        assert topology.reader() is nodes['replica:6379']
+        nodes['replica:6379'].down = True
+        await topology.refresh()
+        assert topology.nodes[('replica', 6379)].latency is None
+        assert topology.reader() is nodes['primary:6379']
+        await topology.close()
+
+    async def test_sentinel(self, monkeypatch):
+        nodes = _Nodes()
+        topology = RedisTopology('redis://:pass@ignored/1', SENTINEL, sentinels=['sentinel:26379'],
+                                 service='mymaster', client_factory=nodes)
+        with pytest.raises(aioredis.exceptions.ConnectionError):
+            topology.primary()
+        primary = ['10.0.0.1', 6379]
+
+        async def _master(_):
+            return tuple(primary)
+
+        async def _slaves(_):
+            return [('10.0.0.2', 6379)]
+
+        monkeypatch.setattr(topology.sentinel, 'discover_master', _master)
+        monkeypatch.setattr(topology.sentinel, 'discover_slaves', _slaves)
+        await topology.refresh()
+        assert topology.primary() is nodes['10.0.0.1:6379']
+        assert nodes['10.0.0.1:6379'].uri == 'redis://:pass@10.0.0.1:6379/1'
+        # failover
+        primary[0] = '10.0.0.3'
+        await topology.refresh()
+        assert topology.primary() is nodes['10.0.0.3:6379']
+        assert ('10.0.0.1', 6379) not in topology.nodes
+        await topology.close()
+
+    async def test_cluster(self):
+        nodes = _Nodes()
+        topology = RedisTopology('redis://seed:7000', CLUSTER, read_from='replica', client_factory=nodes)
+        nodes['seed:7000'].slots = [
+            [0, 8191, ['seed', 7000, 'a'], ['seed-replica', 7001, 'b']],
+            [8192, 16383, ['other', 7002, 'c']],
+        ]
+        await topology.refresh()
+        assert nodes['seed-replica:7001'].readonly and not nodes['other:7002'].readonly
+        redis = RoutedRedis(topology)
+        await redis.sadd('foo', 'a')
+        await redis.sadd('bar', 'b')
+        assert key_slot('foo') > 8191 and await nodes['other:7002'].smembers('foo') == {'a'}
+        assert key_slot('bar') <= 8191 and await nodes['seed:7000'].smembers('bar') == {'b'}
+        # replica of slot of bar serves its reads
+        await nodes['seed-replica:7001'].sadd('bar', 'b')
+        async with redis.pipeline(transaction=False) as pipe:
+            pipe.sismember('foo', 'a')
+            pipe.sismember('bar', 'b')
+            pipe.sismember('bar', 'x')
+            assert await pipe.execute() == [True, True, False]
+        assert [x async for x in redis.sscan_iter('bar')] == ['b']
+        await redis.close()
+
+    async def test_moved(self, monkeypatch):
+        topology = RedisTopology('redis://seed:7000', CLUSTER, client_factory=_Nodes(), refresh_interval=100)
+        await asyncio.sleep(0)
+        refreshed = []
+
+        async def _refresh():
+            refreshed.append(1)
+
+        monkeypatch.setattr(topology, 'refresh', _refresh)
+
+        async def _moved(*_):
+            raise aioredis.exceptions.ResponseError('MOVED 3999 127.0.0.1:6381')
+
+        redis = RoutedRedis(topology)
+        monkeypatch.setattr(topology.primary('x'), 'sadd', _moved)
+        with pytest.raises(aioredis.exceptions.ResponseError):
+            await redis.sadd('x', 'a')
+        await asyncio.sleep(0.01)
+        assert refreshed
+        await redis.close()
+
+
+@pytest.mark.asyncio
+class TestAuthoritativeReplicaReads:
+    async def test_blacklist(self, monkeypatch):
+        monkeypatch.chdir('../')
+        for k_, v_ in {'DNSPY__PLUGINS': '["Authoritative.BlackList"]',
+                       'DNSPY__PLUGIN__AUTHORITATIVE__REDIS_URI': 'redis://primary:6379/0',
+                       'DNSPY__PLUGIN__AUTHORITATIVE__REDIS_TOPOLOGY': 'replica',
+                       'DNSPY__PLUGIN__AUTHORITATIVE__REDIS_REPLICAS': '["replica:6379"]',
+                       'DNSPY__PLUGIN__AUTHORITATIVE__REDIS_READ_FROM': 'replica',
+                       'DNSPY__PLUGIN__AUTHORITATIVE.BLACKLIST__RESPONSE_IP': '["10.0.0.1"]'}.items():
+            monkeypatch.setenv(k_, v_)
+        nodes = _Nodes()
+        monkeypatch.setattr(DNS.RedisTopology, 'create_client', nodes)
+        DNS.Config.Configuration.load()
+        from Plugins.Authoritative import BlackList
+
+        blacklist = BlackList([])
+        assert isinstance(blacklist.redis, RoutedRedis)
+        await blacklist.redis.topology.refresh()
+        # list is only on replica, so answer shows that lookup was served by it
+        await nodes['replica:6379'].sadd('BLDB', 'blocked.test')
+        context = DNS.Context.QueryContext(dns.message.make_query('blocked.test', 'A'), ('127.0.0.1', 0))
+        await blacklist.on_query(context)
+        assert context.response.answer[0][0].address == '10.0.0.1'
+        await blacklist.close()
+        assert blacklist.redis.topology._task is None
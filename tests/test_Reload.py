@@ -0,0 +1,108 @@
+import asyncio
+import os
+import signal
+
+import pytest
+
+import DNS.Config
+from tests.test_Basic import _TestBase
+
+
+@pytest.mark.parametrize('server_conf', [{'DNSPY__PLUGINS': '["QueryLog.Log"]'}], indirect=['server_conf'])
+class TestReload(_TestBase):
+    @pytest.fixture()
+    async def reload_env(self, server, monkeypatch):
+        """
+        environment changes of test are undone and reloaded after test
+        """
+        yield monkeypatch
+        monkeypatch.undo()
+        assert await server.reload()
+
+    async def test_unchanged(self, server, local_remote_equality_assert, reload_env):
+        chain, cache, upstream = server.chain, server.cache, server.upstream
+        assert await server.reload()
+        assert server.chain is not chain
+        assert server.plugins == chain.plugins
+        assert server.cache is cache
+        assert server.upstream is upstream
+        await local_remote_equality_assert(self.EXAMPLE_HOST)
+
+    async def test_changed(self, server, local_remote_equality_assert, reload_env):
+        plugin, cache = server.plugins[0], server.cache
+        closed = []
+        reload_env.setattr(plugin, 'close', lambda: closed.append(plugin))
+        reload_env.setenv('DNSPY__PLUGINS', '["QueryLog.Log", "Example.ExamplePlugin"]')
+        reload_env.setenv('DNSPY__PLUGIN__QUERYLOG.LOG__QUESTION', 'true')
+        reload_env.setenv('DNSPY__CACHE_SIZE', '10')
+        assert await server.reload()
+        assert [x.__class__.__name__ for x in server.plugins] == ['Log', 'ExamplePlugin']
+        assert server.plugins[0] is not plugin and server.plugins[0].config.question
+        assert closed == [plugin]
+        assert server.cache is not cache and server.cache.size == 10
+        await local_remote_equality_assert(self.EXAMPLE_HOST)
+
+    async def test_upstream_changed(self, server, reload_env):
+        upstream = server.upstream
+        closed = []
+
+        async def _close():
+            closed.append(upstream)
+
+        reload_env.setattr(upstream, 'close', _close)
+        reload_env.setenv('DNSPY__UPSTREAM_TIMEOUT', '1.5')
+        assert await server.reload()
+        assert server.upstream is not upstream and server.upstream.timeout == 1.5
+        assert closed == [upstream]
+
+    async def test_reuse_prefix(self, server, reload_env):
+        plugin = server.plugins[0]
+        reload_env.setenv('DNSPY__PLUGINS', '["QueryLog.Log", "Example.ExamplePlugin"]')
+        assert await server.reload()
+        assert server.plugins[0] is plugin
+
+    async def test_invalid(self, server, reload_env):
+        chain, settings = server.chain, DNS.Config.Settings
+        reload_env.setenv('DNSPY__CACHE_SIZE', '-1')
+        assert not await server.reload()
+        assert server.chain is chain
+        assert DNS.Config.Settings is settings
+
+    async def test_drain(self, server, reload_env):
+        chain = server.chain
+        closed = []
+        reload_env.setattr(chain.plugins[0], 'close', lambda: closed.append(True))
+        reload_env.setenv('DNSPY__PLUGIN__QUERYLOG.LOG__QUESTION', 'true')
+        chain.enter()
+        task = asyncio.get_running_loop().create_task(server.reload())
+        await asyncio.sleep(0.05)
+        assert server.chain is not chain
+        assert not task.done() and not closed
+        chain.exit()
+        assert await task
+        assert closed
+
+    async def test_sighup(self, server, reload_env):
+        chain = server.chain
+        os.kill(os.getpid(), signal.SIGHUP)
+        await asyncio.sleep(0.1)
+        assert server.chain is not chain
+
+
+class TestEnvFile:
+    def test_reload_env_file(self, tmp_path, monkeypatch):
+        monkeypatch.chdir('../')
+        monkeypatch.setattr(DNS.Config.Configuration, 'env_file', None)
+        monkeypatch.setattr(DNS.Config.Configuration, '_env_file_keys', set())
+        monkeypatch.setenv('DNSPY__UPSTREAM_PORT', '5300')
+        monkeypatch.delenv('DNSPY__CACHE_SIZE', raising=False)
+        monkeypatch.delenv('DNSPY__WORKERS', raising=False)
+        path = tmp_path / 'env'
+        path.write_text('DNSPY__UPSTREAM_PORT=53\nDNSPY__CACHE_SIZE=10\nDNSPY__WORKERS=2\n')
+        DNS.Config.Configuration.load_env_file(str(path))
+        DNS.Config.Configuration.load()
+        assert (DNS.Config.Settings.upstream_port, DNS.Config.Settings.cache_size) == (5300, 10)
+        path.write_text('DNSPY__CACHE_SIZE=20\n')
+        DNS.Config.Configuration.reload()
+        assert (DNS.Config.Settings.upstream_port, DNS.Config.Settings.cache_size) == (5300, 20)
+        assert DNS.Config.Settings.workers == 1
@@ -0,0 +1,83 @@
+import multiprocessing
+
+import dns.name
+import pytest
+
+import DNS.Config
+import DNS.Core
+from DNS.SharedCache import MAX_SLOT_SIZE, SharedAnswerCache
+
+
+class TestSharedAnswerCache:
+    @pytest.fixture()
+    def cache(self):
+        cache = SharedAnswerCache(slots=64, slot_size=256, stripes=4)
+        yield cache
+        cache.close()
+
+    @staticmethod
+    def _key(host):
+        return SharedAnswerCache.key(dns.name.from_text(host), 1, 1)
+
+    def test_put_get(self, cache):
+        assert cache.get(self._key('a.test')) is None
+        assert cache.put(self._key('a.test'), b'wire-a', 60)
+        assert cache.put(self._key('A.Test'), b'wire-a2', 60)
+        value, ttl, remaining = cache.get(self._key('a.test'))
+        assert value == b'wire-a2'
+        assert ttl == 60
+        assert 59 < remaining <= 60
+        assert cache.count() == 1
+
+    def test_expired_and_large(self, cache):
+        assert cache.put(self._key('a.test'), b'wire', 60, remaining=-1)
+        assert cache.get(self._key('a.test')) is None
+        assert not cache.put(self._key('b.test'), b'x' * 256, 60)
+
+    def test_collisions(self, cache):
+        hosts = [f'host{i}.test' for i in range(40)]
+        for host in hosts:
+            cache.put(self._key(host), host.encode(), 60)
+        found = [x for x in hosts if (cache.get(self._key(x)) or [None])[0] == x.encode()]
+        assert len(found) > 30
+
+    def test_expire(self, cache):
+        hosts = [f'host{i}.test' for i in range(20)]
+        for host in hosts:
+            cache.put(self._key(host), host.encode(), 60)
+        assert cache.expire(b'host1.test.|') == 1
+        assert cache.get(self._key('host1.test')) is None
+        # entries probed past expired slot are still found
+        assert all(cache.get(self._key(x)) for x in hosts if x != 'host1.test')
+        assert cache.expire() == len(hosts) - 1 and cache.count() == 0
+
+    def test_cross_process(self, cache):
+        def _child():
+            cache.put(self._key('child.test'), b'from-child', 60)
+
+        process = multiprocessing.get_context('fork').Process(target=_child)
+        process.start()
+        process.join()
+        assert cache.get(self._key('child.test'))[0] == b'from-child'
+
+    def test_slot_size(self):
+        with pytest.raises(ValueError):
+            SharedAnswerCache(slots=1, slot_size=MAX_SLOT_SIZE + 1)
+
+    @pytest.mark.asyncio
+    async def test_servers(self, cache, stub_response_factory, monkeypatch):
+        monkeypatch.chdir('../')
+        DNS.Config.Configuration.load()
+        writer = DNS.Core.UDPDNSServer(shared_cache=cache)
+        reader = DNS.Core.UDPDNSServer(shared_cache=cache)
+        query, resp = stub_response_factory('a.test', ttl=60)
+        key = writer.cache.key(query)
+        writer._cache_put(query, resp)
+
+        async def _no_upstream(_):
+            raise AssertionError('upstream should not be queried')
+
+        monkeypatch.setattr(reader, 'query_upstream', _no_upstream)
+        resp_ = await reader.resolve(query)
+        assert resp_.answer == resp.answer
+        assert reader.cache.peek(key) is not None
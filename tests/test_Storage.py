@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+from DNS.Storage import FileStorage, IndexFile, compile_index, read_source, reverse_name
+
+
+@pytest.mark.asyncio
+class TestFileStorage:
+    ENTRIES = [('example.com', '1.2.3.4'), ('*.example.com', '5.6.7.8'), ('test.com', ''), ('a.test.com', '')]
+
+    @pytest.fixture()
+    def index_path(self, tmp_path):
+        path = str(tmp_path / 'list.idx')
+        compile_index(self.ENTRIES, path)
+        return path
+
+    def test_reverse_name(self):
+        assert reverse_name('*.example.com') == 'com.example.*'
+
+    def test_read_source(self, tmp_path):
+        path = tmp_path / 'list.txt'
+        path.write_text('# comment\nexample.com 1.2.3.4;5.6.7.8\n\ntest.com\n')
+        assert list(read_source(str(path))) == [('example.com', '1.2.3.4;5.6.7.8'), ('test.com', '')]
+
+    def test_lookup(self, index_path):
+        index = IndexFile(index_path)
+        assert len(index) == len(self.ENTRIES)
+        for name, value in self.ENTRIES:
+            assert index.get(name) == value
+        for name in ['com', 'other.com', 'b.test.com', 'example.co', '']:
+            assert index.get(name) is None
+        index.close()
+
+    def test_large_index(self, tmp_path):
+        path = str(tmp_path / 'large.idx')
+        compile_index(((f'host{i}.example.com', str(i)) for i in range(20000)), path)
+        index = IndexFile(path)
+        assert all(index.get(f'host{i}.example.com') == str(i) for i in range(0, 20000, 7))
+        assert index.get('host20000.example.com') is None
+        index.close()
+
+    async def test_redis_api(self, index_path):
+        storage = FileStorage(index_path)
+        assert await storage.hget('any', 'example.com') == '1.2.3.4'
+        assert await storage.hget('any', 'other.com') is None
+        assert await storage.sismember('any', 'test.com')
+        assert not await storage.sismember('any', 'other.com')
+        storage.close()
+
+    async def test_hot_swap(self, index_path):
+        storage = FileStorage(index_path, check_interval=0.)
+        assert not await storage.sismember('any', 'new.com')
+        compile_index([*self.ENTRIES, ('new.com', '')], index_path)
+        assert await storage.sismember('any', 'new.com')
+        storage.close()
+
+    async def test_broken_replacement(self, index_path):
+        storage = FileStorage(index_path, check_interval=0.)
+        with open(index_path + '.tmp', 'wb') as f_:
+            f_.write(b'garbage-garbage')
+        os.replace(index_path + '.tmp', index_path)
+        assert not storage.reload()
+        assert await storage.sismember('any', 'test.com')
+        storage.close()
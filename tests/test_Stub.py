@@ -0,0 +1,77 @@
+import asyncio
+import time
+
+import dns.asyncquery
+import dns.exception
+import dns.flags
+import dns.message
+import dns.rcode
+import pytest
+
+from DNS.Stub import StubDNSServer
+
+
+@pytest.mark.asyncio
+class TestStub:
+    ZONE = {'example.com': ['1.2.3.4', '5.6.7.8']}
+
+    @staticmethod
+    async def _query(stub, host, timeout=None):
+        ip, port = stub.address
+        return await dns.asyncquery.udp(dns.message.make_query(host, 'A'), ip, port=port, timeout=timeout)
+
+    @pytest.fixture()
+    async def stub_factory(self):
+        stubs = []
+
+        async def _factory(**kwargs):
+            stub = StubDNSServer(self.ZONE, seed=0, **kwargs)
+            await stub.start()
+            stubs.append(stub)
+            return stub
+
+        yield _factory
+        for stub in stubs:
+            await stub.stop()
+
+    async def test_answer(self, stub_factory):
+        stub = await stub_factory()
+        resp = await self._query(stub, 'example.com')
+        assert {x.address for x in resp.answer[0]} == set(self.ZONE['example.com'])
+        resp = await self._query(stub, 'missing.com')
+        assert resp.rcode() == dns.rcode.NXDOMAIN
+
+    async def test_from_file(self, tmp_path):
+        path = tmp_path / 'zone.txt'
+        path.write_text('# comment\nexample.com 1.2.3.4\nexample.com 5.6.7.8\n')
+        stub = StubDNSServer.from_file(str(path))
+        assert stub.zone == self.ZONE
+
+    async def test_latency(self, stub_factory):
+        stub = await stub_factory(latency=0.2)
+        start = time.perf_counter()
+        await self._query(stub, 'example.com')
+        assert time.perf_counter() - start >= 0.2
+
+    async def test_loss(self, stub_factory):
+        stub = await stub_factory(loss=1.)
+        with pytest.raises(dns.exception.Timeout):
+            await self._query(stub, 'example.com', timeout=0.2)
+        assert stub.received == 1
+
+    async def test_truncation(self, stub_factory):
+        stub = await stub_factory(truncation=1.)
+        resp = await self._query(stub, 'example.com')
+        assert resp.flags & dns.flags.TC
+        assert not resp.answer
+
+    async def test_servfail(self, stub_factory):
+        stub = await stub_factory(servfail=1.)
+        resp = await self._query(stub, 'example.com')
+        assert resp.rcode() == dns.rcode.SERVFAIL
+
+    async def test_rates(self, stub_factory):
+        stub = await stub_factory(servfail=0.5)
+        results = await asyncio.gather(*[self._query(stub, 'example.com') for _ in range(200)])
+        servfail = len([x for x in results if x.rcode() == dns.rcode.SERVFAIL])
+        assert 60 < servfail < 140
@@ -0,0 +1,101 @@
+import asyncio
+import ssl
+
+import dns.exception
+import dns.message
+import pytest
+
+from DNS.Stub import StubDNSServer
+from DNS.Upstream import TLSUpstream, UDPUpstream
+from tests.test_Basic import _TestBase
+
+
+@pytest.mark.asyncio
+class TestUpstream:
+    ZONE = {f'host{i}.test': [f'192.0.2.{i}'] for i in range(50)}
+
+    @pytest.fixture()
+    async def stub_factory(self, certificate):
+        stubs = []
+
+        async def _factory(**kwargs):
+            context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+            context.load_cert_chain(*certificate)
+            stub = StubDNSServer(self.ZONE, seed=0, **kwargs)
+            await stub.start()
+            await stub.start_stream(ssl=context)
+            stubs.append(stub)
+            return stub
+
+        yield _factory
+        for stub in stubs:
+            await stub.stop()
+
+    @pytest.fixture()
+    async def upstream_factory(self, certificate):
+        upstreams = []
+
+        def _factory(stub, **kwargs):
+            ip, port = stub.stream_address
+            kwargs = {'server_hostname': 'dns.test', 'ca_file': certificate[0], 'timeout': 1., **kwargs}
+            upstream = TLSUpstream(ip, port, **kwargs)
+            upstreams.append(upstream)
+            return upstream
+
+        yield _factory
+        for upstream in upstreams:
+            await upstream.close()
+
+    async def test_udp(self, stub_factory):
+        stub = await stub_factory()
+        upstream = UDPUpstream(*stub.address)
+        resp = await upstream.query(dns.message.make_query('host1.test', 'A'))
+        assert resp.answer[0][0].address == '192.0.2.1'
+
+    async def test_pipelined(self, stub_factory, upstream_factory):
+        stub = await stub_factory(jitter=0.05)
+        upstream = upstream_factory(stub, pool_size=2)
+        hosts = [f'host{i % 50}.test' for i in range(300)]
+        queries = [dns.message.make_query(x, 'A') for x in hosts]
+        responses = await asyncio.gather(*[upstream.query(x) for x in queries])
+        for host, query, resp in zip(hosts, queries, responses):
+            assert resp.id == query.id
+            assert resp.answer[0].name.to_text(True) == host
+            assert resp.answer[0][0].address == self.ZONE[host][0]
+        assert upstream.connects <= 2
+        assert stub.stream_connections == upstream.connects
+        assert stub.received == 300
+
+    async def test_reconnect(self, stub_factory, upstream_factory):
+        stub = await stub_factory()
+        upstream = upstream_factory(stub, pool_size=1)
+        await upstream.query(dns.message.make_query('host1.test', 'A'))
+        for connection in upstream._connections:
+            connection.close()
+        resp = await upstream.query(dns.message.make_query('host2.test', 'A'))
+        assert resp.answer[0][0].address == '192.0.2.2'
+        assert upstream.connects == 2
+
+    async def test_timeout(self, stub_factory, upstream_factory):
+        stub = await stub_factory(loss=1.)
+        upstream = upstream_factory(stub, timeout=0.2)
+        with pytest.raises(dns.exception.Timeout):
+            await upstream.query(dns.message.make_query('host1.test', 'A'))
+
+    async def test_certificate_mismatch(self, stub_factory, upstream_factory):
+        stub = await stub_factory()
+        upstream = upstream_factory(stub, server_hostname='other.test')
+        with pytest.raises(OSError):
+            await upstream.query(dns.message.make_query('host1.test', 'A'))
+
+
+class TestServerTLSUpstream(_TestBase):
+    async def test_resolve(self, server, stub_upstream, certificate, local_remote_equality_assert, monkeypatch):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        context.load_cert_chain(*certificate)
+        await stub_upstream.start_stream(ssl=context)
+        upstream = TLSUpstream(*stub_upstream.stream_address, server_hostname='dns.test', ca_file=certificate[0])
+        monkeypatch.setattr(server, 'upstream', upstream)
+        await local_remote_equality_assert(self.EXAMPLE_HOST)
+        assert stub_upstream.stream_connections == 1
+        await upstream.close()